@@ -0,0 +1,152 @@
+"""Semantic cache of RAG answers: a question close enough to already answered one gets the cached answer"""
+
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import copy
+import functools
+import inspect
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+import src.config as cfg
+import src.elastic_search.es as es
+from src.embeddings import EmbeddingService, embedding_service
+from src.llm_accounting import llm_accounting
+
+_retrieved_msg_ids: ContextVar[Optional[List[int]]] = ContextVar('retrieved_msg_ids', default=None)
+
+
+def method_params(func: Callable, rag, question: str, args: Tuple = (), kwargs: Dict = None) -> Tuple:
+    """(name, value) of the arguments of rag_* method after question, with defaults, so positional and named calls share the key"""
+    bound = inspect.signature(func).bind(rag, question, *args, **(kwargs or {}))
+    bound.apply_defaults()
+    return tuple(bound.arguments.items())[2:]
+
+
+def note_retrieved(msg_ids: List[int]):
+    """msg_ids the answer is built from, kept with the cached answer"""
+    retrieved = _retrieved_msg_ids.get()
+    if retrieved is not None:
+        retrieved.extend(msg_ids)
+
+
+class SemanticAnswerCache:
+    """_summary_
+    Answers of RAG methods by question embedding, per method, its other arguments and chat.
+    Entries expire after ttl and are dropped for a chat when docs are indexed for it by es.index_docs in this process,
+    answers cached by other processes are refreshed by ttl only.
+    Args:
+        threshold (float, optional): min cosine similarity of questions. Defaults to cfg.answer_cache_threshold.
+        ttl (float, optional): seconds. Defaults to cfg.answer_cache_ttl.
+        max_entries (int, optional): least recently used entries are evicted over that. Defaults to cfg.answer_cache_max_entries.
+        encoder (EmbeddingService, optional): Defaults to embedding_service.
+        clock (Callable, optional): Defaults to time.time.
+    """
+
+    def __init__(self, threshold: float = cfg.answer_cache_threshold, ttl: float = cfg.answer_cache_ttl,
+                 max_entries: int = cfg.answer_cache_max_entries, encoder: EmbeddingService = None, clock: Callable[[], float] = time.time):
+        self.threshold, self.ttl, self.max_entries = threshold, ttl, max_entries
+        self.encoder = encoder or embedding_service
+        self.clock = clock
+        self._entries: OrderedDict[int, Dict] = OrderedDict()  # entry id -> entry, least recently used first
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.saved_latency = 0.0  # seconds
+        self.saved_cost = 0.0  # USD
+
+    def _unit_vector(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.encoder.encode_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1)
+
+    def lookup(self, method: str, question: str, params: Tuple = (), chat_id: int = None) -> Optional[Dict]:
+        """the most similar cached entry over threshold, counts hit or miss"""
+        key, vector, now = (method, params, chat_id or cfg.telegram_group_id), self._unit_vector(question), self.clock()
+        with self._lock:
+            for entry_id in [k for k, x in self._entries.items() if x['created'] + self.ttl < now]:
+                del self._entries[entry_id]
+            candidates = [(k, x) for k, x in self._entries.items() if x['key'] == key]
+            best = None
+            if candidates:
+                sims = np.stack([x['vector'] for _, x in candidates]) @ vector
+                i = int(np.argmax(sims))
+                if sims[i] >= self.threshold:
+                    best = candidates[i]
+            if best is None:
+                self.misses += 1
+                return None
+            entry_id, entry = best
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            self.saved_latency += entry['latency']
+            self.saved_cost += entry['cost']
+        logging.info(f'cached answer of "{entry["question"]}" is reused for "{question}"')
+        return entry
+
+    def store(self, method: str, question: str, answer, msg_ids: List[int] = None, latency: float = 0.0, cost: float = 0.0,
+              params: Tuple = (), chat_id: int = None):
+        entry = {'key': (method, params, chat_id or cfg.telegram_group_id), 'question': question, 'vector': self._unit_vector(question),
+                 'answer': copy.deepcopy(answer), 'msg_ids': list(msg_ids or []), 'latency': latency, 'cost': cost,
+                 'created': self.clock()}
+        with self._lock:
+            self._entries[next(self._ids)] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int = None):
+        """drops entries of the chat, or all of them"""
+        with self._lock:
+            for entry_id in [k for k, x in self._entries.items() if chat_id is None or x['key'][2] == chat_id]:
+                del self._entries[entry_id]
+
+    def on_index(self, index_name: str, chat_ids: Set[int]):
+        for chat_id in chat_ids:
+            self.invalidate(chat_id)
+        logging.info(f'cached answers of chats {chat_ids} are dropped, as {index_name} index is updated')
+
+    def cached(self, method: str = None):
+        """decorator of RaguDuDu.rag_* methods, taking question as the first argument"""
+        def decorator(func):
+            name = method or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(rag, question: str, *args, **kwargs):
+                if not cfg.answer_cache_enabled:
+                    return func(rag, question, *args, **kwargs)
+                params = method_params(func, rag, question, args, kwargs)
+                entry = self.lookup(name, question, params)
+                if entry is not None:
+                    return copy.deepcopy(entry['answer'])
+                msg_ids_token = _retrieved_msg_ids.set([])
+                started = time.perf_counter()
+                try:
+                    with llm_accounting.scope(llm_accounting.current_tag(), budget_name=f'{name} answer') as budget:
+                        answer = func(rag, question, *args, **kwargs)
+                    msg_ids = _retrieved_msg_ids.get()
+                finally:
+                    _retrieved_msg_ids.reset(msg_ids_token)
+                if answer is not None:
+                    self.store(name, question, answer, msg_ids, time.perf_counter() - started, budget.spent, params)
+                return answer
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+            self.saved_latency = self.saved_cost = 0.0
+
+    def stats(self) -> Dict:
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / calls if calls else 0.0,
+                'saved_latency': self.saved_latency, 'saved_cost': self.saved_cost, 'cached': len(self._entries)}
+
+
+answer_cache = SemanticAnswerCache()
+es.index_listeners.append(answer_cache.on_index)
@@ -0,0 +1,73 @@
+"""Splitting of message sequences into prompt sized chunks by real token counts"""
+
+from collections import deque
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List
+import json
+import logging
+
+import src.config as cfg
+
+
+def estimate_tokens(text: str) -> int:
+    letters_per_token = 2  # pessimistic for Cyrillic, used only when tokenizer is not available
+    return len(text) // letters_per_token + 1
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(model: str = cfg.llm_model) -> Callable[[str], int]:
+    """tokens count function of the model tokenizer, falls back to estimate by letters if tiktoken can not load it"""
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:  # model is newer than tiktoken
+            encoding = tiktoken.get_encoding(cfg.tiktoken_default_encoding)
+    except Exception as e:  # not installed, or encoding file can not be downloaded
+        logging.warning(f'no tokenizer for {model}, tokens are estimated by length of text: {e}')
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def message_to_json(msg_dic: Dict) -> str:
+    return json.dumps(msg_dic, ensure_ascii=False)
+
+
+def chunk_to_json(chunk: List[Dict]) -> str:
+    """json array, one message per line, so its size is the sum of sizes of the messages"""
+    return '[\n' + ',\n'.join(message_to_json(m) for m in chunk) + '\n]'
+
+
+def chunk_messages(msg_dicts: Iterable[Dict], max_tokens_count: int, overlapping_msgs_cnt: int = 0,
+                   count_tokens: Callable[[str], int] = None) -> Iterable[List[Dict]]:
+    """_summary_
+    Packs messages to chunks of up to max_tokens_count tokens of chunk_to_json, in one pass with running totals
+    Args:
+        msg_dicts (Iterable[Dict]): messages as they go to the prompt
+        max_tokens_count (int): tokens budget for chunk_to_json of a chunk
+        overlapping_msgs_cnt (int, optional): last messages of a chunk repeated at the start of the next one. Defaults to 0.
+        count_tokens (Callable[[str], int], optional): Defaults to tokenizer of cfg.llm_model.
+
+    Returns:
+        Iterable[List[Dict]]: chunks, a message longer than the budget makes a chunk of its own
+    """
+    count_tokens = count_tokens or get_token_counter(cfg.llm_model)
+    array_tokens, separator_tokens = count_tokens('[\n\n]'), count_tokens(',\n')
+    chunk = deque()  # (msg_dic, tokens)
+    chunk_tokens, new_msgs_cnt = array_tokens, 0
+    for msg_dic in msg_dicts:
+        msg_tokens = count_tokens(message_to_json(msg_dic)) + separator_tokens
+        if chunk_tokens + msg_tokens > max_tokens_count and new_msgs_cnt:
+            yield [m for m, _ in chunk]
+            while len(chunk) > overlapping_msgs_cnt:
+                chunk_tokens -= chunk.popleft()[1]
+            new_msgs_cnt = 0
+        while chunk and chunk_tokens + msg_tokens > max_tokens_count:  # overlap has to give way to new message
+            chunk_tokens -= chunk.popleft()[1]
+        if array_tokens + msg_tokens > max_tokens_count:
+            logging.warning(f'message {msg_dic.get("msg_id")} of {msg_tokens} tokens does not fit to {max_tokens_count}')
+        chunk.append((msg_dic, msg_tokens))
+        chunk_tokens += msg_tokens
+        new_msgs_cnt += 1
+    if new_msgs_cnt:
+        yield [m for m, _ in chunk]
@@ -0,0 +1,229 @@
+"""Compact columnar backend of TelegaMessageIndex for chats with millions of messages"""
+
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from src.data_classes import TelegaMessage
+from src.telegram_messages_index import TelegaMessageIndex
+
+NO_ID = -1  # stands for None in int columns
+
+
+class ColumnarMessages(Mapping):
+    """read only Dict[int, TelegaMessage] view over columnar index"""
+
+    def __init__(self, index: 'ColumnarTelegaMessageIndex'):
+        self._index = index
+
+    def __getitem__(self, msg_id: int) -> TelegaMessage:
+        msg = self._index.get_message(msg_id)
+        if msg is None:
+            raise KeyError(msg_id)
+        return msg
+
+    def __contains__(self, msg_id) -> bool:
+        return self._index.get_row(msg_id) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        self._index.consolidate()
+        return iter(self._index.msg_ids.tolist())
+
+    def __len__(self) -> int:
+        self._index.consolidate()
+        return len(self._index.msg_ids)
+
+
+class ColumnarTelegaMessageIndex(TelegaMessageIndex):
+    """_summary_
+    Same API as TelegaMessageIndex, but messages are kept in typed numpy arrays sorted by msg_id,
+    texts in one utf-8 buffer with offsets, and replies as CSR (parent id -> children ids) structure.
+    TelegaMessage objects are created only when asked for, so they are not shared between calls.
+    Added messages are collected to staging list and merged to arrays on the next query.
+    Each merge rebuilds the arrays and derived structures in O(N log N), so add all messages first
+    and query after, interleaving add_item with queries pays the full rebuild on every query.
+    """
+
+    def __init__(self):
+        self.msg_ids = np.empty(0, dtype=np.int64)
+        self.msg_dates = np.empty(0, dtype='datetime64[s]')
+        self.reply_to_ids = np.empty(0, dtype=np.int64)
+        self.chat_ids = np.empty(0, dtype=np.int64)
+        self.user_id_codes = np.empty(0, dtype=np.int32)  # index in self.user_ids, NO_ID for None
+        self.user_name_codes = np.empty(0, dtype=np.int32)  # index in self.user_names, NO_ID for None
+        self.user_ids: List[str] = []
+        self.user_names: List[str] = []
+        self.text_buffer = bytearray()  # utf-8 texts in order of arrival, append only
+        self.text_starts = np.empty(0, dtype=np.int64)
+        self.text_ends = np.empty(0, dtype=np.int64)
+        self.text_is_null = np.empty(0, dtype=bool)
+        # CSR of replies: children of reply_parent_ids[i] are reply_child_ids[reply_indptr[i]:reply_indptr[i+1]]
+        self.reply_parent_ids = np.empty(0, dtype=np.int64)
+        self.reply_indptr = np.zeros(1, dtype=np.int64)
+        self.reply_child_ids = np.empty(0, dtype=np.int64)
+        self.date_order = np.empty(0, dtype=np.int64)  # rows ordered by msg_date, msg_id
+        self.sorted_dates = np.empty(0, dtype='datetime64[s]')  # msg_dates in date_order, for range search
+        self.topic_tops = np.empty(0, dtype=np.int64)  # topic starting msg id per row
+        self.topic_sizes = np.empty(0, dtype=np.int64)  # number of messages in the topic of the row
+        self._pending: Dict[int, TelegaMessage] = dict()
+
+    @property
+    def msdg_ids(self) -> ColumnarMessages:
+        return ColumnarMessages(self)
+
+    def add_item(self, msg: TelegaMessage):
+        if msg.msg_id not in self._pending and self._find_row(msg.msg_id) is None:
+            self._pending[msg.msg_id] = msg
+
+    def consolidate(self):
+        """merges staged messages to the arrays and rebuilds derived structures, O(N log N) for all messages of the index"""
+        if not self._pending:
+            return
+        msgs = list(self._pending.values())
+        self._pending = dict()
+        user_id_codes = {x: i for i, x in enumerate(self.user_ids)}
+        user_name_codes = {x: i for i, x in enumerate(self.user_names)}
+
+        def encode(value, codes: Dict[str, int], table: List[str]) -> int:
+            if value is None:
+                return NO_ID
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(table)
+                table.append(value)
+            return code
+
+        texts = [(m.msg_text or '').encode('utf-8') for m in msgs]
+        new_ends = len(self.text_buffer) + np.cumsum([len(t) for t in texts], dtype=np.int64)
+        self.text_buffer += b''.join(texts)
+        msg_ids = np.concatenate([self.msg_ids, np.fromiter((m.msg_id for m in msgs), dtype=np.int64, count=len(msgs))])
+        order = np.argsort(msg_ids, kind='stable')
+        self.msg_ids = msg_ids[order]
+        self.msg_dates = np.concatenate([self.msg_dates, np.array([m.msg_date for m in msgs], dtype='datetime64[s]')])[order]
+        self.reply_to_ids = np.concatenate([self.reply_to_ids, np.fromiter(
+            (NO_ID if m.reply_to_msg_id is None else m.reply_to_msg_id for m in msgs), dtype=np.int64, count=len(msgs))])[order]
+        self.chat_ids = np.concatenate([self.chat_ids, np.fromiter(
+            (NO_ID if m.chat_id is None else m.chat_id for m in msgs), dtype=np.int64, count=len(msgs))])[order]
+        self.user_id_codes = np.concatenate([self.user_id_codes, np.fromiter(
+            (encode(m.user_id, user_id_codes, self.user_ids) for m in msgs), dtype=np.int32, count=len(msgs))])[order]
+        self.user_name_codes = np.concatenate([self.user_name_codes, np.fromiter(
+            (encode(m.user_name, user_name_codes, self.user_names) for m in msgs), dtype=np.int32, count=len(msgs))])[order]
+        self.text_is_null = np.concatenate([self.text_is_null, np.array([m.msg_text is None for m in msgs], dtype=bool)])[order]
+        new_starts = new_ends - np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        self.text_starts = np.concatenate([self.text_starts, new_starts])[order]
+        self.text_ends = np.concatenate([self.text_ends, new_ends])[order]
+        self._build_derived()
+
+    def _build_derived(self):
+        has_parent = self.reply_to_ids != NO_ID
+        child_rows = np.nonzero(has_parent)[0]
+        children_order = np.lexsort((self.msg_ids[child_rows], self.reply_to_ids[child_rows]))
+        parents = self.reply_to_ids[child_rows][children_order]
+        self.reply_child_ids = self.msg_ids[child_rows][children_order]
+        self.reply_parent_ids, counts = np.unique(parents, return_counts=True)
+        self.reply_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.date_order = np.lexsort((self.msg_ids, self.msg_dates))
+        self.sorted_dates = self.msg_dates[self.date_order]
+
+        # topic roots by pointer jumping over parent rows: O(N log(depth)) vectorized
+        rows = np.arange(len(self.msg_ids))
+        parent_rows = rows.copy()
+        if len(self.msg_ids):
+            pos = np.searchsorted(self.msg_ids, self.reply_to_ids).clip(max=len(self.msg_ids) - 1)
+            parent_in_index = has_parent & (self.msg_ids[pos] == self.reply_to_ids)
+            parent_rows[parent_in_index] = pos[parent_in_index]
+        for _ in range(64):  # 2**64 is more than enough for any reply chain, cycles just stop here
+            next_rows = parent_rows[parent_rows]
+            if np.array_equal(next_rows, parent_rows):
+                break
+            parent_rows = next_rows
+        # topic of missing parent is named by its id, like in dict based index
+        self.topic_tops = np.where(self.reply_to_ids[parent_rows] != NO_ID, self.reply_to_ids[parent_rows], self.msg_ids[parent_rows])
+        _, inverse, counts = np.unique(self.topic_tops, return_inverse=True, return_counts=True)
+        self.topic_sizes = counts[inverse]
+
+    def _find_row(self, msg_id: int) -> Optional[int]:
+        row = int(np.searchsorted(self.msg_ids, msg_id))
+        if row < len(self.msg_ids) and self.msg_ids[row] == msg_id:
+            return row
+        return None
+
+    def get_row(self, msg_id: int) -> Optional[int]:
+        self.consolidate()
+        return self._find_row(msg_id)
+
+    def _build_message(self, row: int) -> TelegaMessage:
+        reply_to, chat_id = int(self.reply_to_ids[row]), int(self.chat_ids[row])
+        user_id_code, user_name_code = self.user_id_codes[row], self.user_name_codes[row]
+        text = None
+        if not self.text_is_null[row]:
+            text = self.text_buffer[self.text_starts[row]:self.text_ends[row]].decode('utf-8')
+        return TelegaMessage.model_construct(msg_id=int(self.msg_ids[row]),
+                                             msg_date=self.msg_dates[row].item(),
+                                             user_id=None if user_id_code == NO_ID else self.user_ids[user_id_code],
+                                             user_name=None if user_name_code == NO_ID else self.user_names[user_name_code],
+                                             chat_id=None if chat_id == NO_ID else chat_id,
+                                             reply_to_msg_id=None if reply_to == NO_ID else reply_to,
+                                             msg_text=text)
+
+    def get_message(self, msg_id: int) -> TelegaMessage:
+        row = self.get_row(msg_id)
+        return None if row is None else self._build_message(row)
+
+    def get_children_ids(self, msg_id: int) -> Iterable[int]:
+        self.consolidate()
+        i = int(np.searchsorted(self.reply_parent_ids, msg_id))
+        if i < len(self.reply_parent_ids) and self.reply_parent_ids[i] == msg_id:
+            return self.reply_child_ids[self.reply_indptr[i]:self.reply_indptr[i + 1]].tolist()
+        return []
+
+    def sorted_date_index(self) -> List[Tuple[datetime, int]]:
+        self.consolidate()
+        rows = self.date_order
+        return list(zip(self.msg_dates[rows].tolist(), self.msg_ids[rows].tolist()))
+
+    def get_msg_ids_by_date_range(self, date_from: datetime, date_to: datetime) -> List[int]:
+        self.consolidate()
+        start = np.searchsorted(self.sorted_dates, np.datetime64(date_from, 's'), side='left')
+        end = np.searchsorted(self.sorted_dates, np.datetime64(date_to, 's'), side='right')
+        return self.msg_ids[self.date_order[start:end]].tolist()
+
+    def topic_of(self, msg_id: int) -> Optional[int]:
+        row = self.get_row(msg_id)
+        return None if row is None else int(self.topic_tops[row])
+
+    def topic_size(self, msg_id: int) -> int:
+        row = self.get_row(msg_id)
+        return 0 if row is None else int(self.topic_sizes[row])
+
+    def get_topic_roots(self, min_size: int = 1) -> List[Tuple[int, int]]:
+        self.consolidate()
+        tops, counts = np.unique(self.topic_tops, return_counts=True)
+        mask = counts >= min_size
+        return list(zip(tops[mask].tolist(), counts[mask].tolist()))
+
+    @property
+    def topics(self) -> Dict[int, set]:
+        self.consolidate()
+        order = np.argsort(self.topic_tops, kind='stable')
+        tops, starts = np.unique(self.topic_tops[order], return_index=True)
+        groups = np.split(self.msg_ids[order], starts[1:])
+        return {int(top): set(ids.tolist()) for top, ids in zip(tops, groups)}
+
+    def _snapshot_state(self) -> Dict:
+        self.consolidate()
+        return {name: value for name, value in vars(self).items() if name != '_pending'}
+
+    def _restore_snapshot_state(self, state: Dict):
+        for name, value in state.items():
+            if name not in ('version', 'index_class', 'dump_signature'):
+                setattr(self, name, value)
+
+    def memory_usage(self) -> int:
+        """bytes held by the arrays and tables of the index"""
+        self.consolidate()
+        arrays = sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+        tables = sum(len(x) for x in self.user_ids) + sum(len(x) for x in self.user_names)
+        return arrays + len(self.text_buffer) + tables
@@ -0,0 +1,98 @@
+"""Persistent cache of LLM completions, keyed by hash of model, prompt and request parameters"""
+
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import src.config as cfg
+
+
+def completion_key(model: str, prompt: str, **params) -> str:
+    content = json.dumps({'model': model, 'prompt': prompt, 'params': params}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """SQLite table of completions with the cost paid for them
+
+    Args:
+        path (str, optional): sqlite file. Defaults to cfg.llm_cache_path.
+        max_entries (int, optional): least recently used entries above that are evicted. Defaults to cfg.llm_cache_max_entries.
+        max_age (float, optional): seconds, older entries are treated as missing and evicted. Defaults to cfg.llm_cache_max_age.
+        read_only (bool, optional): only lookups, nothing is written to the file. Defaults to False.
+    """
+
+    evict_every_puts = 100
+
+    def __init__(self, path: str = cfg.llm_cache_path, max_entries: int = cfg.llm_cache_max_entries,
+                 max_age: float = cfg.llm_cache_max_age.total_seconds(), read_only: bool = False):
+        self.path, self.max_entries, self.max_age, self.read_only = path, max_entries, max_age, read_only
+        self._lock = threading.Lock()
+        self._puts_count = 0
+        self._conn = None
+        if read_only:
+            if os.path.exists(path):
+                self._conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+            else:
+                logging.info(f'no completion cache at {path}, read only cache is empty')
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, model TEXT, '
+                               'response TEXT, cost REAL, created REAL, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)')
+            self._conn.commit()
+            self.evict()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """(response, cost paid for it) or None"""
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT response, cost, created FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None or time.time() - row[2] > self.max_age:
+                return None
+            if not self.read_only:
+                self._conn.execute('UPDATE completions SET last_access = ? WHERE key = ?', (time.time(), key))
+                self._conn.commit()
+        return row[0], row[1]
+
+    def put(self, key: str, model: str, response: str, cost: float):
+        if self.read_only or self._conn is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)', (key, model, response, cost, now, now))
+            self._conn.commit()
+            self._puts_count += 1
+        if self._puts_count % self.evict_every_puts == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """removes expired entries and least recently used ones above max_entries, returns number of removed"""
+        if self.read_only or self._conn is None:
+            return 0
+        with self._lock:
+            removed = self._conn.execute('DELETE FROM completions WHERE created < ?', (time.time() - self.max_age,)).rowcount
+            removed += self._conn.execute('DELETE FROM completions WHERE key IN (SELECT key FROM completions '
+                                          'ORDER BY last_access DESC LIMIT -1 OFFSET ?)', (self.max_entries,)).rowcount
+            self._conn.commit()
+        return removed
+
+    def stats(self) -> Dict:
+        if self._conn is None:
+            return {'entries': 0, 'cost': 0.0}
+        with self._lock:
+            entries, cost = self._conn.execute('SELECT count(*), coalesce(sum(cost), 0) FROM completions').fetchone()
+        return {'entries': entries, 'cost': cost}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -15,25 +15,104 @@ elastic_search_index_config_path = "src/elastic_search/index_settings.yml"
 
 messages_dump_path = "/Users/dklmn/Documents/data/telega/result.json"
 topics_path = 'output/llm_output/topics.json' 
+ground_truth_path = 'output/llm_output/ground_truth.json'  # questions for offline evaluation, see rag_benchmark.py
+benchmark_output_dir = 'output/benchmark'  # json results of rag_benchmark runs
+topics_checkpoint_path = 'output/llm_output/topics_checkpoint.jsonl'  # topics already summarized by topic_pipeline
+topic_min_size = 5  # topics of fewer messages are not summarized in bulk
+dump_parse_workers = 1  # processes for parsing of telegram dump, see read_telega_dump.telega_dump_parse_fast
+dump_parse_batch_size = 10000  # messages parsed at once with paused gc by streaming reader of the dump
+dump_parse_validate = False  # pydantic validation of each message of the dump, the dump is trusted input
+parquet_cache_dir = 'output/cache/parquet'  # parsed dump partitioned by chat_id and month, see parquet_cache.py
+messages_index_snapshot_path = 'output/cache/messages_index.pkl'  # snapshot of TelegaMessageIndex, rebuilt when dump changes
+messages_index_source = 'dump'  # 'dump' - telegram json dump (messages_dump_path), 'es' - index_name_messages index
+messages_index_backend = 'dict'  # 'dict' - pydantic message per msg_id, 'columnar' - numpy arrays, for chats with millions of messages
+snapshot_validate_hash = False  # to check dump content hash in addition to size and mtime, slow for big dumps
 
 index_name_topics = 'telegram-topics'
 index_name_messages = "telegram-messages"
 index_name_messages_eng = "telegram-messages-eng"
-index_pk_fields = {index_name_topics: ['chat_id', 'topic_name'],
+index_pk_fields = {index_name_topics: ['chat_id', 'topic_msg_id'],  # by starting message, LLM may give the same name to different topics
                    index_name_messages: ['chat_id', 'msg_id'],
                    index_name_messages_eng: ['chat_id', 'msg_id'],                  
                    }  # logical PKs for doc fields
+es_bulk_chunk_size = 500  # number of docs per bulk request
+es_bulk_max_chunk_bytes = 50 * 1024 * 1024  # max size of one bulk request
+es_bulk_max_retries = 3  # retries for docs rejected with 429 during bulk load
+es_scan_slices = 4  # parallel slices for reading whole index
+es_scan_page_size = 5000  # hits per request for reading whole index
+index_checkpoint_dir = 'output/index_checkpoints'  # what is already indexed, for incremental reindexing
+es_vector_index_type = 'int8_hnsw'  # 'hnsw' - float32, 'int8_hnsw' (ES 8.12+), 'int4_hnsw' (8.15+), 'bbq_hnsw' (8.18+) - binary
+es_vectors_in_source = False  # vectors are not returned by searches, so keeping them in _source only grows the index
+es_msearch_batch_size = 100  # searches per _msearch request of batch search functions
+es_knn_num_candidates = 10000  # candidates per shard for approximate kNN
+es_knn_rescore_oversample = 3.0  # k * oversample quantized candidates are rescored exactly (ES 8.18+), 0 - no rescoring
+vector_search_backend = 'es'  # 'es' - ES kNN, 'local' - in-process search over files built by vector_store.LocalVectorIndex
+local_vector_index_dir = 'output/cache/vectors'
+local_vector_dtype = 'float16'  # 'float32' for exact scores, 'float16' halves memory with ~1e-3 score error
+local_vector_hnsw_min_size = 200000  # HNSW graph is built for bigger indices, if hnswlib is installed
+local_vector_hnsw_ef = 100  # HNSW search breadth, more is slower and more accurate
+hybrid_candidates = 30  # docs taken from each leg of fused hybrid search before fusion
+hybrid_rrf_k = 60  # rank constant of reciprocal-rank fusion, larger - flatter contribution of top ranks
+hybrid_text_timeout = 2.0  # seconds to wait for BM25 leg of fused hybrid search
+hybrid_knn_timeout = 2.0  # seconds to wait for kNN leg of fused hybrid search
 
 
 sent_tranformer_model_name = 'distiluse-base-multilingual-cased-v1'
+query_embedding_cache_size = 10000  # number of query vectors kept in LRU cache of embedding service
+embedding_batch_size = 64  # number of texts per forward pass when encoding documents
+reranker_model_name = 'cross-encoder/ms-marco-MiniLM-L-12-v2'
+reranker_backend = 'torch'  # 'torch', 'int8' - dynamically quantized for CPU, 'onnx' - needs optimum[onnxruntime]
+reranker_max_length = 512  # max tokens of (query, doc) pair
+reranker_batch_size = 32  # pairs per forward pass
+reranker_cache_size = 50000  # number of cached (query, doc) scores
 
 llm_model, llm_price = "gpt-4o-2024-08-06", (2.5, 10)  # input,output tokens, usd for 1M
 
 # llm_model, llm_price = "gpt-4o-mini", (0.15, 0.6)  # input, output tokens, usd for 1M
+tiktoken_default_encoding = 'o200k_base'  # for models unknown to installed tiktoken
+llm_cache_mode = 'read_write'  # completion cache: 'read_write', 'read_only' - do not store new completions, 'off'
+llm_cache_path = 'output/cache/llm_completions.sqlite'
+llm_cache_max_entries = 100000  # least recently used completions above are evicted
+llm_cache_max_age = timedelta(days=180)  # older completions are asked again
+llm_expected_completion_tokens = 1000  # to estimate cost of a call before it is made, for budgets
+llm_soft_budget_delay = 5.0  # seconds, bulk calls are slowed down by, when soft budget is exceeded
+llm_query_budget_usd = 0.5  # hard limit for LLM calls answering one user question
+llm_accounting_max_records = 10000  # last LLM calls kept with details
+prompt_format = 'compact'  # messages in prompts: 'compact' - short keys, no nulls, user table, relative time; 'json' - all the fields
+prompt_context_max_tokens = 12000  # budget of messages in RAG and summarization prompts, see prompt_context.pack_messages
+answer_cache_enabled = True  # semantic cache of RAG answers, see answer_cache.py
+answer_cache_threshold = 0.92  # min cosine similarity of question embeddings to reuse cached answer
+answer_cache_ttl = 24 * 3600  # seconds, answers older than that are recomputed
+answer_cache_max_entries = 1000  # least recently used answers are evicted over that
+rag_service_host, rag_service_port = '127.0.0.1', 8765  # HTTP query service, see rag_service.py
+rag_service_workers = 8  # queries processed at once, each in its own thread
+rag_service_max_queue = 64  # queries waiting for a worker, more are rejected with 503
+rag_service_queue_timeout = 30.0  # seconds a query may wait for a worker, then it is rejected with 503
+rag_service_batch_window = 0.005  # seconds to collect questions of concurrent queries into one embedding call
+rag_service_max_batch = 64  # questions per embedding call
+rag_service_max_body = 1 << 20  # bytes of request body
+llm_max_concurrency = 8  # requests in flight for bulk jobs, see llm.AsyncLLMClient
+llm_rpm_limit = 500  # requests per minute of the account tier
+llm_tpm_limit = 30000  # tokens (prompt + completion) per minute of the account tier
+llm_max_retries = 5  # retries on 429 and 5xx responses
+llm_retry_base_delay, llm_retry_max_delay = 1.0, 30.0  # seconds, exponential backoff with full jitter
 
 
-def read_index_settings(index_name):
+def read_index_settings(index_name, vector_index_type: str = None, vectors_in_source: bool = None):
     with open(elastic_search_index_config_path, 'r') as file:
         data = yaml.safe_load(file)
-        return data[index_name]
+        return apply_vector_options(data[index_name], vector_index_type or es_vector_index_type,
+                                    es_vectors_in_source if vectors_in_source is None else vectors_in_source)
+
+
+def apply_vector_options(index_settings, vector_index_type: str, vectors_in_source: bool):
+    """sets HNSW quantization of dense_vector fields and excludes them from _source"""
+    properties = index_settings['mappings']['properties']
+    vector_flds = [f for f in properties if properties[f]['type'] == 'dense_vector']
+    for f in vector_flds:
+        if properties[f].get('index', True):
+            properties[f]['index_options'] = {'type': vector_index_type}
+    if vector_flds and not vectors_in_source:
+        index_settings['mappings']['_source'] = {'excludes': vector_flds}
+    return index_settings
     
@@ -1,78 +1,257 @@
 import json
-from typing import Iterable, Dict, List
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from itertools import islice
+from queue import Queue, Full
+from threading import Event
+from typing import Callable, Iterable, Dict, List, Set, Tuple
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
 
 import src.config as cfg
 from src.data_classes import TelegaMessage
+from src.embeddings import embedding_service, encode_vector_fields, field_to_encode
+from src.perf import stage
+from src.elastic_search.index_checkpoint import IndexCheckpoint, doc_content_hash
 from src.read_telega_dump import telega_dump_parse_essential
+from src.vector_store import LocalVectorIndex, get_local_vector_index, load_local_vector_index
 
 es_client = Elasticsearch(cfg.es_url) 
 # es_client.info()
 
+search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='es-search')  # legs of fused hybrid search
+
+index_listeners: List[Callable[[str, Set[int]], None]] = []  # called with index name and chat ids after docs are indexed
+
+scan_message_fields = ['msg_id', 'msg_date', 'user_id', 'user_name', 'chat_id', 'reply_to_msg_id', 'msg_text']
+
+
+def batched(iterable: Iterable, n: int) -> Iterable[List]:
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
 
 def get_st_model():
-    model = SentenceTransformer(cfg.sent_tranformer_model_name)
-    return model
+    return embedding_service.get_model(cfg.sent_tranformer_model_name)
 
 
-def index_json_file(file_path: str, index_name, recreate_index=True):
+def index_json_file(file_path: str, index_name, recreate_index=True, bulk=False, incremental=False):
     with open(file_path, 'r', encoding='utf-8') as f:
         docs = json.load(f)
-    index_docs(docs, index_name, recreate_index)
+    return index_docs(docs, index_name, recreate_index, bulk=bulk, incremental=incremental)
 
 
-def index_docs(docs: Iterable[Dict], index_name, recreate_index=True):
+def index_docs(docs: Iterable[Dict], index_name, recreate_index=True, bulk=False, incremental=False,
+               encode_batch_size: int = cfg.embedding_batch_size, bulk_chunk_size: int = cfg.es_bulk_chunk_size,
+               pk_fields: List[str] = None, bulk_settings: bool = True):
+    """_summary_
+    To push documents to ES index, calculating dense vectors for "<field>_vector" fields
+    Args:
+        docs (Iterable[Dict]): documents to index
+        index_name (str): name of ES index, settings for which are in index_settings.yml
+        recreate_index (bool, optional): drop and create index before loading. Defaults to True.
+        bulk (bool, optional): batch encoding and bulk API instead of one request per document. Defaults to False.
+        incremental (bool, optional): index only new or changed docs, according to the index checkpoint. Defaults to False.
+        encode_batch_size (int, optional): number of documents encoded per forward pass in bulk mode.
+        bulk_chunk_size (int, optional): number of documents per bulk request in bulk mode.
+        pk_fields (List[str], optional): fields of doc id. Defaults to cfg.index_pk_fields of the index.
+        bulk_settings (bool, optional): to turn off refresh and replicas for the load in bulk mode, False if the caller
+            does that once for many loads, see bulk_load_settings. Defaults to True.
+
+    Returns:
+        Dict: number of indexed and skipped documents and list of failed ones
+    """
     ind_set = cfg.read_index_settings(index_name)
+    pk_fields = pk_fields or cfg.index_pk_fields.get(index_name)
+    checkpoint = None
+    if incremental:
+        if not pk_fields:
+            raise Exception(f'incremental indexing needs logical PK for index {index_name}, see cfg.index_pk_fields')
+        checkpoint = IndexCheckpoint(index_name)
     if recreate_index:
         es_client.indices.delete(index=index_name, ignore_unavailable=True)
-        es_client.indices.create(index=index_name, body=ind_set)
+    created = ensure_index(index_name, ind_set)
+    if created:  # nothing is indexed yet, whatever checkpoint says
+        if checkpoint:
+            checkpoint.reset()
+        else:
+            IndexCheckpoint.delete(index_name)  # so the next incremental load does not skip docs of the dropped index
     
     ind_flds = ind_set['mappings']['properties']
     vector_flds = [f for f in ind_flds if ind_flds[f]['type'] == 'dense_vector']
-    if vector_flds:
-        model = get_st_model()
-    pk_fields = cfg.index_pk_fields.get(index_name)
-    for d in tqdm(docs):
-        d['chat_id'] = cfg.telegram_group_id
-        doc_id = None
-        if pk_fields:
-            doc_id = ';'.join([str(d[x]) for x in pk_fields])
-        for ftv in vector_flds:
-            fld_to_encode = ftv[0: len(ftv) - len('_vector')]  # lets rely on this convention
-            if fld_to_encode in d:
-                d[ftv] = model.encode(d[fld_to_encode]).tolist()
-        es_client.index(index=index_name, id=doc_id, document=d)
-
-
-def load_messages_from_dump():
+    stats = {'indexed': 0, 'skipped': 0, 'failed': []}
+    pending = dict()  # doc_id -> content hash, for docs not confirmed by ES yet
+    loaded = None
+    if cfg.vector_search_backend == 'local':
+        loaded = dict()  # doc_id -> doc, skipped ones too, to refresh local vector index
+        docs = _collect_docs(docs, pk_fields, loaded)
+    if checkpoint:
+        docs = _filter_changed_docs(docs, pk_fields, vector_flds, checkpoint, pending, stats)
+    try:
+        if bulk:
+            with bulk_load_settings(index_name) if bulk_settings else nullcontext():
+                _bulk_index_docs(docs, index_name, vector_flds, pk_fields, encode_batch_size, bulk_chunk_size, stats, checkpoint, pending)
+        else:
+            for d in tqdm(docs):
+                doc_id = _prepare_doc(d, pk_fields)
+                for ftv in vector_flds:
+                    fld_to_encode = field_to_encode(ftv)
+                    if fld_to_encode in d:
+                        d[ftv] = embedding_service.encode([d[fld_to_encode]])[0].tolist()
+                es_client.index(index=index_name, id=doc_id, document=d)
+                _confirm_indexed(doc_id, stats, checkpoint, pending)
+    finally:
+        if checkpoint:
+            checkpoint.save()
+    if loaded is not None:
+        _refresh_local_vector_index(index_name, loaded, pk_fields, replace=created)
+    if stats['indexed'] or recreate_index:  # listeners are told only about completed loads
+        for listener in index_listeners:  # _prepare_doc puts every doc to cfg.telegram_group_id chat
+            listener(index_name, {cfg.telegram_group_id})
+    logging.info(f'{index_name}: {stats["indexed"]} documents indexed, {stats["skipped"]} unchanged skipped, {len(stats["failed"])} failed')
+    return stats
+
+
+def ensure_index(index_name: str, ind_set: Dict = None) -> bool:
+    """creates index by its settings if it does not exist, returns True if it is created"""
+    if es_client.indices.exists(index=index_name):
+        return False
+    es_client.indices.create(index=index_name, body=ind_set or cfg.read_index_settings(index_name))
+    return True
+
+
+def _prepare_doc(d: Dict, pk_fields: List[str]) -> str:
+    d['chat_id'] = cfg.telegram_group_id
+    if pk_fields:
+        return ';'.join([str(d[x]) for x in pk_fields])
+
+
+def _collect_docs(docs: Iterable[Dict], pk_fields: List[str], loaded: Dict) -> Iterable[Dict]:
+    for d in docs:
+        doc_id = _prepare_doc(d, pk_fields)
+        loaded[doc_id if doc_id is not None else len(loaded)] = d  # indexing adds vectors to the same dict
+        yield d
+
+
+def _refresh_local_vector_index(index_name: str, loaded: Dict, pk_fields: List[str], replace: bool):
+    """loaded docs replace the docs of the same id in local vector index, which keeps the others unless ES index is new;
+    vectors of docs skipped by incremental load are taken from the previous index, not encoded again"""
+    previous = load_local_vector_index(index_name)
+    docs = loaded
+    if previous is not None and not replace:
+        kept = dict()
+        for i, d in enumerate(previous.docs):
+            doc_id = _prepare_doc(dict(d), pk_fields)
+            kept[doc_id if doc_id is not None else ('previous', i)] = d
+        docs = {**kept, **loaded}
+    LocalVectorIndex.build(docs.values(), index_name, index_dir=cfg.local_vector_index_dir, previous=previous)
+
+
+def _filter_changed_docs(docs: Iterable[Dict], pk_fields: List[str], vector_flds: List[str],
+                         checkpoint: IndexCheckpoint, pending: Dict, stats: Dict) -> Iterable[Dict]:
+    for d in docs:
+        doc_id = _prepare_doc(d, pk_fields)
+        content_hash = doc_content_hash(d, skip_fields=vector_flds)
+        if not checkpoint.is_changed(doc_id, content_hash):
+            stats['skipped'] += 1
+            continue
+        pending[doc_id] = content_hash
+        yield d
+
+
+def _confirm_indexed(doc_id: str, stats: Dict, checkpoint: IndexCheckpoint, pending: Dict):
+    stats['indexed'] += 1
+    if checkpoint and doc_id in pending:  # same doc might come twice in one load
+        checkpoint.update(doc_id, pending.pop(doc_id))
+
+
+def _bulk_actions(docs: Iterable[Dict], index_name: str, vector_flds: List[str], pk_fields: List[str], encode_batch_size: int):
+    for batch in batched(tqdm(docs), encode_batch_size):
+        encode_vector_fields(batch, vector_flds, encode_batch_size, encoder=embedding_service)
+        for d in batch:
+            doc_id = _prepare_doc(d, pk_fields)
+            yield {'_index': index_name, '_id': doc_id, '_source': d}
+
+
+@contextmanager
+def bulk_load_settings(index_name: str):
+    """turns off refresh and replicas for the time of bulk load, restoring them afterwards"""
+    index_settings = es_client.indices.get_settings(index=index_name)[index_name]['settings']['index']
+    initial = {'refresh_interval': index_settings.get('refresh_interval'),  # None means default
+               'number_of_replicas': index_settings.get('number_of_replicas')}
+    es_client.indices.put_settings(index=index_name, settings={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    try:
+        yield
+    finally:
+        es_client.indices.put_settings(index=index_name, settings={'index': initial})
+        es_client.indices.refresh(index=index_name)
+
+
+def _bulk_index_docs(docs: Iterable[Dict], index_name: str, vector_flds: List[str], pk_fields: List[str],
+                     encode_batch_size: int, bulk_chunk_size: int, stats: Dict, checkpoint: IndexCheckpoint = None, pending: Dict = None):
+    actions = _bulk_actions(docs, index_name, vector_flds, pk_fields, encode_batch_size)
+    for ok, info in streaming_bulk(es_client, actions, chunk_size=bulk_chunk_size, max_chunk_bytes=cfg.es_bulk_max_chunk_bytes,
+                                   raise_on_error=False, raise_on_exception=False, max_retries=cfg.es_bulk_max_retries):
+        op_info = next(iter(info.values()))
+        if ok:
+            _confirm_indexed(op_info.get('_id'), stats, checkpoint, pending)
+        else:
+            stats['failed'].append({'_id': op_info.get('_id'), 'error': op_info.get('error')})
+            logging.warning(f'failed to index document {op_info.get("_id")}: {op_info.get("error")}')
+
+
+def load_messages_from_dump(incremental: bool = True):
     messages_dump_path = cfg.messages_dump_path
     msgs = telega_dump_parse_essential(dump_path=messages_dump_path)
-    subset = [msg.model_dump() for msg in msgs]
+    subset = (msg.model_dump() for msg in msgs)
     # subset = (x for x in subset if x['msg_date']> datetime(2024,1, 1))
     # encoding = tiktoken.encoding_for_model(cfg.llm_model)
-    index_docs(docs=subset, index_name=cfg.index_name_messages, recreate_index=True)
+    return index_docs(docs=subset, index_name=cfg.index_name_messages, recreate_index=not incremental, bulk=True, incremental=incremental)
 
 
-def load_from_json_to_es(json_file_path: str, es_index_name: str):
+def load_from_json_to_es(json_file_path: str, es_index_name: str, incremental: bool = True):
     with open(json_file_path, 'r') as f:
         docs = json.load(f)
-    index_docs(docs, index_name=es_index_name, recreate_index=True)
+    return index_docs(docs, index_name=es_index_name, recreate_index=not incremental, bulk=True, incremental=incremental)
 
 
 def hybrid_search(search_term: str, knn_search_field: str, text_search_field: str, index_name: str, output_fields: List[str] = None,
                   size: int = 10, chat_id: int = None):
-    chat_id = chat_id or cfg.telegram_group_id
-    model = get_st_model()
-    vector = model.encode(search_term)
+    with stage('embed'):
+        vector = embedding_service.encode_query(search_term)
+    search_query = _hybrid_search_body(search_term, vector, knn_search_field, text_search_field, index_name, output_fields, size)
+    with stage('search'):
+        es_results = es_client.search(
+            index=index_name,
+            body=search_query
+        )
+    return _hits_to_docs(es_results)
 
+
+def hybrid_search_many(search_terms: List[str], knn_search_field: str, text_search_field: str, index_name: str,
+                       output_fields: List[str] = None, size: int = 10) -> List[List[Dict]]:
+    """hybrid_search of every search term by one batched encoding and _msearch requests, results are in order of search_terms"""
+    with stage('embed'):
+        vectors = embedding_service.encode_queries(search_terms)
+    bodies = [_hybrid_search_body(t, v, knn_search_field, text_search_field, index_name, output_fields, size)
+              for t, v in zip(search_terms, vectors)]
+    return [_hits_to_docs(x) for x in msearch(index_name, bodies)]
+
+
+def _hybrid_search_body(search_term: str, vector, knn_search_field: str, text_search_field: str, index_name: str,
+                        output_fields: List[str], size: int) -> Dict:
     knn_query = {
         "field": knn_search_field,
         "query_vector": vector,
         "k": size,
-        "num_candidates": 10000,
-        "boost": 0.5
+        "num_candidates": cfg.es_knn_num_candidates,
+        "boost": 0.5,
+        **_knn_rescore_options()
     }
 
     keyword_query = {
@@ -88,84 +267,205 @@ def hybrid_search(search_term: str, knn_search_field: str, text_search_field: st
         }
     }
 
-    if not output_fields:
-        ind_flds = cfg.read_index_settings(index_name)['mappings']['properties']
-        output_fields = [f for f in ind_flds
-                         if ind_flds[f]['type'] != 'dense_vector']
-    search_query = {
+    return {
         "knn": knn_query,
         "query": keyword_query,
         "size": size,
-        "_source": output_fields
+        "_source": output_fields or source_fields(index_name)
     }
 
-    es_results = es_client.search(
-        index=index_name,
-        body=search_query
-    )
-    
-    result_docs = [{'doc': hit['_source'], 'score': hit['_score']} for hit in es_results['hits']['hits']]
 
-    return result_docs
+def fused_hybrid_search(search_term: str, text_search_field: str = 'msg_text', text_index_name: str = cfg.index_name_messages,
+                        knn_search_field: str = 'msg_text_vector', knn_index_name: str = cfg.index_name_messages_eng,
+                        size: int = 10, chat_id: int = None, key_field: str = 'msg_id', text_search_term: str = None,
+                        candidates: int = cfg.hybrid_candidates, rrf_k: int = cfg.hybrid_rrf_k,
+                        text_timeout: float = cfg.hybrid_text_timeout, knn_timeout: float = cfg.hybrid_knn_timeout) -> List[Dict]:
+    """_summary_
+    Hybrid search by BM25 and kNN requests sent concurrently, possibly to different indices, fused by reciprocal rank.
+    A leg that fails or does not answer within its timeout is left out, so results of the other leg are returned.
+    Args:
+        search_term (str): question
+        text_search_field (str, optional): field for BM25 match. Defaults to 'msg_text'.
+        text_index_name (str, optional): index of BM25 leg. Defaults to cfg.index_name_messages.
+        knn_search_field (str, optional): dense vector field. Defaults to 'msg_text_vector'.
+        knn_index_name (str, optional): index of kNN leg. Defaults to cfg.index_name_messages_eng.
+        size (int, optional): number of fused results. Defaults to 10.
+        chat_id (int, optional): Defaults to cfg.telegram_group_id.
+        key_field (str, optional): field identifying the same doc in both indices. Defaults to 'msg_id'.
+        text_search_term (str, optional): terms for BM25 leg, e.g. tags in Russian. Defaults to search_term.
+        candidates (int, optional): docs taken from each leg. Defaults to cfg.hybrid_candidates.
+        rrf_k (int, optional): rank constant of the fusion. Defaults to cfg.hybrid_rrf_k.
+        text_timeout (float, optional): seconds to wait for BM25 leg. Defaults to cfg.hybrid_text_timeout.
+        knn_timeout (float, optional): seconds to wait for kNN leg. Defaults to cfg.hybrid_knn_timeout.
+
+    Returns:
+        List[Dict]: {'doc', 'score' - sum of 1 / (rrf_k + rank) over legs, 'ranks' - rank of the doc in each leg}
+    """
+    chat_id = chat_id or cfg.telegram_group_id
+    started = time.perf_counter()
+    legs = {
+        'text': (search_pool.submit(simple_search, search_term=text_search_term or search_term, search_field=text_search_field,
+                                    index_name=text_index_name, min_score=0, size=candidates), text_timeout),
+        'knn': (search_pool.submit(knn_vector_search, search_term=search_term, search_field=knn_search_field,
+                                   index_name=knn_index_name, number_of_docs=candidates, chat_id=chat_id), knn_timeout),
+    }
+    leg_docs = dict()
+    for leg, (future, timeout) in legs.items():
+        try:
+            with stage('search'):  # legs run in pool threads, so their own embed and search stages are not seen here
+                ret = future.result(timeout=max(started + timeout - time.perf_counter(), 0))
+        except FutureTimeoutError:
+            future.cancel()
+            logging.warning(f'{leg} leg of hybrid search did not answer in {timeout} sec, it is left out')
+            continue
+        except Exception as e:
+            logging.warning(f'{leg} leg of hybrid search failed, it is left out: {e!r}')
+            continue
+        if leg == 'text':  # simple_search returns (score, doc) pairs and does not filter by chat
+            ret = [{'doc': doc, 'score': score} for score, doc in ret if doc.get('chat_id', chat_id) == chat_id]
+        leg_docs[leg] = [x['doc'] for x in ret]
+    if not leg_docs:
+        raise Exception(f'both legs of hybrid search failed for "{search_term}"')
+    return reciprocal_rank_fusion(leg_docs, key_field, size, rrf_k)
+
+
+def reciprocal_rank_fusion(leg_docs: Dict[str, List[Dict]], key_field: str = 'msg_id', size: int = 10,
+                           rrf_k: int = cfg.hybrid_rrf_k) -> List[Dict]:
+    """fuses ranked doc lists by sum of 1 / (rrf_k + rank), doc is taken from the first leg that found it"""
+    fused = dict()
+    for leg, docs in leg_docs.items():
+        for rank, doc in enumerate(docs, 1):
+            key = doc.get(key_field)
+            if key is None:
+                continue
+            item = fused.setdefault(key, {'doc': doc, 'score': 0.0, 'ranks': dict()})
+            if leg in item['ranks']:  # the same doc twice in one leg, e.g. split to chunks
+                continue
+            item['ranks'][leg] = rank
+            item['score'] += 1 / (rrf_k + rank)
+    return sorted(fused.values(), key=lambda x: (-x['score'], min(x['ranks'].values())))[:size]
 
 
 def simple_search(search_term: str, search_field: str, index_name: str, output_fields: List[str] = None, min_score: float = 2, size: int = 20):
-    if not output_fields:
-        ind_flds = cfg.read_index_settings(index_name)['mappings']['properties']
-        output_fields = [f for f in ind_flds if ind_flds[f]['type'] != 'dense_vector']
-    search_query = {
-                    "query": {
-                        "match": {
-                            search_field: search_term
-                        }
-                    },
-                    "_source": output_fields,
-                    "size": size,  # Adjust the number of documents to retrieve
-                    
-                }
+    search_query = _simple_search_body(search_term, search_field, index_name, output_fields, size)
+    with stage('search'):
+        es_results = es_client.search(index=index_name, body=search_query)
+    return _scored_sources(es_results, min_score)
 
-    es_results = es_client.search(index=index_name, body=search_query)
-    
+
+def simple_search_many(search_terms: List[str], search_field: str, index_name: str, output_fields: List[str] = None,
+                       min_score: float = 2, size: int = 20) -> List[List]:
+    """simple_search of every search term by _msearch requests, results are in order of search_terms"""
+    bodies = [_simple_search_body(t, search_field, index_name, output_fields, size) for t in search_terms]
+    return [_scored_sources(x, min_score) for x in msearch(index_name, bodies)]
+
+
+def _simple_search_body(search_term: str, search_field: str, index_name: str, output_fields: List[str], size: int) -> Dict:
+    return {
+                "query": {
+                    "match": {
+                        search_field: search_term
+                    }
+                },
+                "_source": output_fields or source_fields(index_name),
+                "size": size,  # Adjust the number of documents to retrieve
+            }
+
+
+def _scored_sources(es_results: Dict, min_score: float) -> List:
     result_docs = []
-    
     for hit in es_results['hits']['hits']:
         score = hit['_score']
         if score and score >= min_score:
             result_docs.append((score, hit['_source']))
-
     return result_docs
 
 
 def knn_vector_search(search_term: str, search_field: str, index_name: str, output_fields: List[str] = None,
-                      min_score: float = None, number_of_docs: int = 5):
-    model = get_st_model()
-    vector = model.encode(search_term)
+                      min_score: float = None, number_of_docs: int = 5, chat_id: int = None):
+    chat_id = chat_id or cfg.telegram_group_id
+    with stage('embed'):
+        vector = embedding_service.encode_query(search_term)
+    if cfg.vector_search_backend == 'local':
+        with stage('search'):
+            return get_local_vector_index(index_name).search(vector, search_field, number_of_docs, chat_id, min_score, output_fields)
+    search_query = _knn_search_body(vector, search_field, index_name, output_fields, number_of_docs, chat_id)
+    with stage('search'):
+        es_results = es_client.search(index=index_name, body=search_query)
+    return _hits_to_docs(es_results, min_score)
+
+
+def knn_vector_search_many(search_terms: List[str], search_field: str, index_name: str, output_fields: List[str] = None,
+                           min_score: float = None, number_of_docs: int = 5, chat_id: int = None) -> List[List[Dict]]:
+    """knn_vector_search of every search term by one batched encoding and _msearch requests, results are in order of search_terms"""
+    chat_id = chat_id or cfg.telegram_group_id
+    with stage('embed'):
+        vectors = embedding_service.encode_queries(search_terms)
+    if cfg.vector_search_backend == 'local':
+        local_index = get_local_vector_index(index_name)
+        with stage('search'):
+            return [local_index.search(v, search_field, number_of_docs, chat_id, min_score, output_fields) for v in vectors]
+    bodies = [_knn_search_body(v, search_field, index_name, output_fields, number_of_docs, chat_id) for v in vectors]
+    return [_hits_to_docs(x, min_score) for x in msearch(index_name, bodies)]
+
+
+def _knn_search_body(vector, search_field: str, index_name: str, output_fields: List[str], number_of_docs: int, chat_id: int) -> Dict:
     knn = {
         "field": search_field,
         "query_vector": vector,
         "k": number_of_docs,
-        "num_candidates": 10000,
+        "num_candidates": cfg.es_knn_num_candidates,
         "filter": {
             "term": {
-                "chat_id": cfg.telegram_group_id
+                "chat_id": chat_id
             }
-        }
+        },
+        **_knn_rescore_options()
     }
-   
-    if not output_fields:
-        ind_flds = cfg.read_index_settings(index_name)['mappings']['properties']
-        output_fields = [f for f in ind_flds
-                         if ind_flds[f]['type'] != 'dense_vector']
-    search_query = {
+    return {
         "knn": knn,
-        "_source": output_fields
+        "_source": output_fields or source_fields(index_name)
     }
 
-    es_results = es_client.search(index=index_name, body=search_query)
-    result_docs = [{'doc': hit['_source'], 'score': hit['_score']}
-                   for hit in es_results['hits']['hits']
-                   if not min_score or hit['_score'] > min_score]
-    return result_docs
+
+def _hits_to_docs(es_results: Dict, min_score: float = None) -> List[Dict]:
+    return [{'doc': hit['_source'], 'score': hit['_score']}
+            for hit in es_results['hits']['hits']
+            if not min_score or hit['_score'] > min_score]
+
+
+def msearch(index_name: str, bodies: List[Dict], batch_size: int = cfg.es_msearch_batch_size) -> List[Dict]:
+    """responses of _msearch in order of search bodies, batch_size searches per request"""
+    responses = []
+    for batch in batched(bodies, batch_size):
+        searches = []
+        for body in batch:
+            searches.extend([{'index': index_name}, body])
+        with stage('search'):
+            responses.extend(es_client.msearch(searches=searches)['responses'])
+    errors = [x['error'] for x in responses if 'error' in x]
+    if errors:
+        raise Exception(f'{len(errors)} of {len(responses)} searches in {index_name} failed, first error: {errors[0]}')
+    return responses
+
+
+@lru_cache(maxsize=None)
+def _index_source_fields(index_name: str) -> Tuple[str, ...]:
+    ind_flds = cfg.read_index_settings(index_name)['mappings']['properties']
+    return tuple(f for f in ind_flds if ind_flds[f]['type'] != 'dense_vector')
+
+
+def source_fields(index_name: str) -> List[str]:
+    """non vector fields of the index, index_settings.yml is read once per process"""
+    return list(_index_source_fields(index_name))
+
+
+def _knn_rescore_options(vector_index_type: str = None) -> Dict:
+    """exact similarity rescoring of oversampled candidates, for quantized vectors only"""
+    vector_index_type = vector_index_type or cfg.es_vector_index_type
+    if vector_index_type in ('hnsw', 'flat') or not cfg.es_knn_rescore_oversample:
+        return {}
+    return {"rescore_vector": {"oversample": cfg.es_knn_rescore_oversample}}
 
 
 def get_messages_by_id(chat_id: int, msg_ids: List[int]) -> List[TelegaMessage]:
@@ -190,7 +490,79 @@ def get_messages_by_id(chat_id: int, msg_ids: List[int]) -> List[TelegaMessage]:
             "size": size  # Specify the number of results to return
         }
 
-    es_results = es_client.search(index=cfg.index_name_messages, body=query)
+    with stage('context'):
+        es_results = es_client.search(index=cfg.index_name_messages, body=query)
 
     tms = [TelegaMessage.model_validate(x['_source']) for x in es_results['hits']['hits'] ]
     return tms
+
+
+def scan_messages(index_name: str = cfg.index_name_messages, chat_id: int = None, slices: int = cfg.es_scan_slices,
+                  page_size: int = cfg.es_scan_page_size, keep_alive: str = '2m') -> Iterable[TelegaMessage]:
+    """_summary_
+    To stream all the messages of the chat from ES index, reading it by several parallel slices
+    of point in time (PIT) with search_after pagination
+    Args:
+        index_name (str, optional): ES index with messages. Defaults to cfg.index_name_messages.
+        chat_id (int, optional): Defaults to cfg.telegram_group_id.
+        slices (int, optional): number of slices, read in parallel threads. Defaults to cfg.es_scan_slices.
+        page_size (int, optional): number of hits per search request. Defaults to cfg.es_scan_page_size.
+        keep_alive (str, optional): keep alive for PIT between two requests of one slice.
+
+    Returns:
+        Iterable[TelegaMessage]: messages in arbitrary order
+    """
+    chat_id = chat_id or cfg.telegram_group_id
+    pit_id = es_client.open_point_in_time(index=index_name, keep_alive=keep_alive)['id']
+    latest_pit_id = [pit_id]  # search may return a new id of the same PIT, the latest one is to be used and closed
+    hits_queue = Queue(maxsize=slices * 4)  # to not read whole index to memory if consumer is slow
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                hits_queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def scan_slice(slice_id: int):
+        try:
+            search_after, slice_pit_id = None, pit_id
+            while not stop.is_set():
+                body = {'pit': {'id': slice_pit_id, 'keep_alive': keep_alive},
+                        'query': {'term': {'chat_id': chat_id}},
+                        '_source': scan_message_fields,
+                        'size': page_size,
+                        'sort': [{'_shard_doc': 'asc'}]}
+                if slices > 1:
+                    body['slice'] = {'id': slice_id, 'max': slices}
+                if search_after:
+                    body['search_after'] = search_after
+                resp = es_client.search(body=body)
+                slice_pit_id = latest_pit_id[0] = resp.get('pit_id', slice_pit_id)
+                hits = resp['hits']['hits']
+                if not hits:
+                    break
+                put(hits)
+                search_after = hits[-1]['sort']
+        finally:
+            put(None)  # end of slice
+
+    executor = ThreadPoolExecutor(max_workers=slices)
+    try:
+        futures = [executor.submit(scan_slice, slice_id) for slice_id in range(slices)]
+        finished_slices = 0
+        while finished_slices < slices:
+            hits = hits_queue.get()
+            if hits is None:
+                finished_slices += 1
+                continue
+            for hit in hits:
+                yield TelegaMessage.model_validate(hit['_source'])
+        for future in futures:
+            future.result()  # to raise exception from the slice, if any
+    finally:
+        stop.set()  # releases slices blocked on full queue, if consumer stopped reading earlier
+        executor.shutdown(wait=True)
+        es_client.close_point_in_time(id=latest_pit_id[0])
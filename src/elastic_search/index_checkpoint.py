@@ -0,0 +1,59 @@
+"""Checkpoint of documents already pushed to ES index, used for incremental reindexing"""
+
+from typing import Dict, Iterable
+import hashlib
+import json
+import os
+
+import src.config as cfg
+from src.data_classes import date_to_json_serialize
+
+
+def doc_content_hash(doc: Dict, skip_fields: Iterable[str] = ()) -> str:
+    content = {k: v for k, v in doc.items() if k not in skip_fields}
+    json_str = json.dumps(content, default=date_to_json_serialize, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(json_str.encode('utf-8')).hexdigest()
+
+
+def checkpoint_path(index_name: str, checkpoint_dir: str = cfg.index_checkpoint_dir) -> str:
+    return os.path.join(checkpoint_dir, f'{index_name}.json')
+
+
+class IndexCheckpoint:
+    """Keeps content hash per doc id for one ES index
+
+    Args:
+        index_name (str): name of ES index
+        checkpoint_dir (str, optional): folder for checkpoint files. Defaults to cfg.index_checkpoint_dir.
+    """
+
+    def __init__(self, index_name: str, checkpoint_dir: str = cfg.index_checkpoint_dir):
+        self.path = checkpoint_path(index_name, checkpoint_dir)
+        self.doc_hashes: Dict[str, str] = dict()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.doc_hashes = data['doc_hashes']
+
+    def is_changed(self, doc_id: str, content_hash: str) -> bool:
+        return self.doc_hashes.get(doc_id) != content_hash
+
+    def update(self, doc_id: str, content_hash: str):
+        self.doc_hashes[doc_id] = content_hash
+
+    def reset(self):
+        self.doc_hashes.clear()
+
+    @staticmethod
+    def delete(index_name: str, checkpoint_dir: str = cfg.index_checkpoint_dir):
+        """drops checkpoint of the index, when the index is recreated by not incremental load"""
+        path = checkpoint_path(index_name, checkpoint_dir)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'doc_hashes': self.doc_hashes}, f)
+        os.replace(tmp_path, self.path)  # to not leave broken checkpoint if process is killed while writing
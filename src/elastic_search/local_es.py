@@ -0,0 +1,211 @@
+"""In-process stand-in of Elasticsearch client, to run searches of es.py without a cluster, e.g. in benchmarks"""
+
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Set
+import json
+import logging
+import math
+import os
+import re
+
+import numpy as np
+
+import src.config as cfg
+from src.embeddings import EmbeddingService, embedding_service, encode_vector_fields
+
+bm25_k1, bm25_b = 1.2, 0.75  # ES defaults
+_word_re = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return _word_re.findall(text.lower()) if text else []
+
+
+class _LocalIndex:
+    def __init__(self, index_name: str):
+        self.properties = cfg.read_index_settings(index_name)['mappings']['properties']
+        self.vector_flds = [f for f in self.properties if self.properties[f]['type'] == 'dense_vector']
+        self.docs: List[Dict] = []
+        self._vectors: Dict[str, np.ndarray] = dict()
+        self._texts: Dict[str, tuple] = dict()  # field -> (postings of term: [(row, term frequency)], doc lengths, avg length)
+
+    def add(self, docs: List[Dict]):
+        self.docs.extend(docs)
+        self._vectors.clear()
+        self._texts.clear()
+
+    def vectors(self, field: str) -> np.ndarray:
+        """unit length vectors of docs, NaN rows for docs without vector"""
+        matrix = self._vectors.get(field)
+        if matrix is None:
+            dims = self.properties[field]['dims']
+            matrix = np.full((len(self.docs), dims), np.nan, dtype=np.float32)
+            for i, d in enumerate(self.docs):
+                if d.get(field) is not None:
+                    v = np.asarray(d[field], dtype=np.float32)
+                    matrix[i] = v / (np.linalg.norm(v) or 1)
+            matrix = self._vectors[field] = matrix
+        return matrix
+
+    def bm25(self, field: str, text: str) -> Dict[int, float]:
+        if field not in self._texts:
+            postings, lengths = defaultdict(list), []
+            for row, d in enumerate(self.docs):
+                words = tokenize(_as_text(d.get(field)))
+                lengths.append(len(words))
+                for term, tf in Counter(words).items():
+                    postings[term].append((row, tf))
+            self._texts[field] = (postings, lengths, sum(lengths) / len(lengths) if lengths else 0)
+        postings, lengths, avg_length = self._texts[field]
+        scores = dict()
+        for term in set(tokenize(text)):
+            term_postings = postings.get(term, [])
+            idf = math.log(1 + (len(self.docs) - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for row, tf in term_postings:
+                norm = bm25_k1 * (1 - bm25_b + bm25_b * lengths[row] / (avg_length or 1))
+                scores[row] = scores.get(row, 0.0) + idf * tf * (bm25_k1 + 1) / (tf + norm)
+        return scores
+
+    def matching_rows(self, field: str, values: Iterable) -> Set[int]:
+        values = {str(v) for v in values}
+        rows = set()
+        for row, d in enumerate(self.docs):
+            doc_values = d.get(field)
+            doc_values = doc_values if isinstance(doc_values, list) else [doc_values]
+            if any(str(v) in values for v in doc_values):
+                rows.add(row)
+        return rows
+
+
+def _as_text(value) -> str:
+    return ' '.join(str(x) for x in value) if isinstance(value, list) else (str(value) if value is not None else '')
+
+
+class LocalElasticsearch:
+    """_summary_
+    Answers search and msearch requests, built by es.py, over docs kept in memory: match, multi_match, term, terms,
+    bool (must, filter), knn (with filter), and their sum for hybrid requests. kNN is exact, with the ES cosine score.
+    Text is split to lowercased words without stemming of ES analyzers, so BM25 scores are close to ES but not equal.
+    Args:
+        encoder (EmbeddingService, optional): for vector fields missing in added docs. Defaults to embedding_service.
+    """
+
+    def __init__(self, encoder: EmbeddingService = None):
+        self.encoder = encoder or embedding_service
+        self.indices: Dict[str, _LocalIndex] = dict()
+
+    @classmethod
+    def from_files(cls, index_files: Dict[str, str], encoder: EmbeddingService = None) -> 'LocalElasticsearch':
+        """stand-in with indices loaded from json files with lists of docs, the same files es.load_from_json_to_es loads"""
+        local_es = cls(encoder)
+        for index_name, file_path in index_files.items():
+            with open(file_path, 'r') as f:
+                local_es.add_docs(index_name, json.load(f))
+        return local_es
+
+    def add_docs(self, index_name: str, docs: Iterable[Dict], encode_batch_size: int = cfg.embedding_batch_size):
+        if index_name not in self.indices:
+            self.indices[index_name] = _LocalIndex(index_name)
+        index = self.indices[index_name]
+        docs = [self._coerce(index, dict(d)) for d in docs]
+        for start in range(0, len(docs), encode_batch_size):
+            batch = docs[start:start + encode_batch_size]
+            encode_vector_fields([d for d in batch if any(f not in d for f in index.vector_flds)], index.vector_flds,
+                                 encode_batch_size, encoder=self.encoder)
+        index.add(docs)
+        logging.info(f'{len(docs)} docs are added to local stand-in of {index_name} index')
+
+    @staticmethod
+    def _coerce(index: _LocalIndex, d: Dict) -> Dict:
+        d['chat_id'] = d.get('chat_id') or cfg.telegram_group_id  # as es._prepare_doc does
+        for f in index.properties:
+            if f not in index.vector_flds:
+                d.setdefault(f, None)  # translated messages have no reply_to_msg_id, which TelegaMessage requires
+        for f, value in d.items():
+            if index.properties.get(f, {}).get('type') == 'integer' and isinstance(value, str) and value.startswith('['):
+                d[f] = json.loads(value)  # lists saved as strings by pandas
+        return d
+
+    def search(self, index: str = None, body: Dict = None, **kwargs) -> Dict:
+        local_index = self.indices.get(index)
+        if local_index is None:
+            raise Exception(f'index {index} is not loaded to local Elasticsearch stand-in')
+        body = body or dict()
+        scores = dict()
+        if 'query' in body:
+            for row, score in self._query_scores(local_index, body['query']).items():
+                scores[row] = scores.get(row, 0.0) + score
+        if 'knn' in body:
+            for row, score in self._knn_scores(local_index, body['knn']).items():
+                scores[row] = scores.get(row, 0.0) + score
+        rows = sorted(scores, key=lambda row: (-scores[row], row))[:body.get('size', 10)]
+        source_flds = body.get('_source')
+        hits = []
+        for row in rows:
+            d = local_index.docs[row]
+            source = {k: v for k, v in d.items() if k not in local_index.vector_flds and (not source_flds or k in source_flds)}
+            hits.append({'_index': index, '_source': source, '_score': scores[row]})
+        return {'hits': {'total': {'value': len(scores)}, 'hits': hits}}
+
+    def msearch(self, searches: List[Dict] = None, **kwargs) -> Dict:
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                responses.append(self.search(index=header.get('index'), body=body))
+            except Exception as e:
+                responses.append({'error': {'reason': str(e)}})
+        return {'responses': responses}
+
+    def _query_scores(self, index: _LocalIndex, query: Dict) -> Dict[int, float]:
+        kind, params = next(iter(query.items()))
+        if kind == 'match_all':
+            return {row: 1.0 for row in range(len(index.docs))}
+        if kind == 'match':
+            field, value = next(iter(params.items()))
+            if isinstance(value, dict):
+                return {k: v * value.get('boost', 1) for k, v in index.bm25(field, value['query']).items()}
+            return index.bm25(field, value)
+        if kind == 'multi_match':  # best_fields
+            scores = dict()
+            for field in params['fields']:
+                for row, score in index.bm25(field, params['query']).items():
+                    scores[row] = max(scores.get(row, 0.0), score * params.get('boost', 1))
+            return scores
+        if kind in ('term', 'terms'):
+            field, value = next(iter(params.items()))
+            return {row: 1.0 for row in index.matching_rows(field, value if kind == 'terms' else [value])}
+        if kind == 'bool':
+            scores = None
+            for clause_kind in ('must', 'filter'):
+                clauses = params.get(clause_kind, [])
+                for clause in clauses if isinstance(clauses, list) else [clauses]:
+                    clause_scores = self._query_scores(index, clause)
+                    if clause_kind == 'filter':
+                        clause_scores = {row: 0.0 for row in clause_scores}
+                    if scores is None:
+                        scores = clause_scores
+                    else:
+                        scores = {row: scores[row] + clause_scores[row] for row in scores if row in clause_scores}
+            return scores or dict()
+        raise Exception(f'query {kind} is not supported by local Elasticsearch stand-in')
+
+    def _knn_scores(self, index: _LocalIndex, knn: Dict) -> Dict[int, float]:
+        matrix = index.vectors(knn['field'])
+        if not len(matrix):
+            return dict()
+        query = np.asarray(knn['query_vector'], dtype=np.float32)
+        sims = matrix @ (query / (np.linalg.norm(query) or 1))
+        sims[np.isnan(sims)] = -np.inf
+        if 'filter' in knn:
+            allowed = np.zeros(len(sims), dtype=bool)
+            allowed[list(self._query_scores(index, knn['filter']))] = True
+            sims[~allowed] = -np.inf
+        rows = [row for row in np.argsort(-sims, kind='stable')[:knn['k']] if np.isfinite(sims[row])]
+        return {int(row): float((1 + sims[row]) / 2) * knn.get('boost', 1) for row in rows}
+
+
+def default_index_files() -> Dict[str, str]:
+    """json files with docs of indices in output folder, telegram-messages gets translated messages, as the dump is not a docs list"""
+    index_files = {cfg.index_name_messages_eng: 'output/llm_output/merged_messages.json', cfg.index_name_topics: cfg.topics_path}
+    index_files[cfg.index_name_messages] = index_files[cfg.index_name_messages_eng]
+    return {k: v for k, v in index_files.items() if os.path.exists(v)}
@@ -0,0 +1,131 @@
+"""Process-wide access to SentenceTransformer models and query embeddings."""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Tuple
+import logging
+import threading
+
+import numpy as np
+
+import src.config as cfg
+
+
+def normalize_query(text: str) -> str:
+    # the model is cased, so we only collapse whitespace and do not lowercase
+    return ' '.join(text.split())
+
+
+class EmbeddingService:
+    """Loads every model once per process and keeps LRU cache of query vectors
+
+    Args:
+        max_cache_size (int, optional): max number of cached query vectors. Defaults to cfg.query_embedding_cache_size.
+        model_loader (Callable, optional): factory, that creates model by its name. Defaults to SentenceTransformer.
+    """
+
+    def __init__(self, max_cache_size: int = cfg.query_embedding_cache_size, model_loader: Callable = None):
+        self.max_cache_size = max_cache_size
+        self._model_loader = model_loader
+        self._models = dict()  # Dict[str, SentenceTransformer]
+        self._cache: OrderedDict[Tuple[str, str], np.ndarray] = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_model(self, model_name: str = cfg.sent_tranformer_model_name):
+        model = self._models.get(model_name)
+        if model is None:
+            with self._lock:
+                model = self._models.get(model_name)
+                if model is None:
+                    logging.info(f'loading sentence transformer model {model_name}')
+                    model = self._load_model(model_name)
+                    self._models[model_name] = model
+        return model
+
+    def _load_model(self, model_name: str):
+        if self._model_loader:
+            return self._model_loader(model_name)
+        from sentence_transformers import SentenceTransformer  # heavy import, so postpone it until model is really needed
+        return SentenceTransformer(model_name)
+
+    def warm_up(self, model_names: Iterable[str] = (cfg.sent_tranformer_model_name,)):
+        for model_name in model_names:
+            self.get_model(model_name).encode('warm up')
+
+    def encode_query(self, text: str, model_name: str = cfg.sent_tranformer_model_name) -> np.ndarray:
+        key = (model_name, normalize_query(text))
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return vector
+            self.misses += 1
+        vector = np.asarray(self.get_model(model_name).encode(key[1]))
+        vector.setflags(write=False)  # same array is handed out to every caller
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+        return vector
+
+    def encode_queries(self, texts: List[str], model_name: str = cfg.sent_tranformer_model_name,
+                       batch_size: int = cfg.embedding_batch_size) -> List[np.ndarray]:
+        """Vectors of queries in order of texts, the ones missing in cache are encoded in one batched call"""
+        keys = [(model_name, normalize_query(t)) for t in texts]
+        vectors, missing = dict(), dict()  # missing is ordered set of keys
+        with self._lock:
+            for key in keys:
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    vectors[key] = vector
+                elif key not in missing:
+                    self.misses += 1
+                    missing[key] = None
+        if missing:
+            new_vectors = np.asarray(self.get_model(model_name).encode([k[1] for k in missing], batch_size=batch_size))
+            with self._lock:
+                for key, vector in zip(missing, new_vectors):
+                    vector.setflags(write=False)
+                    vectors[key] = self._cache[key] = vector
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.max_cache_size:
+                    self._cache.popitem(last=False)
+        return [vectors[key] for key in keys]
+
+    def encode(self, texts: List[str], model_name: str = cfg.sent_tranformer_model_name,
+               batch_size: int = cfg.embedding_batch_size) -> np.ndarray:
+        """Encodes documents in batches, bypassing query cache"""
+        return np.asarray(self.get_model(model_name).encode(texts, batch_size=batch_size))
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._cache), 'models': len(self._models)}
+
+
+embedding_service = EmbeddingService()
+
+
+def field_to_encode(vector_field: str) -> str:
+    return vector_field[0: len(vector_field) - len('_vector')]  # lets rely on this convention
+
+
+def encode_vector_fields(batch: List[Dict], vector_flds: List[str], encode_batch_size: int = cfg.embedding_batch_size,
+                         encoder: EmbeddingService = None):
+    """sets "<field>_vector" fields of the docs to embeddings of "<field>" text, for docs having it"""
+    encoder = encoder or embedding_service
+    for ftv in vector_flds:
+        fld_to_encode = field_to_encode(ftv)
+        to_encode = [d for d in batch if d.get(fld_to_encode) is not None]
+        if to_encode:
+            vectors = encoder.encode([d[fld_to_encode] for d in to_encode], batch_size=encode_batch_size)
+            for d, v in zip(to_encode, vectors):
+                d[ftv] = v.tolist()
@@ -1,31 +1,350 @@
 from dotenv import load_dotenv
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import contextvars
 import logging
 import json
+import random
+import re
+import threading
+import time
 
-from openai import OpenAI
+from openai import APIStatusError, AsyncOpenAI, OpenAI
+from openai.types import CompletionUsage
 import src.config as cfg
-from src.data_classes import TelegaMessage, convert_to_json_list
+from src.chunking import get_token_counter
+from src.completion_cache import CompletionCache, completion_key
+from src.data_classes import TelegaMessage
+from src.llm_accounting import estimate_cost, llm_accounting
+from src.prompt_context import encode_messages, pack_messages
 
 load_dotenv()
 
 client = OpenAI()
 TOTAL_SPEND = 0 # spend USD for input output tokens
+CACHE_HITS, CACHE_MISSES, CACHE_SAVED_SPEND = 0, 0, 0  # completion cache counters, USD not spent thanks to cache
+completion_cache: Optional[CompletionCache] = None  # opened on first use, see get_completion_cache
+
+
+def ask_llm(prompt, model=cfg.llm_model, use_cache: bool = True):
+    check_prompt(prompt)
+    key = completion_key(model, prompt)
+    cached = lookup_completion(key, model) if use_cache else None
+    if cached is not None:
+        return cached
+    estimated_cost = estimate_cost(get_token_counter(model)(prompt))
+    llm_accounting.reserve(estimated_cost)
+    started = time.perf_counter()
+    try:
+        response = client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}]
+        )
+    except Exception:
+        llm_accounting.release(estimated_cost)
+        raise
+    amount_spend = account_usage(response.usage, model, time.perf_counter() - started, estimated_cost)
+    content = response.choices[0].message.content
+    if use_cache:
+        store_completion(key, model, content, amount_spend)
+    return content
+
+
+def ask_llm_stream(prompt, model=cfg.llm_model, use_cache: bool = True) -> Iterator[str]:
+    """_summary_
+    ask_llm yielding pieces of the answer as the model generates them, a cached answer is yielded at once.
+    Usage is accounted and the answer is cached when the stream is read to the end.
+    Args:
+        prompt (str): prompt
+        model (str, optional): Defaults to cfg.llm_model.
+        use_cache (bool, optional): Defaults to True.
+
+    Yields:
+        str: pieces of the answer
+    """
+    check_prompt(prompt)
+    key = completion_key(model, prompt)
+    cached = lookup_completion(key, model) if use_cache else None
+    if cached is not None:
+        yield cached
+        return
+    estimated_cost = estimate_cost(get_token_counter(model)(prompt))
+    llm_accounting.reserve(estimated_cost)
+    started = time.perf_counter()
+    pieces, usage = [], None
+    try:
+        with client.chat.completions.create(model=model, messages=[{"role": "user", "content": prompt}],
+                                            stream=True, stream_options={"include_usage": True}) as stream:
+            for chunk in stream:
+                if chunk.usage is not None:  # the last chunk, without choices
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield pieces[-1]
+    except BaseException:  # GeneratorExit too, when the reader stops early
+        llm_accounting.release(estimated_cost)
+        raise
+    content = ''.join(pieces)
+    if usage is None:
+        count_tokens = get_token_counter(model)
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(content)
+        usage = CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+    amount_spend = account_usage(usage, model, time.perf_counter() - started, estimated_cost)
+    if use_cache:
+        store_completion(key, model, content, amount_spend)
+
+
+class JsonFieldStream:
+    """_summary_
+    Decodes text of a string field of json object while the json is being generated,
+    to show "answer" of the LLM result before the whole result can be parsed
+    Args:
+        field (str, optional): Defaults to 'answer'.
+    """
 
-
-def ask_llm(prompt, model=cfg.llm_model):
-    global TOTAL_SPEND
+    def __init__(self, field: str = 'answer'):
+        self._field_re = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._raw = ''
+        self._start = None  # position of the field value in raw json
+        self._decoded_len = 0
+        self.done = False
+
+    def feed(self, piece: str) -> str:
+        """text of the field added by the piece of json"""
+        if self.done:
+            return ''
+        self._raw += piece
+        if self._start is None:
+            found = self._field_re.search(self._raw)
+            if found is None:
+                return ''
+            self._start = found.end()
+        value, i = self._raw[self._start:], 0
+        while i < len(value):
+            if value[i] == '"':
+                self.done = True
+                break
+            if value[i] == '\\':
+                escape_len = 6 if value[i + 1:i + 2] == 'u' else 2
+                if i + escape_len > len(value):
+                    break  # incomplete escape is decoded with the next piece
+                i += escape_len
+            else:
+                i += 1
+        try:
+            text = json.loads(f'"{value[:i]}"', strict=False)  # strict=False lets raw newlines through
+        except json.JSONDecodeError:
+            return ''
+        added, self._decoded_len = text[self._decoded_len:], len(text)
+        return added
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    global completion_cache
+    if completion_cache is None and cfg.llm_cache_mode != 'off':
+        completion_cache = CompletionCache(read_only=cfg.llm_cache_mode == 'read_only')
+    return completion_cache
+
+
+def lookup_completion(key: str, model: str = cfg.llm_model) -> Optional[str]:
+    global CACHE_HITS, CACHE_MISSES, CACHE_SAVED_SPEND
+    cache = get_completion_cache()
+    if cache is None:
+        return None
+    cached = cache.get(key)
+    if cached is None:
+        CACHE_MISSES += 1
+        return None
+    CACHE_HITS += 1
+    CACHE_SAVED_SPEND += cached[1]
+    llm_accounting.record(model, cached=True)
+    logging.info(f'completion taken from cache, saved total: {CACHE_SAVED_SPEND:.5f}, last: {cached[1]:.5f} USD')
+    return cached[0]
+
+
+def store_completion(key: str, model: str, content: str, amount_spend: float):
+    cache = get_completion_cache()
+    if cache is not None:
+        cache.put(key, model, content, amount_spend)
+
+
+def check_prompt(prompt: str):
     if len(prompt) > 100000:
         raise Exception("Prompt is too big")
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}]
-    )
-    logging.info(f'number of prompt_tokens: {response.usage.prompt_tokens}; completion tokens: {response.usage.completion_tokens}')
-    amount_spend = (response.usage.prompt_tokens * cfg.llm_price[0] + response.usage.completion_tokens * cfg.llm_price[1])/1000000
+
+
+def account_usage(usage, model: str = cfg.llm_model, latency: float = 0.0, estimated_cost: float = 0.0) -> float:
+    global TOTAL_SPEND
+    logging.info(f'number of prompt_tokens: {usage.prompt_tokens}; completion tokens: {usage.completion_tokens}')
+    amount_spend = (usage.prompt_tokens * cfg.llm_price[0] + usage.completion_tokens * cfg.llm_price[1])/1000000
     TOTAL_SPEND += amount_spend
+    llm_accounting.record(model, usage.prompt_tokens, usage.completion_tokens, amount_spend, latency, estimated_cost=estimated_cost)
     logging.info(f'amount_spend total:{TOTAL_SPEND:.5f}, last: {amount_spend:.5f} USD')
-    return response.choices[0].message.content
+    return amount_spend
+
+
+class RateLimiter:
+    """Sliding window of one minute for requests and tokens count
+
+    Args:
+        rpm (int): max requests per minute
+        tpm (int): max tokens per minute, request is charged by estimate and corrected by real usage afterwards
+    """
+
+    def __init__(self, rpm: int = cfg.llm_rpm_limit, tpm: int = cfg.llm_tpm_limit, clock=time.monotonic):
+        self.rpm, self.tpm = rpm, tpm
+        self._clock = clock
+        self._window: Deque[List] = deque()  # [timestamp, tokens] per request sent during the last minute
+        self._tokens = 0
+        self._lock = threading.Lock()  # the limiter is shared by clients running in event loops of different threads
+
+    def _expire(self, now: float):
+        while self._window and now - self._window[0][0] >= 60:
+            self._tokens -= self._window.popleft()[1]
+
+    async def acquire(self, tokens: int) -> List:
+        tokens = min(tokens, self.tpm)  # a single huge prompt must not wait forever
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._expire(now)
+                if len(self._window) < self.rpm and self._tokens + tokens <= self.tpm:
+                    entry = [now, tokens]
+                    self._window.append(entry)
+                    self._tokens += tokens
+                    return entry
+                wait = 60 - (now - self._window[0][0])
+            await asyncio.sleep(min(max(wait, 0.01), 1.0))  # recheck, usage may be corrected
+
+    def correct(self, entry: List, tokens: int):
+        with self._lock:
+            if any(x is entry for x in self._window):
+                self._tokens += tokens - entry[1]
+                entry[1] = tokens
+
+
+account_rate_limiter = RateLimiter()  # limits are per account, so clients created one after another share the window
+
+
+class AsyncLLMClient:
+    """_summary_
+    asyncio counterpart of ask_llm for bulk jobs: limits concurrency, requests and tokens per minute,
+    retries 429 and 5xx responses with jittered exponential backoff. Spend is added to TOTAL_SPEND as in ask_llm.
+    Args:
+        model (str, optional): Defaults to cfg.llm_model.
+        max_concurrency (int, optional): max requests in flight. Defaults to cfg.llm_max_concurrency.
+        rate_limiter (RateLimiter, optional): Defaults to account_rate_limiter, shared by all the clients of the process.
+        client (AsyncOpenAI, optional): Defaults to AsyncOpenAI with its own retries turned off.
+        use_cache (bool, optional): to look up and store completions in completion cache, as ask_llm does. Defaults to True.
+    """
+
+    def __init__(self, model: str = cfg.llm_model, max_concurrency: int = cfg.llm_max_concurrency,
+                 rate_limiter: RateLimiter = None, client: AsyncOpenAI = None, max_retries: int = cfg.llm_max_retries,
+                 use_cache: bool = True):
+        self.model = model
+        self.use_cache = use_cache
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter or account_rate_limiter
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = client or AsyncOpenAI(max_retries=0)
+        self.retries_count = 0
+
+    async def ask(self, prompt: str) -> str:
+        content, _ = await self.ask_with_cost(prompt)
+        return content
+
+    async def ask_with_cost(self, prompt: str) -> Tuple[str, float]:
+        check_prompt(prompt)
+        key = completion_key(self.model, prompt)
+        cached = lookup_completion(key, self.model) if self.use_cache else None
+        if cached is not None:
+            return cached, 0.0
+        prompt_tokens = get_token_counter(self.model)(prompt)
+        estimated_cost = estimate_cost(prompt_tokens)
+        soft_budget_exceeded = llm_accounting.reserve(estimated_cost)
+        try:
+            if soft_budget_exceeded:  # slow down to let job be stopped or budget be raised
+                await asyncio.sleep(cfg.llm_soft_budget_delay)
+            response, latency = await self._create_completion(prompt, prompt_tokens)
+        except BaseException:
+            llm_accounting.release(estimated_cost)
+            raise
+        amount_spend = account_usage(response.usage, self.model, latency, estimated_cost)
+        content = response.choices[0].message.content
+        if self.use_cache:
+            store_completion(key, self.model, content, amount_spend)
+        return content, amount_spend
+
+    async def _create_completion(self, prompt: str, prompt_tokens: int):
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                limiter_entry = await self.rate_limiter.acquire(prompt_tokens)
+                started = time.perf_counter()
+                try:
+                    response = await self._client.chat.completions.create(
+                        model=self.model,
+                        messages=[{"role": "user", "content": prompt}]
+                    )
+                except BaseException as e:
+                    self.rate_limiter.correct(limiter_entry, 0)  # failed request spends no tokens, only its request slot
+                    if not isinstance(e, APIStatusError) or attempt == self.max_retries or not (e.status_code == 429 or e.status_code >= 500):
+                        raise
+                    self.retries_count += 1
+                    delay = self._retry_delay(attempt, e)
+                    logging.info(f'LLM responded {e.status_code}, retry {attempt + 1} in {delay:.2f}s')
+                    await asyncio.sleep(delay)
+                    continue
+                self.rate_limiter.correct(limiter_entry, response.usage.prompt_tokens + response.usage.completion_tokens)
+                return response, time.perf_counter() - started
+
+    @staticmethod
+    def _retry_delay(attempt: int, error: APIStatusError) -> float:
+        retry_after = error.response.headers.get('retry-after') if error.response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), cfg.llm_retry_max_delay)
+            except ValueError:
+                pass
+        return random.uniform(0, min(cfg.llm_retry_max_delay, cfg.llm_retry_base_delay * 2 ** attempt))
+
+    async def ask_many(self, prompts: List[str], return_exceptions: bool = False) -> List:
+        """answers in order of prompts; with return_exceptions failed prompts get exception instead of answer"""
+        return await asyncio.gather(*(self.ask(p) for p in prompts), return_exceptions=return_exceptions)
+
+    async def close(self):
+        await self._client.close()
+
+
+def run_sync(coro):
+    """runs coroutine to the end from sync code, also from Jupyter, where the event loop of the notebook is already running"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as executor:  # own event loop in worker thread, with llm_accounting scopes of the caller
+        return executor.submit(contextvars.copy_context().run, asyncio.run, coro).result()
+
+
+async def ask_llm_many_async(prompts: List[str], model: str = cfg.llm_model, max_concurrency: int = cfg.llm_max_concurrency,
+                             return_exceptions: bool = False, use_cache: bool = True, llm_client: AsyncLLMClient = None) -> List:
+    """answers in order of prompts, by llm_client or by the client created for the call"""
+    if llm_client is not None:
+        return await llm_client.ask_many(prompts, return_exceptions=return_exceptions)
+    llm_client = AsyncLLMClient(model=model, max_concurrency=max_concurrency, use_cache=use_cache)
+    try:
+        return await llm_client.ask_many(prompts, return_exceptions=return_exceptions)
+    finally:
+        await llm_client.close()
+
+
+def ask_llm_many(prompts: List[str], model: str = cfg.llm_model, max_concurrency: int = cfg.llm_max_concurrency,
+                 return_exceptions: bool = False, use_cache: bool = True) -> List:
+    """blocking helper to run prompts concurrently from sync code, answers are in order of prompts"""
+    return run_sync(ask_llm_many_async(prompts, model, max_concurrency, return_exceptions, use_cache))
 
 
 def get_pure_json_from_llm_result(llr_ret:  str):
@@ -37,8 +356,21 @@ def get_dict_from_llm_result(llr_ret:  str):
     return json.loads(llr_ret)
 
 
-def build_summarization_prompt(messages: List[TelegaMessage], chat_description: str = '') -> str:
-    prompt_template = """
+# messages of few-shot examples of the prompts, encoded the same way as the messages of the prompt
+example_messages = [
+    TelegaMessage(msg_id=123, msg_date=datetime(2024, 8, 29, 10, 14), user_name='Dima', reply_to_msg_id=None, is_in_family=True,
+                  msg_text='What kind of motor oil do you recommend to put in a Volkswagen car?'),
+    TelegaMessage(msg_id=124, msg_date=datetime(2024, 8, 29, 10, 16), user_name='John', reply_to_msg_id=None, is_in_family=False,
+                  msg_text='I prefer Shell oil. But change it every 6 month'),
+    TelegaMessage(msg_id=126, msg_date=datetime(2024, 8, 29, 10, 17), user_name='Janet', reply_to_msg_id=None, is_in_family=False,
+                  msg_text='I have a nice cat'),
+    TelegaMessage(msg_id=127, msg_date=datetime(2024, 8, 29, 10, 19), user_name='George', reply_to_msg_id=124, is_in_family=False,
+                  msg_text='Shell sucks. Buy Motul'),
+    TelegaMessage(msg_id=128, msg_date=datetime(2024, 8, 29, 10, 20), user_name='Paul', reply_to_msg_id=123, is_in_family=True,
+                  msg_text='VW sucks. Buy Tesla car, and you will not need to change oil at all'),
+]
+
+summarization_prompt_json = """
 You will be given some json data, having  some sequence of messages from Telegram chat, mostly in Russian.
 {chat_description}
 Sequence is ordered by "msg_date"  (message date ).
@@ -121,12 +453,77 @@ The messages, that you need to summirize into one topic are:
     `{messages}`
     """
 
-    msg_json = convert_to_json_list(messages)
-    return prompt_template.format(chat_description=chat_description, messages=msg_json)
+summarization_prompt_compact = """
+You will be given a sequence of messages from Telegram chat, mostly in Russian, as lines of json.
+{chat_description}
+The first line is a header: "keys" explains the short keys of messages, "t0" is the time which "t" of messages is counted from,
+"users" gives user names by the keys used in "u" of messages.
+Each next line is one message, keys without value are left out:
+"id" - message id, "re" - id of the message this one replies to, "t" - minutes after t0, "u" - key of user name,
+"fam": 1 - message is in family, "x" - message text.
+Messages are ordered by "t".
+There will be two types of messages,
+- the first one has "fam": 1 - and that means that they are explicitly linked in parent child relationship to each other by "re" key.
+  If such message has no "re", -that means this message is a root of such tree, probably starting discussion on some topic.
+- the second one, without "fam", - do not have explicit relation to main tree of discussion.
+They can be related to it or not, so were are consider them as "family candidates"
 
+Please mind "re" values -it points to the message for which the current one is a reply.
+Thus, all messages linked by this reference, are more likely belong to one topic.
+And if some message that is initially "family candidate" is attributed to "family" -
+you need to add to topic (family) all the tree of descendant messages, if any.
 
-def build_rag_prompt(question: str, chat_description:  str, messages: List[TelegaMessage]):
-    prompt_template = """
+Need to analyze the messages that are "in family", extract main subject of discussion (topic),
+and then  for each message not in family make a decision, - whether the message is related to main subject or not.
+
+Ultimately you should output in json format following:
+- topic name  (should be up to 7 words, in Russian)
+- topic name eng  (same in English)
+- topic summary (up to 50 words, for long topics may consist from up to 4 sentences in Russian)
+- topic summary eng (same in English)
+- topic tags: list of words for tagging, in Russian
+- topic tags eng: same list but in English
+- msg_ids: list of "id" values of relevant for this topic messages, it supposed to contains ids for most of the messages with "fam": 1
+  and some of the ones without it.
+- question: possible question, in English,  for which the answer can be found in one  or more of 'topic' messages.
+- answer: anwser to the question above, and the reasoning behind
+- answer message ids: list of "id" value(s) of the messages, that contains answer to the  question above.
+  Thus, that list MUST BE a subset of "msg_ids" List.
+
+Final output should be pure parsible to dict json, without any additional comments.
+--
+example of usage:
+for set of messages:
+`
+{example}
+`
+topic_name might be: "recommendation for choosing of motor oil for VW".
+"topic_summary_eng" might be:
+"as an motor oil for VS   recommended Shell and  Motul. But somebody recommends to have Toyota car instead of VW"".
+msg_ids:  [124, 127, 128]
+question: "What car should one have in order not to change engine oil?"
+answer: "Tesla. People says not need to change oil for them at all"
+answer_msg_ids: [128]
+# 126 - not included cause it is of-topic.
+    _________So, let's play._____
+The messages, that you need to summirize into one topic are:
+    `{messages}`
+    """
+
+
+def build_summarization_prompt(messages: List[TelegaMessage], chat_description: str = '',
+                               max_tokens: int = cfg.prompt_context_max_tokens, prompt_format: str = None) -> str:
+    """prompt of topic summarization, its instructions and example are in the same prompt_format as the messages"""
+    prompt_format = prompt_format or cfg.prompt_format
+    msg_json = encode_messages(pack_messages(messages, max_tokens, prompt_format=prompt_format, with_family=True), prompt_format,
+                               with_family=True)
+    if prompt_format == 'compact':
+        return summarization_prompt_compact.format(chat_description=chat_description, messages=msg_json,
+                                                   example=encode_messages(example_messages, prompt_format, with_family=True))
+    return summarization_prompt_json.format(chat_description=chat_description, messages=msg_json)
+
+
+rag_prompt_json = """
     You will be given some data. That data is a sequence of messages from chat from some messager.
     It can be in English or Russian language.
     This sequnce will be given in json format.
@@ -194,8 +591,60 @@ for set of messages:
     And the messages, where you can potentially find necessary information are:
     `{messages}`
     """
-    msg_json = convert_to_json_list(messages)
-    return prompt_template.format(question=question, chat_description=chat_description, messages=msg_json)
+
+rag_prompt_compact = """
+    You will be given some data. That data is a sequence of messages from chat from some messager.
+    It can be in English or Russian language.
+    This sequnce will be given as lines of json.
+    This chat is devoted to {chat_description}.
+
+    The first line is a header: "keys" explains the short keys of messages, "t0" is the time which "t" of messages is counted from,
+    "users" gives user names by the keys used in "u" of messages.
+    Each next line is one message, keys without value are left out:
+    "id" - message id, "re" - id of the message this one replies to, "t" - minutes after t0, "u" - key of user name, "x" - message text.
+    Please mind "re" values -it points to the message for which the current one is a reply.
+    Thus, all messages linked by this reference, are more likely belong to one topic branch.
+
+    You output should be some summarization text, answering the question,  maybe several sentences, if there is enough information to tell about,
+    and the "id" values of the messages, that are relevant to the question and which you use for the answer.
+    Use English language for the output.
+    Final result should be just pure json with attributes described above, "answer", "msg_ids"
+    If there are no relevant information inside the messages - just give empty values for both attributes
+______
+example of usage:
+for set of messages:
+`
+{example}
+`
+
+    and question: "A have Audi car. What motor oil is better for me?"
+    the result might be:
+    `
+    {{
+        answer: "As Audi is part of VW brand, it might be either Shell or Motul.
+            But for Shell keep in mind to change it every 6 months.
+            Though user Paul suggested just to buy Tesla instead of VW."
+        msg_ids: [123,124, 127, 128]
+    }}
+    `
+    # note: 126 is no included as it is not relevant for this question
+    _________So, let's play._____
+     The question, for which you should give the answer is:
+    '{question}'.
+    And the messages, where you can potentially find necessary information are:
+    `{messages}`
+    """
+
+
+def build_rag_prompt(question: str, chat_description:  str, messages: List[TelegaMessage], msg_scores: Dict[int, float] = None,
+                     max_tokens: int = cfg.prompt_context_max_tokens, prompt_format: str = None):
+    """prompt of answering the question by messages, its instructions and example are in the same prompt_format as the messages"""
+    prompt_format = prompt_format or cfg.prompt_format
+    msg_json = encode_messages(pack_messages(messages, max_tokens, msg_scores, prompt_format=prompt_format), prompt_format)
+    if prompt_format == 'compact':
+        return rag_prompt_compact.format(question=question, chat_description=chat_description, messages=msg_json,
+                                         example=encode_messages(example_messages, prompt_format))
+    return rag_prompt_json.format(question=question, chat_description=chat_description, messages=msg_json)
 
 
 def build_translation_prompt(msgs_json: str) -> str:
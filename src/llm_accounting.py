@@ -0,0 +1,182 @@
+"""Per call accounting of LLM tokens, cost and latency, tagged by caller, with budgets per job and per user query"""
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Deque, Dict, Tuple
+import json
+import logging
+import threading
+
+from pydantic import BaseModel
+
+import src.config as cfg
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class LLMCallRecord(BaseModel):
+    tag: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0  # USD
+    latency: float = 0.0  # seconds
+    cached: bool = False
+    call_date: datetime
+
+
+class Budget:
+    """USD limit for a job or a user query: over soft_limit calls are slowed down, calls that may pass hard_limit are refused
+
+    Args:
+        name (str): name for logs and errors
+        hard_limit (float, optional): USD. Defaults to None - no limit.
+        soft_limit (float, optional): USD. Defaults to None - no limit.
+    """
+
+    def __init__(self, name: str, hard_limit: float = None, soft_limit: float = None):
+        self.name, self.hard_limit, self.soft_limit = name, hard_limit, soft_limit
+        self.spent = 0.0
+        self.reserved = 0.0  # estimated cost of calls in flight
+
+    def reserve(self, estimated_cost: float) -> bool:
+        """raises BudgetExceeded if call may overshoot hard limit, returns True if soft limit is passed"""
+        if self.hard_limit is not None and self.spent + self.reserved + estimated_cost > self.hard_limit:
+            raise BudgetExceeded(f'budget {self.name} of {self.hard_limit} USD would be exceeded: spent {self.spent:.4f}, '
+                                 f'in flight {self.reserved:.4f}, next call up to {estimated_cost:.4f} USD')
+        self.reserved += estimated_cost
+        return self.soft_limit is not None and self.spent + self.reserved > self.soft_limit
+
+    def settle(self, estimated_cost: float, cost: float):
+        self.reserved = max(self.reserved - estimated_cost, 0.0)
+        self.spent += cost
+
+
+_current_tag: ContextVar[str] = ContextVar('llm_tag', default='untagged')
+_current_budgets: ContextVar[Tuple[Budget, ...]] = ContextVar('llm_budgets', default=())
+
+
+class LLMAccounting:
+    """Keeps last LLM call records and totals per (tag, model)
+
+    Args:
+        max_records (int, optional): number of last call records kept. Defaults to cfg.llm_accounting_max_records.
+    """
+
+    def __init__(self, max_records: int = cfg.llm_accounting_max_records):
+        self.records: Deque[LLMCallRecord] = deque(maxlen=max_records)
+        self.totals: Dict[Tuple[str, str], Dict[str, float]] = defaultdict(
+            lambda: {'calls': 0, 'cached_calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'latency': 0.0})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def scope(self, tag: str, hard_limit: float = None, soft_limit: float = None, budget_name: str = None):
+        """tags LLM calls inside, and limits their total cost if limits are given, or just sums it if only budget_name is;
+        works as decorator too"""
+        budgets = _current_budgets.get()
+        if hard_limit is not None or soft_limit is not None or budget_name:
+            budgets = budgets + (Budget(budget_name or tag, hard_limit, soft_limit),)
+        tag_token, budgets_token = _current_tag.set(tag), _current_budgets.set(budgets)
+        try:
+            yield budgets[-1] if budgets else None
+        finally:
+            _current_tag.reset(tag_token)
+            _current_budgets.reset(budgets_token)
+
+    @staticmethod
+    def current_tag() -> str:
+        return _current_tag.get()
+
+    @staticmethod
+    def reserve(estimated_cost: float) -> bool:
+        """reserves estimated cost in active budgets, returns True if any soft limit is passed"""
+        soft_exceeded, reserved = False, []
+        try:
+            for budget in _current_budgets.get():
+                soft_exceeded = budget.reserve(estimated_cost) or soft_exceeded
+                reserved.append(budget)
+        except BudgetExceeded:
+            for budget in reserved:
+                budget.settle(estimated_cost, 0.0)
+            raise
+        if soft_exceeded:
+            logging.warning(f'soft LLM budget is exceeded for {_current_tag.get()}')
+        return soft_exceeded
+
+    @staticmethod
+    def release(estimated_cost: float):
+        """returns reservation of a call that failed"""
+        for budget in _current_budgets.get():
+            budget.settle(estimated_cost, 0.0)
+
+    def record(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0, cost: float = 0.0, latency: float = 0.0,
+               cached: bool = False, estimated_cost: float = 0.0):
+        """adds call to the totals of the current tag and settles its cost in active budgets"""
+        tag = _current_tag.get()
+        for budget in _current_budgets.get():
+            budget.settle(estimated_cost, cost)
+        with self._lock:
+            self.records.append(LLMCallRecord(tag=tag, model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                              cost=cost, latency=latency, cached=cached, call_date=datetime.now()))
+            totals = self.totals[(tag, model)]
+            totals['calls'] += 1
+            totals['cached_calls'] += int(cached)
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+            totals['cost'] += cost
+            totals['latency'] += latency
+
+    def summary(self) -> Dict[str, Dict]:
+        """totals per tag, with average cost and latency per call"""
+        with self._lock:
+            by_tag = defaultdict(lambda: defaultdict(float))
+            for (tag, _), totals in self.totals.items():
+                for k, v in totals.items():
+                    by_tag[tag][k] += v
+        ret = dict()
+        for tag, totals in by_tag.items():
+            calls = totals['calls']
+            ret[tag] = {**totals, 'cost_per_call': totals['cost'] / calls if calls else 0,
+                        'latency_per_call': totals['latency'] / calls if calls else 0}
+        return ret
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=4)
+
+    def to_prometheus(self) -> str:
+        """totals in Prometheus text exposition format"""
+        metrics = [('llm_calls_total', 'calls', 'LLM calls'),
+                   ('llm_cached_calls_total', 'cached_calls', 'LLM calls answered from completion cache'),
+                   ('llm_prompt_tokens_total', 'prompt_tokens', 'prompt tokens'),
+                   ('llm_completion_tokens_total', 'completion_tokens', 'completion tokens'),
+                   ('llm_cost_usd_total', 'cost', 'spent USD'),
+                   ('llm_latency_seconds_total', 'latency', 'total latency of LLM calls')]
+        with self._lock:
+            totals = sorted(self.totals.items())
+        lines = []
+        for metric, field, help_text in metrics:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for (tag, model), values in totals:
+                lines.append(f'{metric}{{tag="{_escape_label(tag)}",model="{_escape_label(model)}"}} {values[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.records.clear()
+            self.totals.clear()
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def estimate_cost(prompt_tokens: int, completion_tokens: int = cfg.llm_expected_completion_tokens) -> float:
+    return (prompt_tokens * cfg.llm_price[0] + completion_tokens * cfg.llm_price[1]) / 1000000
+
+
+llm_accounting = LLMAccounting()
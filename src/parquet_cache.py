@@ -0,0 +1,115 @@
+"""Columnar cache of parsed telegram dump, as parquet dataset partitioned by chat and month"""
+
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, List, Optional
+import json
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import src.config as cfg
+from src.data_classes import TelegaMessage
+from src.perf import gc_paused
+from src.read_telega_dump import telega_dump_parse_fast
+from src.telegram_messages_index import TelegaMessageIndex, dump_signature, message_columns
+
+parquet_schema = pa.schema([('msg_id', pa.int64()),
+                            ('msg_date', pa.timestamp('s')),
+                            ('user_id', pa.string()),
+                            ('user_name', pa.string()),
+                            ('chat_id', pa.int64()),
+                            ('reply_to_msg_id', pa.int64()),
+                            ('msg_text', pa.string()),
+                            ('msg_month', pa.string())])
+partitioning = ds.partitioning(pa.schema([('chat_id', pa.int64()), ('msg_month', pa.string())]), flavor='hive')
+signature_file_name = '_dump_signature.json'
+
+
+def dump_to_parquet(dump_path: str, cache_dir: str = cfg.parquet_cache_dir, batch_size: int = 100000) -> str:
+    """_summary_
+    To parse telegram dump and write it to parquet dataset partitioned by chat_id and msg_month
+    Args:
+        dump_path (str): path to telegram json dump
+        cache_dir (str, optional): root folder of dataset. Defaults to cfg.parquet_cache_dir.
+        batch_size (int, optional): number of messages per record batch.
+
+    Returns:
+        str: cache_dir
+    """
+    msgs = iter(telega_dump_parse_fast(dump_path, validate=cfg.dump_parse_validate, workers=cfg.dump_parse_workers))
+
+    def record_batches():
+        while batch := list(islice(msgs, batch_size)):
+            columns = {c: [getattr(m, c) for m in batch] for c in message_columns}
+            columns['msg_month'] = [m.msg_date.strftime('%Y-%m') for m in batch]
+            yield pa.RecordBatch.from_pydict(columns, schema=parquet_schema)
+
+    # partitions of months or chats that are not in the new dump would stay with delete_matching, so cache is written from scratch
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    ds.write_dataset(record_batches(), cache_dir, schema=parquet_schema, format='parquet', partitioning=partitioning,
+                     existing_data_behavior='overwrite_or_ignore')
+    with open(os.path.join(cache_dir, signature_file_name), 'w') as f:
+        json.dump(dump_signature(dump_path), f)
+    return cache_dir
+
+
+def ensure_parquet_cache(dump_path: str, cache_dir: str = cfg.parquet_cache_dir) -> str:
+    """converts dump to parquet only if there is no cache for this very dump yet"""
+    signature_path = os.path.join(cache_dir, signature_file_name)
+    if os.path.exists(signature_path):
+        with open(signature_path, 'r') as f:
+            if tuple(json.load(f)) == dump_signature(dump_path):
+                return cache_dir
+    return dump_to_parquet(dump_path, cache_dir)
+
+
+def _filter(date_from: Optional[datetime], date_to: Optional[datetime], chat_id: Optional[int]) -> Optional[ds.Expression]:
+    conditions = []
+    if chat_id is not None:
+        conditions.append(ds.field('chat_id') == chat_id)
+    if date_from is not None:  # condition on partition field prunes whole months, on msg_date - row groups and rows
+        conditions.append(ds.field('msg_month') >= date_from.strftime('%Y-%m'))
+        conditions.append(ds.field('msg_date') >= pa.scalar(date_from, pa.timestamp('s')))
+    if date_to is not None:
+        conditions.append(ds.field('msg_month') <= date_to.strftime('%Y-%m'))
+        conditions.append(ds.field('msg_date') <= pa.scalar(date_to, pa.timestamp('s')))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_parquet_table(cache_dir: str = cfg.parquet_cache_dir, columns: List[str] = None,
+                       date_from: datetime = None, date_to: datetime = None, chat_id: int = None) -> pa.Table:
+    """reads only requested columns of the messages with date_from <= msg_date <= date_to, ordered by msg_id"""
+    dataset = ds.dataset(cache_dir, format='parquet', partitioning=partitioning, exclude_invalid_files=True)
+    read_columns = list(columns) if columns else list(message_columns)
+    if 'msg_id' not in read_columns:
+        read_columns.append('msg_id')  # for ordering
+    table = dataset.to_table(columns=read_columns, filter=_filter(date_from, date_to, chat_id))
+    table = table.sort_by('msg_id')
+    return table.select(columns) if columns else table
+
+
+def read_parquet_dataframe(cache_dir: str = cfg.parquet_cache_dir, columns: List[str] = None,
+                           date_from: datetime = None, date_to: datetime = None, chat_id: int = None) -> pd.DataFrame:
+    return read_parquet_table(cache_dir, columns, date_from, date_to, chat_id).to_pandas()
+
+
+def read_parquet_messages(cache_dir: str = cfg.parquet_cache_dir, date_from: datetime = None, date_to: datetime = None,
+                          chat_id: int = None) -> Iterable[TelegaMessage]:
+    table = read_parquet_table(cache_dir, None, date_from, date_to, chat_id)
+    for batch in table.to_batches():
+        with gc_paused():  # not across yields, the caller runs with gc enabled
+            columns = [batch.column(c).to_pylist() for c in message_columns]
+            msgs = [TelegaMessage.model_construct(**dict(zip(message_columns, values))) for values in zip(*columns)]
+        yield from msgs
+
+
+def read_parquet_index(cache_dir: str = cfg.parquet_cache_dir, date_from: datetime = None, date_to: datetime = None,
+                       chat_id: int = None, index_class=TelegaMessageIndex) -> TelegaMessageIndex:
+    return index_class.from_messages(read_parquet_messages(cache_dir, date_from, date_to, chat_id))
@@ -0,0 +1,45 @@
+"""helpers for performance sensitive code"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+import gc
+import time
+
+
+@contextmanager
+def gc_paused():
+    """cyclic gc passes over millions of freshly created objects take longer than creating them, while none of them is garbage"""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+_stage_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('stage_timings', default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """adds duration of the block to the timings of collect_stages, does nothing when no one collects them"""
+    timings = _stage_timings.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+@contextmanager
+def collect_stages():
+    """seconds spent in every stage within the block, by stage name; threads started inside are not counted"""
+    timings = dict()
+    token = _stage_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_timings.reset(token)
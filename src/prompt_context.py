@@ -0,0 +1,124 @@
+"""Compact encoding of chat messages for prompts, and packing of the most relevant of them into a token budget"""
+
+from datetime import datetime
+from typing import Callable, Dict, List
+import json
+import logging
+
+import src.config as cfg
+from src.chunking import get_token_counter
+from src.data_classes import TelegaMessage, convert_to_json_list
+
+compact_keys_legend = 'id - msg_id, re - reply_to_msg_id, t - minutes after t0, u - user_name by its key in users, x - msg_text'
+family_key_legend = ', fam - is_in_family'
+
+
+def _user_keys(messages: List[TelegaMessage]) -> Dict[str, int]:
+    """short keys of user names, in order of their first message"""
+    keys = dict()
+    for msg in messages:
+        if msg.user_name and msg.user_name not in keys:
+            keys[msg.user_name] = len(keys) + 1
+    return keys
+
+
+def _compact_line(msg: TelegaMessage, t0: datetime, user_keys: Dict[str, int], with_family: bool) -> str:
+    d = {'id': msg.msg_id}
+    if msg.reply_to_msg_id is not None:
+        d['re'] = msg.reply_to_msg_id
+    d['t'] = int((msg.msg_date - t0).total_seconds() // 60)
+    if msg.user_name:
+        d['u'] = user_keys[msg.user_name]
+    if with_family and msg.is_in_family:
+        d['fam'] = 1
+    if msg.msg_text:
+        d['x'] = msg.msg_text
+    return json.dumps(d, ensure_ascii=False, separators=(',', ':'))
+
+
+def _compact_header(t0: datetime, user_keys: Dict[str, int], with_family: bool) -> str:
+    header = {'keys': compact_keys_legend + (family_key_legend if with_family else ''), 't0': t0.strftime('%Y-%m-%d %H:%M'),
+              'users': {str(k): name for name, k in user_keys.items()}}
+    return json.dumps(header, ensure_ascii=False, separators=(',', ':'))
+
+
+def encode_messages_compact(messages: List[TelegaMessage], with_family: bool = False) -> str:
+    """_summary_
+    Json line per message with short keys and without nulls, after the header line with the keys legend,
+    table of user names and t0 - time of the first message, which message times are counted from in minutes
+    Args:
+        messages (List[TelegaMessage]): messages for the prompt
+        with_family (bool, optional): to keep is_in_family flag, needed for summarization. Defaults to False.
+
+    Returns:
+        str: lines of messages ordered by date
+    """
+    msgs = sorted(messages, key=lambda x: (x.msg_date, x.msg_id))
+    if not msgs:
+        return ''
+    t0 = msgs[0].msg_date.replace(second=0, microsecond=0)
+    user_keys = _user_keys(msgs)
+    return '\n'.join([_compact_header(t0, user_keys, with_family)] + [_compact_line(x, t0, user_keys, with_family) for x in msgs])
+
+
+def encode_messages(messages: List[TelegaMessage], prompt_format: str = None, with_family: bool = False) -> str:
+    """messages as they go to the prompt, in cfg.prompt_format: 'compact' or 'json' - indented list of all the fields"""
+    prompt_format = prompt_format or cfg.prompt_format
+    if prompt_format == 'compact':
+        return encode_messages_compact(messages, with_family)
+    if prompt_format == 'json':
+        return convert_to_json_list(messages)
+    raise Exception(f'unknown prompt format {prompt_format}')
+
+
+def pack_messages(messages: List[TelegaMessage], max_tokens: int = None, scores: Dict[int, float] = None,
+                  prompt_format: str = None, with_family: bool = False, count_tokens: Callable[[str], int] = None) -> List[TelegaMessage]:
+    """_summary_
+    Keeps the highest scoring messages, each together with the chain of messages it replies to,
+    while encode_messages of the kept messages fits to max_tokens
+    Args:
+        messages (List[TelegaMessage]): candidate messages
+        max_tokens (int, optional): budget of encoded messages. Defaults to cfg.prompt_context_max_tokens.
+        scores (Dict[int, float], optional): relevance by msg_id, missing ones are 0. Defaults to is_in_family flag.
+        prompt_format (str, optional): Defaults to cfg.prompt_format.
+        with_family (bool, optional): as for encode_messages. Defaults to False.
+        count_tokens (Callable[[str], int], optional): Defaults to tokenizer of cfg.llm_model.
+
+    Returns:
+        List[TelegaMessage]: kept messages in their original order
+    """
+    max_tokens = max_tokens or cfg.prompt_context_max_tokens
+    prompt_format = prompt_format or cfg.prompt_format
+    count_tokens = count_tokens or get_token_counter(cfg.llm_model)
+    by_id = {x.msg_id: x for x in messages}
+    if not by_id:
+        return []
+    # cost of every message is counted once, as if it is encoded among all the candidates
+    if prompt_format == 'compact':
+        t0 = min(x.msg_date for x in messages).replace(second=0, microsecond=0)
+        user_keys = _user_keys(sorted(messages, key=lambda x: (x.msg_date, x.msg_id)))
+        used_tokens = count_tokens(_compact_header(t0, {}, with_family))
+        user_tokens = {name: count_tokens(f'"{k}":{json.dumps(name, ensure_ascii=False)},') for name, k in user_keys.items()}
+        msg_tokens = {x.msg_id: count_tokens(_compact_line(x, t0, user_keys, with_family)) + 1 for x in by_id.values()}
+    else:
+        used_tokens, user_tokens = count_tokens('[\n]'), dict()
+        msg_tokens = {x.msg_id: count_tokens(convert_to_json_list([x])) for x in by_id.values()}
+    if used_tokens + sum(msg_tokens.values()) + sum(user_tokens.values()) <= max_tokens:
+        return list(messages)
+
+    if scores is None:
+        scores = {x.msg_id: float(bool(x.is_in_family)) for x in by_id.values()}
+    kept, kept_users = set(), set()
+    for msg in sorted(by_id.values(), key=lambda x: (-scores.get(x.msg_id, 0.0), x.msg_date, x.msg_id)):
+        chain, current = [], msg
+        while current is not None and current.msg_id not in kept and current.msg_id not in chain:
+            chain.append(current.msg_id)
+            current = by_id.get(current.reply_to_msg_id)
+        chain_users = {by_id[x].user_name for x in chain if by_id[x].user_name} - kept_users
+        cost = sum(msg_tokens[x] for x in chain) + sum(user_tokens.get(x, 0) for x in chain_users)
+        if used_tokens + cost <= max_tokens:
+            kept.update(chain)
+            kept_users.update(chain_users)
+            used_tokens += cost
+    logging.info(f'{len(kept)} of {len(by_id)} messages are packed into {used_tokens} of {max_tokens} tokens')
+    return [x for x in messages if x.msg_id in kept]
@@ -0,0 +1,262 @@
+"""Offline benchmark of retrieval and RAG methods over ground truth questions: hit rate, MRR and latency of every stage.
+
+python -m src.rag_benchmark --local --fake-llm --baseline output/benchmark/previous.json
+"""
+
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+import src.config as cfg
+import src.elastic_search.es as es
+from src.chunking import get_token_counter
+from src.data_classes import TelegaMessage
+from src.embeddings import embedding_service
+from src.perf import collect_stages
+from src.prompt_context import encode_messages, pack_messages
+from src.rag_integration import RaguDuDu
+from src.reranker import reranker_engine
+from src.telegram_messages_index import TelegaMessageIndex
+
+stages = ('embed', 'search', 'rerank', 'context', 'prompt', 'llm', 'total')
+
+
+class FakeLLM:
+    """stand-in of llm.ask_llm: answers after latency seconds with json of msg_ids found in the prompt"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, prompt: str, model: str = cfg.llm_model) -> str:
+        self.calls += 1
+        time.sleep(self.latency)
+        msg_ids = [int(x) for x in re.findall(r'"(?:msg_)?id": ?(\d+)', prompt)]
+        return json.dumps({'answer': f'fake answer on {len(prompt)} letters of prompt', 'msg_ids': msg_ids})
+
+
+def _as_ids(value) -> List[int]:
+    if isinstance(value, str):  # lists saved as strings by pandas
+        value = json.loads(value)
+    return [int(x) for x in value or []]
+
+
+def load_ground_truth(path: str = cfg.ground_truth_path, topics_path: str = cfg.topics_path) -> List[Dict]:
+    """questions with answer_msg_ids, the ids missing in ground truth records are taken from topics with the same question"""
+    with open(path, 'r') as f:
+        records = json.load(f)
+    answer_ids = dict()
+    if topics_path and os.path.exists(topics_path):
+        with open(topics_path, 'r') as f:
+            answer_ids = {x['question']: x.get('answer_message_ids') for x in json.load(f)}
+    ground_truth = []
+    for x in records:
+        ids = x.get('answer_msg_ids') or x.get('answer_message_ids') or answer_ids.get(x['question'])
+        if not ids:
+            logging.warning(f'no answer msg ids for question "{x["question"]}", it is skipped')
+            continue
+        ground_truth.append({**x, 'answer_msg_ids': _as_ids(ids)})
+    return ground_truth
+
+
+# method name -> function of (RaguDuDu, ground truth record) returning ranked msg_ids and function producing LLM answer
+Method = Callable[[RaguDuDu, Dict], Tuple[List[int], Callable]]
+
+
+def _by_topics(rg: RaguDuDu, record: Dict):
+    topic = rg.find_topic(record['question'])
+    if not topic:
+        return [], None
+    return _as_ids(topic['msg_ids']), lambda: rg.rag_by_topic(record['question'], topic)
+
+
+def _by_messages(find: Callable[[RaguDuDu, Dict], List[int]]) -> Method:
+    def method(rg: RaguDuDu, record: Dict):
+        msg_ids = find(rg, record)
+        return msg_ids, lambda: rg.rag_by_messages(record['question'], msg_ids)
+    return method
+
+
+methods: Dict[str, Method] = {
+    'topics': _by_topics,
+    'simple_search': _by_messages(lambda rg, x: rg.find_by_simple_search(x.get('tags') or x['question'])),
+    'dense_vector_search': _by_messages(lambda rg, x: rg.find_by_dense_vector_search(x['question'])),
+    'reranked': _by_messages(lambda rg, x: rg.find_reranked(x['question'])),
+    'hybrid_search': _by_messages(lambda rg, x: rg.find_by_hybrid_search(x['question'], x.get('tags'))),
+}
+
+
+def latency_percentiles(seconds: List[float]) -> Dict[str, float]:
+    ms = np.asarray(seconds) * 1000
+    return {'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95)), 'p99': float(np.percentile(ms, 99)),
+            'mean': float(ms.mean())}
+
+
+def run_benchmark(rg: RaguDuDu, ground_truth: List[Dict], method_names: List[str] = None, with_llm: bool = True) -> Dict:
+    """_summary_
+    Runs every method over every question, with cold query embedding and reranker caches for each method
+    Args:
+        rg (RaguDuDu): RAG system to benchmark
+        ground_truth (List[Dict]): records with question, answer_msg_ids and optional tags for BM25, see load_ground_truth
+        method_names (List[str], optional): keys of methods. Defaults to all of them.
+        with_llm (bool, optional): to build prompts and ask LLM, otherwise only retrieval is measured. Defaults to True.
+
+    Returns:
+        Dict: by method - hit rate and MRR of answer_msg_ids in retrieved msg_ids, latency percentiles in ms by stage
+    """
+    ret = dict()
+    for name in method_names or list(methods):
+        method = methods[name]
+        embedding_service.clear_cache()
+        reranker_engine.clear_cache()
+        hits, reciprocal_ranks, errors = 0, [], 0
+        timings = {x: [] for x in stages}
+        for record in ground_truth:
+            relevant = set(record['answer_msg_ids'])
+            with collect_stages() as question_timings:
+                started = time.perf_counter()
+                try:
+                    msg_ids, answer = method(rg, record)
+                    if with_llm and answer:
+                        answer()
+                except Exception as e:
+                    errors += 1
+                    logging.warning(f'{name} failed for "{record["question"]}": {e!r}')
+                    continue
+                question_timings['total'] = time.perf_counter() - started
+            rank = next((i for i, x in enumerate(msg_ids, 1) if int(x) in relevant), None)
+            hits += rank is not None
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+            for stage_name, seconds in question_timings.items():
+                timings[stage_name].append(seconds)
+        answered = len(reciprocal_ranks)
+        ret[name] = {'questions': len(ground_truth), 'errors': errors,
+                     'hit_rate': hits / answered if answered else 0.0,
+                     'mrr': float(np.mean(reciprocal_ranks)) if answered else 0.0,
+                     'latency_ms': {k: latency_percentiles(v) for k, v in timings.items() if v}}
+        logging.info(f'{name}: hit rate {ret[name]["hit_rate"]:.3f}, MRR {ret[name]["mrr"]:.3f}, {errors} errors')
+    return ret
+
+
+def measure_prompt_tokens(rg: RaguDuDu, ground_truth: List[Dict], method_names: List[str] = None,
+                          max_tokens: int = cfg.prompt_context_max_tokens) -> Dict:
+    """_summary_
+    Tokens of context messages in RAG prompts as plain json of all the fields and as compact encoding packed into max_tokens,
+    and share of questions with answer messages still in the context. Topics method is skipped, as its context is the topic itself.
+    Context hit rate only shows that packing keeps answer messages, correctness of LLM answers is not measured here.
+    Args:
+        rg (RaguDuDu): RAG system to get context messages from
+        ground_truth (List[Dict]): see load_ground_truth
+        method_names (List[str], optional): keys of methods. Defaults to all of them but topics.
+        max_tokens (int, optional): budget of compact context. Defaults to cfg.prompt_context_max_tokens.
+
+    Returns:
+        Dict: by method - mean tokens of both encodings, savings share, context hit rate of both encodings
+    """
+    count_tokens = get_token_counter(cfg.llm_model)
+    ret = dict()
+    for name in method_names or [x for x in methods if x != 'topics']:
+        json_tokens, compact_tokens, json_hits, compact_hits = [], [], 0, 0
+        for record in ground_truth:
+            relevant = set(record['answer_msg_ids'])
+            msg_ids, _ = methods[name](rg, record)
+            msgs, msg_scores = rg.context_messages(msg_ids)
+            packed = pack_messages(msgs, max_tokens, msg_scores, prompt_format='compact', count_tokens=count_tokens)
+            json_tokens.append(count_tokens(encode_messages(msgs, 'json')))
+            compact_tokens.append(count_tokens(encode_messages(packed, 'compact')))
+            json_hits += bool(relevant & {x.msg_id for x in msgs})
+            compact_hits += bool(relevant & {x.msg_id for x in packed})
+        questions = len(ground_truth) or 1
+        ret[name] = {'json_tokens': float(np.mean(json_tokens or [0])), 'compact_tokens': float(np.mean(compact_tokens or [0])),
+                     'savings': 1 - sum(compact_tokens) / sum(json_tokens) if sum(json_tokens) else 0.0,
+                     'context_hit_rate_json': json_hits / questions, 'context_hit_rate_compact': compact_hits / questions}
+        logging.info(f'{name}: compact context takes {ret[name]["savings"]:.1%} fewer tokens, answer messages kept in context '
+                     f'{ret[name]["context_hit_rate_json"]:.3f} -> {ret[name]["context_hit_rate_compact"]:.3f}')
+    return ret
+
+
+def compare_results(current: Dict, baseline: Dict, quality_tolerance: float = 0.01, latency_tolerance: float = 0.2) -> List[str]:
+    """regressions of current run against baseline: hit rate or MRR drop, p95 of total latency growth by latency_tolerance share"""
+    regressions = []
+    for name, res in current['methods'].items():
+        base = baseline.get('methods', {}).get(name)
+        if not base:
+            continue
+        for metric in ('hit_rate', 'mrr'):
+            if res[metric] < base[metric] - quality_tolerance:
+                regressions.append(f'{name} {metric} {base[metric]:.3f} -> {res[metric]:.3f}')
+        p95, base_p95 = res['latency_ms'].get('total', {}).get('p95'), base['latency_ms'].get('total', {}).get('p95')
+        if p95 and base_p95 and p95 > base_p95 * (1 + latency_tolerance):
+            regressions.append(f'{name} p95 latency {base_p95:.1f} -> {p95:.1f} ms')
+    return regressions
+
+
+def local_rag(ask_llm: Callable[[str, str], str] = None) -> RaguDuDu:
+    """RaguDuDu over in-process stand-in of ES, with indices loaded from json files of output folder"""
+    from src.elastic_search.local_es import LocalElasticsearch, default_index_files
+    local_es = LocalElasticsearch.from_files(default_index_files())
+    es.es_client = local_es
+    msgs = (TelegaMessage.model_validate(d) for d in local_es.indices[cfg.index_name_messages].docs)
+    return RaguDuDu(telegram_index=TelegaMessageIndex.from_messages(msgs), ask_llm=ask_llm)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ground-truth', default=cfg.ground_truth_path)
+    parser.add_argument('--topics', default=cfg.topics_path, help='source of answer msg ids missing in ground truth')
+    parser.add_argument('--methods', nargs='+', choices=list(methods), default=list(methods))
+    parser.add_argument('--limit', type=int, help='number of first questions to run')
+    parser.add_argument('--local', action='store_true', help='in-process stand-in of Elasticsearch instead of the cluster')
+    parser.add_argument('--fake-llm', action='store_true', help='answers by FakeLLM instead of OpenAI')
+    parser.add_argument('--fake-llm-latency', type=float, default=0.0, help='seconds of FakeLLM answer')
+    parser.add_argument('--no-llm', action='store_true', help='retrieval only')
+    parser.add_argument('--prompt-tokens', action='store_true', help='to compare tokens of json and compact context encodings')
+    parser.add_argument('--output', help='json file of results. Defaults to timestamped file in cfg.benchmark_output_dir')
+    parser.add_argument('--baseline', help='json file of previous run to compare with')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit code 1 if results are worse than baseline')
+    args = parser.parse_args(argv)
+
+    ground_truth = load_ground_truth(args.ground_truth, args.topics)[:args.limit]
+    ask_llm = FakeLLM(args.fake_llm_latency) if args.fake_llm else None
+    rg = local_rag(ask_llm) if args.local else RaguDuDu(ask_llm=ask_llm)
+    results = {'run_date': datetime.now().isoformat(), 'backend': 'local' if args.local else cfg.es_url,
+               'llm': 'none' if args.no_llm else ('fake' if args.fake_llm else cfg.llm_model),
+               'vector_search_backend': cfg.vector_search_backend, 'ground_truth': args.ground_truth,
+               'methods': run_benchmark(rg, ground_truth, args.methods, with_llm=not args.no_llm)}
+    if args.prompt_tokens:
+        results['prompt_tokens'] = measure_prompt_tokens(rg, ground_truth, [x for x in args.methods if x != 'topics'])
+
+    output = args.output or os.path.join(cfg.benchmark_output_dir, f'rag_benchmark_{datetime.now():%Y%m%d_%H%M%S}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    for name, res in results['methods'].items():
+        total = res['latency_ms'].get('total', {})
+        print(f'{name:<20} hit rate {res["hit_rate"]:.3f}  MRR {res["mrr"]:.3f}  errors {res["errors"]}  '
+              f'p50 {total.get("p50", 0):.1f} ms  p95 {total.get("p95", 0):.1f} ms  p99 {total.get("p99", 0):.1f} ms')
+    for name, res in results.get('prompt_tokens', {}).items():
+        print(f'{name:<20} context tokens {res["json_tokens"]:.0f} -> {res["compact_tokens"]:.0f} ({res["savings"]:.1%} saved), '
+              f'context hit rate {res["context_hit_rate_json"]:.3f} -> {res["context_hit_rate_compact"]:.3f}')
+    print(f'results are written to {output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare_results(results, json.load(f))
+        for x in regressions:
+            print(f'REGRESSION: {x}')
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
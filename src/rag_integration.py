@@ -1,51 +1,77 @@
 import logging
-from tqdm import tqdm
-from typing import Iterable, List
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+import asyncio
+import contextvars
 import json
 import math
+import time
 
 from sentence_transformers import CrossEncoder
 
 import src.config as cfg
+from src.answer_cache import answer_cache, method_params, note_retrieved
+from src.chunking import chunk_messages, chunk_to_json, get_token_counter
 from src.data_classes import TelegaMessage
 from src.telegram_messages_index import TelegaMessageIndex
-from src.read_telega_dump import telega_dump_parse_essential
+from src.columnar_message_index import ColumnarTelegaMessageIndex
 import src.elastic_search.es as es
+from src.embeddings import embedding_service
+from src.reranker import reranker_engine
 import src.llm as llm
+from src.perf import stage
+from src.llm_accounting import BudgetExceeded, llm_accounting
 
 
 class RaguDuDu:
-    def __init__(self, llm_model=cfg.llm_model):
-        print("Creating the messages    index...")
-        dump_path = cfg.messages_dump_path
-        msgs = telega_dump_parse_essential(dump_path=dump_path)
-        # this supposed to be loaded from es index. todo
-        mi = TelegaMessageIndex()
-        for msg in tqdm(msgs):
-            mi.add_item(msg)
-        self.telegram_index = mi
+    def __init__(self, llm_model=cfg.llm_model, telegram_index: TelegaMessageIndex = None, ask_llm: Callable[[str, str], str] = None,
+                 ask_llm_stream: Callable[[str, str], Iterator[str]] = None):
+        if telegram_index is None:
+            print("Creating the messages    index...")
+            index_class = ColumnarTelegaMessageIndex if cfg.messages_index_backend == 'columnar' else TelegaMessageIndex
+            if cfg.messages_index_source == 'es':
+                telegram_index = index_class.from_messages(es.scan_messages(cfg.index_name_messages))
+            else:
+                telegram_index = index_class.from_dump(cfg.messages_dump_path, snapshot_path=cfg.messages_index_snapshot_path)
+        self.telegram_index = telegram_index
         self.llm_model = llm_model
+        self.ask_llm = ask_llm or llm.ask_llm  # (prompt, model) -> answer, replaced by fake LLM in benchmarks
+        if ask_llm_stream is None:  # (prompt, model) -> pieces of answer, fake LLM gives the whole answer as one piece
+            ask_llm_stream = llm.ask_llm_stream if ask_llm is None else lambda prompt, model: iter([ask_llm(prompt, model)])
+        self.ask_llm_stream = ask_llm_stream
+        embedding_service.warm_up()  # to not pay model loading on the first question
 
+    @llm_accounting.scope('summarization', hard_limit=cfg.llm_query_budget_usd)
     def get_topic_summary_by_message(self, topic_message_id: int) -> str:
         msgs_to_feed = self.telegram_index.get_potential_topic(topic_message_id, max_steps_up=1)
         prompt = llm.build_summarization_prompt(chat_description=cfg.chat_description, messages=msgs_to_feed)
         logging.info(f'len of prompt {len(prompt)}')
-        answer = llm.ask_llm(prompt, self.llm_model)
-        answer = answer.replace('```json', '').replace('```', '')
-        return answer
+        answer = self.ask_llm(prompt, self.llm_model)
+        topic = llm.get_dict_from_llm_result(answer)
+        topic['topic_msg_id'] = topic_message_id  # logical PK of topics index, see cfg.index_pk_fields
+        return json.dumps(topic, ensure_ascii=False)
 
+    @answer_cache.cached()
+    @llm_accounting.scope('rag_by_topics', hard_limit=cfg.llm_query_budget_usd)
     def rag_by_topics(self, question: str) -> str:
+        topic = self.find_topic(question)
+        if topic:
+            return self.rag_by_topic(question, topic)
+
+    def find_topic(self, question: str) -> Dict:
         search_field = 'topic_name_eng_vector'
         ret = es.knn_vector_search(search_term=question, index_name=cfg.index_name_topics, search_field=search_field)
         if ret:
-            score, doc = ret[0]['score'], ret[0]['doc']
-            logging.info(f'got result of knn search {score=}')
-            msgs = es.get_messages_by_id(chat_id=doc['chat_id'],  msg_ids=doc['msg_ids'])
-            prompt = llm.build_rag_prompt(question, chat_description=cfg.chat_description, messages=msgs)
-            logging.info(prompt)
-            answer = llm.ask_llm(prompt, self.llm_model)
-            return answer
+            logging.info(f'got result of knn search score={ret[0]["score"]}')
+            return ret[0]['doc']
 
+    def rag_by_topic(self, question: str, topic: Dict) -> str:
+        prompt, _ = self.topic_prompt(question, topic)
+        with stage('llm'):
+            answer = self.ask_llm(prompt, self.llm_model)
+        return answer
+
+    @answer_cache.cached()
+    @llm_accounting.scope('rag_by_simple_search', hard_limit=cfg.llm_query_budget_usd)
     def rag_by_simple_search(self, question: str, tags: str) -> str:
         """rag_by_simple_search (non semantic search, just by words comparison by letters)
 
@@ -56,13 +82,25 @@ class RaguDuDu:
         Returns:
             str: answer to question using search results as context
         """
+        return self.rag_by_messages(question=question, msg_ids=self.find_by_simple_search(tags))
+
+    def topic_prompt(self, question: str, topic: Dict) -> Tuple[str, List[TelegaMessage]]:
+        msgs = es.get_messages_by_id(chat_id=topic['chat_id'],  msg_ids=topic['msg_ids'])
+        note_retrieved(topic['msg_ids'])
+        with stage('prompt'):
+            prompt = llm.build_rag_prompt(question, chat_description=cfg.chat_description, messages=msgs)
+        logging.info(prompt)
+        return prompt, msgs
+
+    def find_by_simple_search(self, tags: str) -> List[int]:
         search_field = 'msg_text'
         ed_lst = es.simple_search(search_term=tags, index_name=cfg.index_name_messages, search_field=search_field, size=30, min_score=5)
         logging.info(f'got {len(ed_lst)} documents from ES')
         #  msgs = [TelegaMessage(**md[1]) for md in ed_lst]
-        msg_ids = [md[1]['msg_id'] for md in ed_lst]
-        return self.rag_by_messages(question=question, msg_ids=msg_ids)
-    
+        return [md[1]['msg_id'] for md in ed_lst]
+
+    @answer_cache.cached()
+    @llm_accounting.scope('rag_by_dense_vector_search', hard_limit=cfg.llm_query_budget_usd)
     def rag_by_dense_vector_search(self, question: str) -> str:
         """ RAG by semantic search using dense vector index for english translation for the messages
 
@@ -72,49 +110,168 @@ class RaguDuDu:
         Returns:
             str: answer to question using search results as context
         """
+        return self.rag_by_messages(question=question, msg_ids=self.find_by_dense_vector_search(question))
+
+    def find_by_dense_vector_search(self, question: str) -> List[int]:
         search_field = 'msg_text_vector'
         ed_lst = es.knn_vector_search(search_term=question, index_name=cfg.index_name_messages_eng, search_field=search_field,
                                       number_of_docs=5, min_score=0.5)
         logging.info(f'got {len(ed_lst)} documents from ES')
-        msg_ids = [md['doc']['msg_id'] for md in ed_lst]
-        return self.rag_by_messages(question=question, msg_ids=msg_ids)
-    
+        return [md['doc']['msg_id'] for md in ed_lst]
+
+    @answer_cache.cached()
+    @llm_accounting.scope('rag_by_hybrid_search', hard_limit=cfg.llm_query_budget_usd)
+    def rag_by_hybrid_search(self, question: str, tags: str = None, number_of_docs: int = 5) -> str:
+        """RAG by BM25 search in original messages and semantic search in translated ones, fused by reciprocal rank
+
+        Args:
+            question (str): question to RAG system
+            tags (str, optional): words for BM25 search, in the language of the chat. Defaults to question.
+            number_of_docs (int, optional): messages to build context around. Defaults to 5.
+
+        Returns:
+            str: answer to question using search results as context
+        """
+        return self.rag_by_messages(question=question, msg_ids=self.find_by_hybrid_search(question, tags, number_of_docs))
+
+    def find_by_hybrid_search(self, question: str, tags: str = None, number_of_docs: int = 5) -> List[int]:
+        ed_lst = es.fused_hybrid_search(search_term=question, text_search_term=tags, size=number_of_docs)
+        logging.info(f'got {len(ed_lst)} documents from ES')
+        return [md['doc']['msg_id'] for md in ed_lst]
+
     def rerank(self,  docs: Iterable, query: str):
-        cross_encoder = CrossEncoderRanker(model_name='cross-encoder/ms-marco-MiniLM-L-12-v2')
-        answers = [x['doc']['msg_text'] for x in docs] 
-        reranking_scores = cross_encoder.predict(question=query, answers=answers)
-        for d, s in zip(docs, reranking_scores):
-            d['reranked_score'] = s
-        docs.sort(key=lambda x: x["reranked_score"], reverse=True)
+        with stage('rerank'):
+            reranker_engine.rerank(docs, query)
 
+    @answer_cache.cached()
+    @llm_accounting.scope('rag_reranked', hard_limit=cfg.llm_query_budget_usd)
     def rag_reranked(self, question: str, number_of_docs_initial: int = 10, number_of_doc_for_rag: int = 5) -> str:
+        msg_ids = self.find_reranked(question, number_of_docs_initial, number_of_doc_for_rag)
+        return self.rag_by_messages(question=question, msg_ids=msg_ids)
+
+    def find_reranked(self, question: str, number_of_docs_initial: int = 10, number_of_doc_for_rag: int = 5) -> List[int]:
         knn_search_field = 'msg_text_vector'
         rag_candidates = es.knn_vector_search(search_term=question, search_field=knn_search_field, 
                                               index_name=cfg.index_name_messages_eng, number_of_docs=number_of_docs_initial)
         self.rerank(docs=rag_candidates, query=question)
-        msg_ids = [md['doc']['msg_id'] for md in rag_candidates[0: number_of_doc_for_rag]]
-        return self.rag_by_messages(question=question, msg_ids=msg_ids)
+        return [md['doc']['msg_id'] for md in rag_candidates[0: number_of_doc_for_rag]]
   
     
-    def rag_by_messages(self, question: str, msg_ids: List[int]) -> str:
-        topic_msgs_all = []
-        for msg_id in msg_ids:
+    def context_messages(self, msg_ids: List[int]) -> Tuple[List[TelegaMessage], Dict[int, float]]:
+        """topics around found messages, scored by rank of the found message, which itself is scored a bit higher than its topic"""
+        topic_msgs_all, msg_scores = [], dict()
+        for rank, msg_id in enumerate(msg_ids):
             tms = self.telegram_index.get_potential_topic(msg_id, max_depth_down=1, max_steps_up=1, take_in_direct_relatives=False)
             tms = [x for x in tms if x.msg_id not in [x.msg_id for x in topic_msgs_all]]
             topic_msgs_all.extend(tms)
-        prompt = llm.build_rag_prompt(question, chat_description=cfg.chat_description, messages=topic_msgs_all)
-        logging.info(f'len of prompt {len(prompt)} for {len(topic_msgs_all)} messages')
-        answer = llm.ask_llm(prompt, self.llm_model)
-        answer = llm.get_dict_from_llm_result(answer)
+            for x in tms:
+                msg_scores.setdefault(x.msg_id, len(msg_ids) - rank)
+            msg_scores[msg_id] = max(msg_scores.get(msg_id, 0), len(msg_ids) - rank + 0.5)
+        return topic_msgs_all, msg_scores
+
+    def rag_by_messages(self, question: str, msg_ids: List[int]) -> str:
+        prompt, _ = self.messages_prompt(question, msg_ids)
+        with stage('llm'):
+            answer = self.ask_llm(prompt, self.llm_model)
+            answer = llm.get_dict_from_llm_result(answer)
         return answer
 
+    def messages_prompt(self, question: str, msg_ids: List[int]) -> Tuple[str, List[TelegaMessage]]:
+        note_retrieved(msg_ids)
+        with stage('context'):
+            topic_msgs_all, msg_scores = self.context_messages(msg_ids)
+        with stage('prompt'):
+            prompt = llm.build_rag_prompt(question, chat_description=cfg.chat_description, messages=topic_msgs_all, msg_scores=msg_scores)
+        logging.info(f'len of prompt {len(prompt)} for {len(topic_msgs_all)} messages')
+        return prompt, topic_msgs_all
+
+    def retrieve(self, question: str, method: str, **kwargs) -> Tuple[str, List[TelegaMessage], List[int]]:
+        """prompt, its context messages and found msg_ids, as rag_* method builds them"""
+        if method == 'rag_by_topics':
+            topic = self.find_topic(question)
+            if not topic:
+                return None, [], []
+            prompt, msgs = self.topic_prompt(question, topic)
+            return prompt, msgs, topic['msg_ids']
+        finders = {'rag_by_simple_search': lambda: self.find_by_simple_search(kwargs['tags']),
+                   'rag_by_dense_vector_search': lambda: self.find_by_dense_vector_search(question),
+                   'rag_by_hybrid_search': lambda: self.find_by_hybrid_search(question, **kwargs),
+                   'rag_reranked': lambda: self.find_reranked(question, **kwargs)}
+        if method not in finders:
+            raise Exception(f'unknown rag method {method}')
+        msg_ids = finders[method]()
+        prompt, msgs = self.messages_prompt(question, msg_ids)
+        return prompt, msgs, msg_ids
+
+    def rag_stream(self, question: str, method: str = 'rag_by_dense_vector_search', **kwargs) -> Iterator[Dict]:
+        """_summary_
+        Streaming variant of rag_* methods, so UI shows found messages and the answer while LLM is still generating it.
+        Shares answer cache and LLM budget with the method.
+        Args:
+            question (str): question to RAG system
+            method (str, optional): name of rag_* method. Defaults to 'rag_by_dense_vector_search'.
+            kwargs: other arguments of the method, by name
+
+        Yields:
+            Dict: {'messages': List[TelegaMessage]} of the context first, then {'token': str} pieces of the answer text,
+                and {'answer': ...} the last one, the same as the method returns
+        """
+        func = getattr(type(self), method, None)
+        if func is None:
+            raise Exception(f'unknown rag method {method}')
+        params = method_params(func, self, question, (), kwargs)  # the same key as answer_cache.cached makes
+        entry = answer_cache.lookup(method, question, params) if cfg.answer_cache_enabled else None
+        if entry is not None:
+            yield {'messages': [x for x in map(self.telegram_index.get_message, entry['msg_ids']) if x is not None]}
+            answer = entry['answer']
+            # rag_by_topics keeps the answer unparsed, so its text is decoded the same way as while streaming
+            text = answer.get('answer') if isinstance(answer, dict) else llm.JsonFieldStream('answer').feed(answer or '')
+            if text:
+                yield {'token': text}
+            yield {'answer': answer}
+            return
+
+        started = time.perf_counter()
+        # each step runs in the context of the scope, but events are yielded outside of it,
+        # so the scope does not leak to the reader between events and an abandoned stream exits cleanly
+        with llm_accounting.scope(method, hard_limit=cfg.llm_query_budget_usd) as budget:
+            scope_context = contextvars.copy_context()
+        prompt, msgs, msg_ids = scope_context.run(self.retrieve, question, method, **kwargs)
+        yield {'messages': msgs}
+        if prompt is None:
+            yield {'answer': None}
+            return
+        pieces, answer_text = [], llm.JsonFieldStream('answer')
+        stream = scope_context.run(self.ask_llm_stream, prompt, self.llm_model)
+        try:
+            while True:
+                with stage('llm'):
+                    piece = scope_context.run(next, stream, None)
+                if piece is None:
+                    break
+                if not pieces:
+                    logging.info(f'first token in {time.perf_counter() - started:.2f}s')
+                pieces.append(piece)
+                text = answer_text.feed(piece)
+                if text:
+                    yield {'token': text}
+        finally:
+            if hasattr(stream, 'close'):
+                scope_context.run(stream.close)  # accounting of the stream releases its reservation in the scope
+        answer = ''.join(pieces)
+        if method != 'rag_by_topics':  # rag_by_topic returns the answer unparsed
+            answer = llm.get_dict_from_llm_result(answer)
+        if cfg.answer_cache_enabled:
+            answer_cache.store(method, question, answer, msg_ids, time.perf_counter() - started, budget.spent, params)
+        yield {'answer': answer}
+
 
 def sigmoid(logit: float) -> float:
     "Apply sigmoig function to logits from model in order to have score from 0 to 1."
     return 1 / (1 + math.exp(-logit))
 
 
-class CrossEncoderRanker:
+class CrossEncoderRanker:  # model per instance, kept as baseline for benchmark of reranker.RerankerEngine
     def __init__(self, model_name: str, max_length: int = 512) -> None:
         self.model = CrossEncoder(model_name, max_length=max_length)
 
@@ -124,38 +281,62 @@ class CrossEncoderRanker:
 
 
 def translate_messages(msgs: Iterable[TelegaMessage], out_dir: str,  max_tokens_count: int = 16000, overlapping_msgs_cnt: int = 0,
-                       llm_model=cfg.llm_model):
+                       llm_model=cfg.llm_model, budget_usd: float = None):
     """_summary_
 
     Args:
         msgs (List[TelegaMessage]): telegram msgs l
-        max_tokens_count (int, optional): Tokens per chunk. Defaults to 16000.
+        max_tokens_count (int, optional): Tokens per chunk, by tokenizer of llm_model. Defaults to 16000.
         overlapping_msgs_cnt (int, optional): number of overlapping msgs in the chunk. Defaults to 0.
+        budget_usd (float, optional): translation stops before spending more. Defaults to None - no limit.
     """
-    def output_chunk(chunk_messages: List[TelegaMessageIndex]):
-        json_str = json.dumps(chunk_messages, indent=4, ensure_ascii=False) 
-        chunk_min_msg_id, chunk_max_msg_id = chunk_messages[0]["msg_id"], chunk_messages[-1]["msg_id"] 
-        print(f'chunk is ready for {len(chunk_messages)} msgs: {chunk_min_msg_id}-{chunk_max_msg_id}, {chunk_symbols_count=}') 
-        prompt = llm.build_translation_prompt(json_str)
-        ret_llm = llm.ask_llm(prompt=prompt, llm_model=llm_model)
+    def msg_dicts():
+        for msg in msgs:
+            #  todo - think about replyto to keep context for translation
+            msg_dic = {'msg_id': msg.msg_id, 'user_name': msg.user_name, 'msg_text': msg.msg_text}
+            if msg.reply_to_msg_id:
+                msg_dic['reply_to_msg_id'] = msg.reply_to_msg_id
+            yield msg_dic
+
+    chunks = chunk_messages(msg_dicts(), max_tokens_count, overlapping_msgs_cnt, count_tokens=get_token_counter(llm_model))
+    with llm_accounting.scope('translation', hard_limit=budget_usd, budget_name='translation job'):
+        if llm.run_sync(_translate_chunks(chunks, out_dir, llm_model)):
+            logging.warning(f'translation is stopped by budget of {budget_usd} USD')
+
+
+async def _translate_chunks(chunks: Iterable[List[Dict]], out_dir: str, llm_model: str = cfg.llm_model,
+                            max_concurrency: int = cfg.llm_max_concurrency) -> bool:
+    """translates chunks by one client, keeping max_concurrency of them in flight, so a slow chunk does not hold the others;
+    returns True if it is stopped by budget"""
+    llm_client = llm.AsyncLLMClient(model=llm_model, max_concurrency=max_concurrency)
+    chunks, in_flight, budget_exceeded = iter(chunks), dict(), False  # in_flight: task -> chunk
+    try:
+        while True:
+            while not budget_exceeded and len(in_flight) < max_concurrency:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                in_flight[asyncio.ensure_future(llm_client.ask(llm.build_translation_prompt(chunk_to_json(chunk))))] = chunk
+            if not in_flight:
+                return budget_exceeded
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                answer = task.exception() or task.result()
+                budget_exceeded = budget_exceeded or isinstance(answer, BudgetExceeded)
+                _write_translated_chunks([in_flight.pop(task)], [answer], out_dir)
+    finally:
+        for task in in_flight:
+            task.cancel()
+        await llm_client.close()
+
+
+def _write_translated_chunks(chunks: List[List[Dict]], answers: List, out_dir: str):
+    for chunk, ret_llm in zip(chunks, answers):
+        out_fn = f'{out_dir}/messages{chunk[0]["msg_id"]}-{chunk[-1]["msg_id"]}.json'
+        if isinstance(ret_llm, Exception):
+            logging.error(f'translation failed for {out_fn}: {ret_llm}')
+            continue
         ret_llm = ret_llm.replace('```json', '').replace('```', '')
-        out_fn = f'{out_dir}/messages{chunk_min_msg_id}-{chunk_max_msg_id}.json'
         with open(out_fn, "w") as outfile:
             outfile.write(ret_llm)
-            print(f'data written to {out_fn}')
-        
-    chunk_msgs, chunk_symbols_count = [], 0
-    letters_per_token = 2  # &?
-    for msg in msgs:
-        #  todo - think about replyto to keep context for translation
-        msg_dic = {'msg_id': msg.msg_id, 'user_name': msg.user_name, 'msg_text': msg.msg_text}
-        if msg.reply_to_msg_id:
-            msg_dic['reply_to_msg_id'] = msg.reply_to_msg_id
-        msg_symbols_count = len(str(msg_dic))
-        if (chunk_symbols_count + msg_symbols_count) / letters_per_token > max_tokens_count:  # approximate tokens count
-            output_chunk(chunk_msgs)
-            chunk_msgs = chunk_msgs[-overlapping_msgs_cnt:]
-        chunk_msgs.append(msg_dic)
-        chunk_symbols_count = len(str(chunk_msgs))
-    if len(chunk_msgs) > overlapping_msgs_cnt:   
-        output_chunk(chunk_msgs)
\ No newline at end of file
+            print(f'data written to {out_fn} for {len(chunk)} msgs')
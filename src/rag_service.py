@@ -0,0 +1,456 @@
+"""Long-lived asyncio HTTP service answering questions by RaguDuDu, with warm index and models,
+micro-batched question embeddings and admission control.
+
+python -m src.rag_service --local --fake-llm
+python -m src.rag_service --local --fake-llm --load-test 500 --concurrency 32
+
+POST /<method> with json of its arguments, e.g. POST /rag_by_dense_vector_search {"question": "..."}
+POST /rag_stream {"question": "...", "method": "rag_by_dense_vector_search"} - json lines of rag_stream events
+GET /health, GET /stats
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+from pydantic import BaseModel
+
+import src.config as cfg
+from src.answer_cache import answer_cache
+from src.embeddings import EmbeddingService, embedding_service
+from src.llm_accounting import llm_accounting
+from src.rag_integration import RaguDuDu
+from src.reranker import reranker_engine
+
+service_methods = ('rag_by_topics', 'rag_by_simple_search', 'rag_by_dense_vector_search', 'rag_by_hybrid_search', 'rag_reranked',
+                   'find_topic', 'find_by_simple_search', 'find_by_dense_vector_search', 'find_by_hybrid_search', 'find_reranked')
+http_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error',
+                503: 'Service Unavailable'}
+
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode='json')
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj)} is not serializable')
+
+
+def to_json_bytes(obj) -> bytes:
+    return json.dumps(obj, default=_json_default, ensure_ascii=False).encode()
+
+
+class QuestionBatcher:
+    """_summary_
+    Collects questions of concurrent queries for batch_window seconds, or until there are max_batch of them,
+    and encodes them by one encode_queries call. Their vectors get to the query cache of the encoder,
+    where searches and answer cache take them from, so the model is called once per batch instead of once per query.
+    Args:
+        encoder (EmbeddingService, optional): Defaults to embedding_service.
+        batch_window (float, optional): seconds. Defaults to cfg.rag_service_batch_window.
+        max_batch (int, optional): Defaults to cfg.rag_service_max_batch.
+    """
+
+    def __init__(self, encoder: EmbeddingService = None, batch_window: float = cfg.rag_service_batch_window,
+                 max_batch: int = cfg.rag_service_max_batch):
+        self.encoder = encoder or embedding_service
+        self.batch_window, self.max_batch = batch_window, max_batch
+        self._executor = ThreadPoolExecutor(1)  # model calls do not run in parallel anyway
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle = None
+        self._tasks = set()
+        self.batches = self.questions = 0
+
+    async def encode(self, question: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((question, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            self.questions += len(batch)
+            task = asyncio.ensure_future(self._encode_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _encode_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(self._executor, self.encoder.encode_queries, [q for q, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    def stats(self) -> Dict:
+        return {'batches': self.batches, 'questions': self.questions,
+                'mean_batch_size': self.questions / self.batches if self.batches else 0.0}
+
+
+class RagService:
+    """_summary_
+    Answers queries by methods of one RaguDuDu instance, built at start, with embedding model and reranker warmed up.
+    Up to workers queries are processed at once, in threads. Up to max_queue more wait for a worker,
+    no longer than queue_timeout. The rest are rejected with 503, so overload does not grow latency of accepted queries.
+    Args:
+        rg (RaguDuDu): RAG system
+        workers (int, optional): Defaults to cfg.rag_service_workers.
+        max_queue (int, optional): Defaults to cfg.rag_service_max_queue.
+        queue_timeout (float, optional): seconds. Defaults to cfg.rag_service_queue_timeout.
+        batcher (QuestionBatcher, optional): Defaults to QuestionBatcher with limits from config.
+        warm_reranker (bool, optional): to load reranker model at start. Defaults to True.
+    """
+
+    def __init__(self, rg: RaguDuDu, workers: int = cfg.rag_service_workers, max_queue: int = cfg.rag_service_max_queue,
+                 queue_timeout: float = cfg.rag_service_queue_timeout, batcher: QuestionBatcher = None, warm_reranker: bool = True):
+        self.rg = rg
+        self.workers, self.max_queue, self.queue_timeout = workers, max_queue, queue_timeout
+        self.batcher = batcher or QuestionBatcher()
+        if warm_reranker:
+            reranker_engine.warm_up()
+        self._executor = ThreadPoolExecutor(workers)
+        self._slots = asyncio.Semaphore(workers)
+        self.waiting = self.in_flight = 0
+        self.requests = self.rejected = self.errors = 0
+        self.latencies: Deque[float] = deque(maxlen=10000)  # seconds of last answered queries
+        self.started = time.time()
+        self._server = None
+
+    async def _acquire_slot(self):
+        """admission control: waits for a worker, or raises 503 if the queue is full or the wait is too long"""
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise ServiceError(503, f'{self.waiting} queries are waiting already')
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise ServiceError(503, f'no worker for {self.queue_timeout}s')
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    @contextlib.asynccontextmanager
+    async def _admitted(self, params: Dict):
+        """query holds a worker inside, its question is embedded while it waits, together with questions of other queries"""
+        self.requests += 1
+        started = time.perf_counter()
+        vector = None
+        if isinstance(params.get('question'), str):
+            vector = asyncio.ensure_future(self.batcher.encode(params['question']))
+        try:
+            await self._acquire_slot()
+        except ServiceError:
+            if vector is not None:
+                vector.cancel()
+            raise
+        try:
+            if vector is not None:
+                await vector
+            yield
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self._release_slot()
+        self.latencies.append(time.perf_counter() - started)
+
+    def _method(self, method: str, params: Dict, prefix: str = ''):
+        if method not in service_methods or not method.startswith(prefix):
+            raise ServiceError(404, f'unknown method {method}')
+        func = getattr(self.rg, method)
+        try:
+            inspect.signature(func).bind(**params)
+        except TypeError as e:
+            raise ServiceError(400, f'{method}: {e}')
+        return func
+
+    async def call(self, method: str, params: Dict):
+        """result of RaguDuDu method by name, with arguments by name"""
+        func = self._method(method, params)
+        async with self._admitted(params):
+            # own context per query, as llm_accounting budgets and perf stages are kept in context variables
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, contextvars.copy_context().run, functools.partial(func, **params))
+
+    async def stream(self, params: Dict, write_event: Callable[[Dict], Awaitable]):
+        """passes rag_stream events to write_event as soon as worker thread produces them"""
+        params = dict(params)
+        method = params.pop('method', 'rag_by_dense_vector_search')
+        self._method(method, params, prefix='rag_')
+        loop, queue, done = asyncio.get_running_loop(), asyncio.Queue(), object()
+
+        def produce():
+            try:
+                for event in self.rg.rag_stream(method=method, **params):
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            except Exception as e:
+                logging.exception(f'rag_stream failed for {params}')
+                loop.call_soon_threadsafe(queue.put_nowait, {'error': repr(e)})
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        async with self._admitted(params):
+            produced = loop.run_in_executor(self._executor, contextvars.copy_context().run, produce)
+            while True:
+                event = await queue.get()
+                if event is done:
+                    break
+                await write_event(event)
+            await produced
+
+    def stats(self) -> Dict:
+        latencies = np.asarray(self.latencies) * 1000
+        ret = {'uptime': time.time() - self.started, 'requests': self.requests, 'rejected': self.rejected, 'errors': self.errors,
+               'in_flight': self.in_flight, 'waiting': self.waiting, 'batching': self.batcher.stats(),
+               'embeddings': self.batcher.encoder.stats(), 'answer_cache': answer_cache.stats(), 'llm': llm_accounting.summary()}
+        if len(latencies):
+            ret['latency_ms'] = {'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95)),
+                                 'p99': float(np.percentile(latencies, 99)), 'mean': float(latencies.mean())}
+        return ret
+
+    async def start(self, host: str = cfg.rag_service_host, port: int = cfg.rag_service_port) -> int:
+        """starts listening, returns port, which is chosen by OS for port 0"""
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        logging.info(f'RAG service is listening on {host}:{port}')
+        return port
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self._executor.shutdown(wait=False)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP/1.1 with keep-alive, json bodies of known length only"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                http_method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                length = int(headers.get('content-length') or 0)
+                if length > cfg.rag_service_max_body:
+                    await self._respond(writer, 413, {'error': f'body is longer than {cfg.rag_service_max_body} bytes'}, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                await self._dispatch(http_method, path.split('?')[0].strip('/'), body, writer, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, http_method: str, path: str, body: bytes, writer: asyncio.StreamWriter, keep_alive: bool):
+        try:
+            if http_method == 'GET' and path == 'health':
+                return await self._respond(writer, 200, {'status': 'ok'}, keep_alive)
+            if http_method == 'GET' and path == 'stats':
+                return await self._respond(writer, 200, self.stats(), keep_alive)
+            if http_method != 'POST':
+                raise ServiceError(404, f'{http_method} /{path} is not served')
+            try:
+                params = json.loads(body or b'{}')
+            except json.JSONDecodeError as e:
+                raise ServiceError(400, f'body is not json: {e}')
+            if not isinstance(params, dict):
+                raise ServiceError(400, 'body should be json object of method arguments')
+            if path == 'rag_stream':
+                return await self._respond_stream(writer, params, keep_alive)
+            started = time.perf_counter()
+            result = await self.call(path, params)
+            await self._respond(writer, 200, {'result': result, 'latency_ms': (time.perf_counter() - started) * 1000}, keep_alive)
+        except ServiceError as e:
+            await self._respond(writer, e.status, {'error': str(e)}, keep_alive, retry_after=e.status == 503)
+        except Exception as e:
+            logging.exception(f'{http_method} /{path} failed')
+            await self._respond(writer, 500, {'error': repr(e)}, keep_alive)
+
+    @staticmethod
+    def _head(status: int, headers: Dict[str, str], keep_alive: bool) -> bytes:
+        headers = {**headers, 'Connection': 'keep-alive' if keep_alive else 'close'}
+        lines = [f'HTTP/1.1 {status} {http_reasons.get(status, "")}'] + [f'{k}: {v}' for k, v in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool, retry_after: bool = False):
+        body = to_json_bytes(payload)
+        headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+        if retry_after:
+            headers['Retry-After'] = '1'
+        writer.write(self._head(status, headers, keep_alive) + body)
+        await writer.drain()
+
+    async def _respond_stream(self, writer: asyncio.StreamWriter, params: Dict, keep_alive: bool):
+        started = [False]
+
+        async def write_event(event: Dict):
+            if not started[0]:
+                writer.write(self._head(200, {'Content-Type': 'application/x-ndjson', 'Transfer-Encoding': 'chunked'}, keep_alive))
+                started[0] = True
+            line = to_json_bytes(event) + b'\n'
+            writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+            await writer.drain()
+
+        await self.stream(params, write_event)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+async def http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, http_method: str, path: str,
+                       payload: Dict = None) -> Tuple[int, Dict]:
+    """one request over keep-alive connection, for responses with Content-Length"""
+    body = to_json_bytes(payload) if payload is not None else b''
+    writer.write(f'{http_method} {path} HTTP/1.1\r\nHost: rag\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers.get('content-length') or 0)) or b'{}')
+
+
+async def load_test(host: str, port: int, questions: List[str], requests: int, concurrency: int,
+                    method: str = 'rag_by_dense_vector_search') -> Dict:
+    """_summary_
+    Sends requests queries of questions in turn, from concurrency clients with own keep-alive connection each
+    Returns:
+        Dict: throughput in answered queries per second, latency percentiles in ms of answered queries, rejected and failed counts
+    """
+    from src.rag_benchmark import latency_percentiles
+    latencies, statuses, sent = [], [], iter(range(requests))
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for i in sent:
+                started = time.perf_counter()
+                status, _ = await http_request(reader, writer, 'POST', f'/{method}', {'question': questions[i % len(questions)]})
+                statuses.append(status)
+                if status == 200:
+                    latencies.append(time.perf_counter() - started)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    duration = time.perf_counter() - started
+    return {'requests': requests, 'concurrency': concurrency, 'method': method, 'duration': duration,
+            'throughput_rps': len(latencies) / duration, 'rejected': statuses.count(503),
+            'failed': len(statuses) - len(latencies) - statuses.count(503),
+            'latency_ms': latency_percentiles(latencies) if latencies else dict()}
+
+
+async def serve(rg: RaguDuDu, host: str, port: int, load_test_requests: int = None, concurrency: int = 16,
+                method: str = 'rag_by_dense_vector_search', questions: List[str] = None, **service_kwargs) -> Dict:
+    """runs service until it is stopped, or just for the load test if load_test_requests is given, then returns its results"""
+    service = RagService(rg, **service_kwargs)
+    port = await service.start(host, port)
+    try:
+        if not load_test_requests:
+            await service._server.serve_forever()
+            return dict()
+        results = await load_test(host, port, questions, load_test_requests, concurrency, method)
+        results['service'] = service.stats()
+        return results
+    finally:
+        await service.stop()
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=cfg.rag_service_host)
+    parser.add_argument('--port', type=int, default=cfg.rag_service_port)
+    parser.add_argument('--workers', type=int, default=cfg.rag_service_workers)
+    parser.add_argument('--max-queue', type=int, default=cfg.rag_service_max_queue)
+    parser.add_argument('--batch-window', type=float, default=cfg.rag_service_batch_window, help='seconds, 0 - no micro-batching')
+    parser.add_argument('--local', action='store_true', help='in-process stand-in of Elasticsearch instead of the cluster')
+    parser.add_argument('--fake-llm', action='store_true', help='answers by FakeLLM instead of OpenAI')
+    parser.add_argument('--fake-llm-latency', type=float, default=0.0, help='seconds of FakeLLM answer')
+    parser.add_argument('--load-test', type=int, metavar='REQUESTS', help='to send that many queries to the service and exit')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients of load test')
+    parser.add_argument('--method', default='rag_by_dense_vector_search', choices=service_methods, help='method of load test')
+    parser.add_argument('--ground-truth', default=cfg.ground_truth_path, help='questions of load test')
+    parser.add_argument('--output', help='json file of load test results. Defaults to timestamped file in cfg.benchmark_output_dir')
+    args = parser.parse_args(argv)
+
+    from src.rag_benchmark import FakeLLM, local_rag
+    ask_llm = FakeLLM(args.fake_llm_latency) if args.fake_llm else None
+    rg = local_rag(ask_llm) if args.local else RaguDuDu(ask_llm=ask_llm)
+    questions = None
+    if args.load_test:
+        with open(args.ground_truth, 'r') as f:
+            questions = [x['question'] for x in json.load(f)]
+    batcher = QuestionBatcher(batch_window=args.batch_window, max_batch=cfg.rag_service_max_batch if args.batch_window else 1)
+    results = asyncio.run(serve(rg, args.host, args.port, args.load_test, args.concurrency, args.method, questions,
+                                workers=args.workers, max_queue=args.max_queue, batcher=batcher))
+    if args.load_test:
+        output = args.output or os.path.join(cfg.benchmark_output_dir, f'rag_service_load_{datetime.now():%Y%m%d_%H%M%S}.json')
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4, default=_json_default)
+        latency = results['latency_ms']
+        print(f'{results["requests"]} queries by {results["concurrency"]} clients: {results["throughput_rps"]:.1f} queries/s, '
+              f'p50 {latency.get("p50", 0):.1f} ms  p95 {latency.get("p95", 0):.1f} ms  p99 {latency.get("p99", 0):.1f} ms, '
+              f'{results["rejected"]} rejected, {results["failed"]} failed, '
+              f'mean embedding batch {results["service"]["batching"]["mean_batch_size"]:.1f}')
+        print(f'results are written to {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
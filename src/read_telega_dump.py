@@ -1,18 +1,37 @@
 
 # %%
 import datetime
-from typing import Iterable, Dict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Dict, List, Tuple
+import os
 from tqdm import tqdm
 import pandas as pd
 import ijson
 
 from src.data_classes import TelegaMessage
-from src.config import telegram_group_id
+from src.config import telegram_group_id, dump_parse_batch_size
+from src.perf import gc_paused
+
+try:
+    import orjson as fast_json
+except ImportError:  # orjson is optional, std json is just slower
+    import json as fast_json
+
+try:
+    ijson_backend = ijson.get_backend('yajl2_c')
+except ImportError:
+    ijson_backend = ijson  # pure python backend, when C extension is not built for the platform
+
+# Telegram Desktop export is pretty printed with one space indent, so items of "messages" array start at two spaces
+messages_array_start = b'"messages": ['
+message_item_start = b'\n  {'
+messages_array_end = b'\n ]'
 
 
 def telega_dump_to_pandas(dump_path: str) -> pd.DataFrame:
     msgs = telega_dump_parse_essential(dump_path)
-    dd = (msg.model_dump for msg in msgs)
+    dd = (msg.model_dump() for msg in msgs)
     df = pd.DataFrame.from_dict(dd)
     return df
 
@@ -41,12 +60,106 @@ def __extract_message_data(msg) -> TelegaMessage:
                        user_name=msg.get('from'),
                        reply_to_msg_id=msg.get('reply_to_message_id'),
                        msg_text=text,
-                       chat_id=telegram_group_id
-                      )
+                       chat_id=telegram_group_id)
     return tm
 
 
-    
+def telega_dump_parse_fast(dump_path: str, validate: bool = False, workers: int = 1, reader: str = 'ijson') -> Iterable[TelegaMessage]:
+    """_summary_
+    Faster version of telega_dump_parse_essential with the same output
+    Args:
+        dump_path (str): path to json dump exported by Telegram Desktop
+        validate (bool, optional): pydantic validation of messages, not needed for trusted dumps. Defaults to False.
+        workers (int, optional): number of processes parsing byte ranges of messages array. Defaults to 1.
+        reader (str, optional): 'ijson' - streaming by ijson C backend, 'orjson' - whole file at once, faster but needs memory.
+
+    Returns:
+        Iterable[TelegaMessage]: messages in order of the dump
+    """
+    build = TelegaMessage if validate else TelegaMessage.model_construct
+    for rows in _parse_rows(dump_path, workers, reader):
+        # gc is paused only while a batch is built, never across yields to the caller
+        with gc_paused():
+            msgs = [build(**dict(zip(_message_fields, row))) for row in rows]
+        yield from msgs
+
+
+def _parse_rows(dump_path: str, workers: int, reader: str) -> Iterable[List[Tuple]]:
+    """batches of message rows (see _message_fields), service messages are skipped"""
+    if workers > 1:
+        chunks = _split_messages_array(dump_path, workers)
+        if chunks:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                yield from executor.map(_parse_messages_chunk, [dump_path] * len(chunks), chunks)
+            return
+        # layout of dump is not as expected, so there is no way to split it safely
+    if reader == 'orjson':
+        with open(dump_path, 'rb') as f, gc_paused():
+            rows = _extract_message_rows(fast_json.loads(f.read())['messages'])
+        yield rows
+        return
+    with open(dump_path, 'rb') as f:
+        raw_docs = ijson_backend.items(f, 'messages.item')
+        while True:
+            with gc_paused():
+                raw_batch = list(islice(raw_docs, dump_parse_batch_size))
+                rows = _extract_message_rows(raw_batch)
+            if not raw_batch:
+                return
+            yield rows
+
+
+_message_fields = ('msg_id', 'msg_date', 'user_id', 'user_name', 'reply_to_msg_id', 'msg_text', 'chat_id')
+
+
+def _extract_message_row(msg: Dict) -> Tuple:
+    tes = msg.get('text_entities')
+    text = ''.join([mp['text'] for mp in tes]) if tes else ''
+    return (msg['id'], datetime.datetime.fromisoformat(msg['date']), msg.get('from_id'), msg.get('from'),
+            msg.get('reply_to_message_id'), text, telegram_group_id)
+
+
+def _extract_message_rows(raw_docs: Iterable[Dict]) -> List[Tuple]:
+    return [_extract_message_row(msg) for msg in raw_docs if msg['type'] != 'service']
+
+
+def _split_messages_array(dump_path: str, chunks_count: int) -> List[Tuple[int, int]]:
+    """byte ranges of messages array, each starting at the beginning of some message; empty list if layout is unknown"""
+    size = os.path.getsize(dump_path)
+    with open(dump_path, 'rb') as f:
+        head = f.read(1 << 20)
+        array_pos = head.find(messages_array_start)
+        if array_pos < 0 or head.find(message_item_start, array_pos) != array_pos + len(messages_array_start):
+            return []
+        f.seek(max(size - (1 << 20), 0))
+        tail = f.read()
+        end_pos = tail.rfind(messages_array_end)
+        if end_pos < 0:
+            return []
+        end = size - len(tail) + end_pos
+        bounds = [array_pos + len(messages_array_start)]
+        for i in range(1, chunks_count):
+            f.seek(max(bounds[0] + (end - bounds[0]) * i // chunks_count, bounds[-1] + 1))
+            block = f.read(1 << 20)
+            pos = block.find(message_item_start)
+            if pos < 0:
+                break
+            start = f.tell() - len(block) + pos
+            if start >= end:
+                break
+            bounds.append(start)
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parse_messages_chunk(dump_path: str, byte_range: Tuple[int, int]) -> List[Tuple]:
+    start, end = byte_range
+    with open(dump_path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start).strip().rstrip(b',')
+    with gc_paused():
+        return _extract_message_rows(fast_json.loads(b'[' + chunk + b']'))
+
 
 # %%df
 
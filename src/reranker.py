@@ -0,0 +1,133 @@
+"""Process-wide cross-encoder reranker with cache of (query, doc) scores."""
+
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+import logging
+import threading
+
+import numpy as np
+
+import src.config as cfg
+from src.embeddings import normalize_query
+
+
+def sigmoid(logits: np.ndarray) -> np.ndarray:
+    """Apply sigmoid function to logits from model in order to have scores from 0 to 1."""
+    return 1 / (1 + np.exp(-np.asarray(logits, dtype=np.float64)))
+
+
+class OnnxCrossEncoder:
+    """predict() of CrossEncoder over ONNX Runtime session, needs optimum[onnxruntime] installed"""
+
+    def __init__(self, model_name: str, max_length: int):
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        from transformers import AutoTokenizer
+        self.model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.max_length = max_length
+
+    def predict(self, pairs: List[Tuple[str, str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        logits = []
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            features = self.tokenizer([q for q, _ in batch], [a for _, a in batch], padding=True, truncation=True,
+                                      max_length=self.max_length, return_tensors='np')
+            logits.append(np.asarray(self.model(**features).logits).reshape(-1))
+        return np.concatenate(logits) if logits else np.empty(0)
+
+
+class RerankerEngine:
+    """Loads cross-encoder once per process and keeps LRU cache of relevance scores
+
+    Args:
+        model_name (str, optional): Defaults to cfg.reranker_model_name.
+        max_length (int, optional): max tokens of (query, doc) pair. Defaults to cfg.reranker_max_length.
+        batch_size (int, optional): pairs per forward pass. Defaults to cfg.reranker_batch_size.
+        backend (str, optional): 'torch', 'int8' - torch with dynamically quantized linear layers, 'onnx'. Defaults to cfg.reranker_backend.
+        max_cache_size (int, optional): max number of cached scores. Defaults to cfg.reranker_cache_size.
+        model_loader (Callable, optional): factory, that creates model with predict(pairs, batch_size) returning logits.
+    """
+
+    def __init__(self, model_name: str = cfg.reranker_model_name, max_length: int = cfg.reranker_max_length,
+                 batch_size: int = cfg.reranker_batch_size, backend: str = cfg.reranker_backend,
+                 max_cache_size: int = cfg.reranker_cache_size, model_loader: Callable = None):
+        self.model_name, self.max_length, self.batch_size, self.backend = model_name, max_length, batch_size, backend
+        self.max_cache_size = max_cache_size
+        self._model_loader = model_loader
+        self._model = None
+        self._cache: OrderedDict[Tuple[str, str], float] = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    logging.info(f'loading cross encoder {self.model_name} for {self.backend} backend')
+                    self._model = self._load_model()
+        return self._model
+
+    def _load_model(self):
+        if self._model_loader:
+            return self._model_loader(self.model_name)
+        if self.backend == 'onnx':
+            return OnnxCrossEncoder(self.model_name, self.max_length)
+        import torch
+        from sentence_transformers import CrossEncoder  # heavy import, so postpone it until model is really needed
+        model = CrossEncoder(self.model_name, max_length=self.max_length, default_activation_function=torch.nn.Identity())
+        if self.backend == 'int8':
+            model.model = torch.quantization.quantize_dynamic(model.model.to('cpu'), {torch.nn.Linear}, dtype=torch.qint8)
+            model._target_device = torch.device('cpu')
+        elif self.backend != 'torch':
+            raise Exception(f'unknown reranker backend {self.backend}')
+        return model
+
+    def warm_up(self):
+        self.predict('warm up', ['warm up'])
+
+    def predict(self, question: str, answers: List[str]) -> List[float]:
+        """relevance scores from 0 to 1 of answers to question, only pairs missing in cache go to the model"""
+        query = normalize_query(question)
+        scores = [None] * len(answers)
+        to_score = dict()  # answer -> positions
+        with self._lock:
+            for i, answer in enumerate(answers):
+                score = self._cache.get((query, answer))
+                if score is None:
+                    to_score.setdefault(answer, []).append(i)
+                else:
+                    self._cache.move_to_end((query, answer))
+                    scores[i] = score
+            self.hits += len(answers) - sum(len(x) for x in to_score.values())
+            self.misses += len(to_score)
+        if to_score:
+            new_answers = list(to_score)
+            logits = self.get_model().predict([(query, a) for a in new_answers], batch_size=self.batch_size)
+            new_scores = sigmoid(logits).reshape(-1).tolist()
+            with self._lock:
+                for answer, score in zip(new_answers, new_scores):
+                    for i in to_score[answer]:
+                        scores[i] = score
+                    self._cache[(query, answer)] = score
+                    self._cache.move_to_end((query, answer))
+                while len(self._cache) > self.max_cache_size:
+                    self._cache.popitem(last=False)
+        return scores
+
+    def rerank(self, docs: List[Dict], query: str, text_getter: Callable[[Dict], str] = lambda x: x['doc']['msg_text']):
+        """sorts search results in place by 'reranked_score'"""
+        for d, s in zip(docs, self.predict(query, [text_getter(x) for x in docs])):
+            d['reranked_score'] = s
+        docs.sort(key=lambda x: x['reranked_score'], reverse=True)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self._cache)}
+
+
+reranker_engine = RerankerEngine()
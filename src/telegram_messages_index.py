@@ -1,11 +1,68 @@
 
-from typing import List, Tuple, Dict, Set
+from typing import List, Tuple, Dict, Set, Optional, Iterator, Iterable
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from collections.abc import MutableMapping
+from datetime import datetime
 from math import inf
+import hashlib
 import logging
+import os
+import pickle
 
 import src.config as cfg
 from src.data_classes import TelegaMessage
+from src.read_telega_dump import telega_dump_parse_fast
+from src.perf import gc_paused
+
+SNAPSHOT_VERSION = 5
+message_columns = ('msg_id', 'msg_date', 'user_id', 'user_name', 'chat_id', 'reply_to_msg_id', 'msg_text')
+
+
+class LazyMessageDict(MutableMapping):
+    """Dict[int, TelegaMessage] over columns of snapshot, creating TelegaMessage only for the messages been asked for"""
+
+    def __init__(self, columns: Tuple[List, ...]):
+        self._columns = columns
+        self._rows = {msg_id: row for row, msg_id in enumerate(columns[0])}
+        self._materialized: Dict[int, TelegaMessage] = dict()
+
+    def __getitem__(self, msg_id: int) -> TelegaMessage:
+        msg = self._materialized.get(msg_id)
+        if msg is None:
+            row = self._rows[msg_id]
+            msg = TelegaMessage.model_construct(**{c: col[row] for c, col in zip(message_columns, self._columns)})
+            self._materialized[msg_id] = msg
+        return msg
+
+    def __setitem__(self, msg_id: int, msg: TelegaMessage):
+        self._materialized[msg_id] = msg
+
+    def __delitem__(self, msg_id: int):
+        self._materialized.pop(msg_id, None)
+        self._rows.pop(msg_id, None)
+
+    def __contains__(self, msg_id) -> bool:
+        return msg_id in self._rows or msg_id in self._materialized
+
+    def __iter__(self) -> Iterator[int]:
+        yield from self._rows
+        yield from (msg_id for msg_id in self._materialized if msg_id not in self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows) + sum(1 for msg_id in self._materialized if msg_id not in self._rows)
+
+
+def dump_signature(dump_path: str, with_hash: bool = False) -> Tuple:
+    st = os.stat(dump_path)
+    content_hash = None
+    if with_hash:
+        sha = hashlib.sha1()
+        with open(dump_path, 'rb') as f:
+            while chunk := f.read(1 << 24):
+                sha.update(chunk)
+        content_hash = sha.hexdigest()
+    return st.st_size, st.st_mtime_ns, content_hash
 
 
 class TelegaMessageIndex:
@@ -13,27 +70,183 @@ class TelegaMessageIndex:
         self.msdg_ids = dict()  # Dict[int, TelegaMessage]
         self.reply_to_msg_ids = defaultdict(set)  # Dict[int, Set[int]] # set of child messages ids
         self.msg_date_ids = defaultdict(set)  # Dict[int, Set[int]] # set of child messages ids
-        self.topics: Dict[int, Set[int]] = dict()
+        self.date_index: List[Tuple[datetime, int]] = []  # (msg_date, msg_id), sorted lazily, see sorted_date_index
+        self._date_index_sorted = True
+        # topics as disjoint-set forest over msg ids linked by reply_to_msg_id, missing parents are kept as placeholder nodes
+        self._topic_parent: Dict[int, int] = dict()
+        self._topic_set_size: Dict[int, int] = dict()  # set representative -> number of nodes, for union by size
+        self._topic_top: Dict[int, int] = dict()  # set representative -> topic starting msg id
+        self._topic_msgs_count: Dict[int, int] = dict()  # set representative -> number of messages in the index
+        self._topics: Optional[Dict[int, Set[int]]] = None  # built on first access of topics, dropped by add_item
 
     def add_item(self, msg: TelegaMessage):
         if msg.msg_id not in self.msdg_ids:  # i assume no need to clear data if item already in the index 
             self.msdg_ids[msg.msg_id] = msg
+            self._topics = None
             if msg.reply_to_msg_id:
                 self.reply_to_msg_ids[msg.reply_to_msg_id].add(msg.msg_id)
             self.msg_date_ids[msg.msg_date].add(msg.msg_id)
-            tsmid = self.get_topic_starting_msg_id(msg)
-            if tsmid not in self.topics:
-                self.topics[tsmid] = {msg.msg_id}
-            else:
-                self.topics[tsmid].add(msg.msg_id)
+            date_key = (msg.msg_date, msg.msg_id)
+            if self.date_index and self.date_index[-1] > date_key:
+                self._date_index_sorted = False  # out of order message, so we will sort once on the next lookup
+            self.date_index.append(date_key)
+            self._topic_add_node(msg.msg_id)
+            self._topic_msgs_count[self._topic_find(msg.msg_id)] += 1
+            if msg.reply_to_msg_id:
+                self._topic_add_node(msg.reply_to_msg_id)
+                self._topic_union(msg.msg_id, msg.reply_to_msg_id)
+
+    def _topic_add_node(self, msg_id: int):
+        if msg_id not in self._topic_parent:
+            self._topic_parent[msg_id] = msg_id
+            self._topic_set_size[msg_id] = 1
+            self._topic_top[msg_id] = msg_id
+            self._topic_msgs_count[msg_id] = 0
+
+    def _topic_find(self, msg_id: int) -> int:
+        parent = self._topic_parent
+        root = msg_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[msg_id] != root:  # path compression
+            parent[msg_id], msg_id = root, parent[msg_id]
+        return root
+
+    def _topic_union(self, msg_id: int, reply_to_msg_id: int):
+        child_root, parent_root = self._topic_find(msg_id), self._topic_find(reply_to_msg_id)
+        if child_root == parent_root:  # cycle in replies, should not happen
+            return
+        top = self._topic_top[parent_root]  # whole subtree of the message goes under the topic of its parent
+        if self._topic_set_size[child_root] > self._topic_set_size[parent_root]:
+            child_root, parent_root = parent_root, child_root
+        self._topic_parent[child_root] = parent_root
+        self._topic_set_size[parent_root] += self._topic_set_size.pop(child_root)
+        self._topic_msgs_count[parent_root] += self._topic_msgs_count.pop(child_root)
+        self._topic_top.pop(child_root)
+        self._topic_top[parent_root] = top
+
+    def topic_of(self, msg_id: int) -> Optional[int]:
+        """id of topic starting message (might be absent in the index) for the message"""
+        if msg_id not in self._topic_parent:
+            return None
+        return self._topic_top[self._topic_find(msg_id)]
+
+    def topic_size(self, msg_id: int) -> int:
+        """number of messages in the index in the same topic as msg_id"""
+        if msg_id not in self._topic_parent:
+            return 0
+        return self._topic_msgs_count[self._topic_find(msg_id)]
+
+    def get_topic_roots(self, min_size: int = 1) -> List[Tuple[int, int]]:
+        """list of (topic starting msg id, number of messages in topic) for topics having at least min_size messages"""
+        return [(self._topic_top[root], cnt) for root, cnt in self._topic_msgs_count.items() if cnt >= min_size]
+
+    @property
+    def topics(self) -> Dict[int, Set[int]]:
+        """topic starting msg id -> msg ids of the topic, built once after the last add_item, so it is shared between callers"""
+        if self._topics is None:
+            topics = defaultdict(set)
+            for msg_id in self.msdg_ids:
+                topics[self.topic_of(msg_id)].add(msg_id)
+            self._topics = dict(topics)
+        return self._topics
+
+    @classmethod
+    def from_messages(cls, msgs: Iterable[TelegaMessage]) -> 'TelegaMessageIndex':
+        mi = cls()
+        with gc_paused():
+            for msg in msgs:
+                mi.add_item(msg)
+        return mi
+
+    @classmethod
+    def from_dump(cls, dump_path: str, snapshot_path: str = None, validate_hash: bool = cfg.snapshot_validate_hash) -> 'TelegaMessageIndex':
+        """_summary_
+        To build index from telegram dump, using on disk snapshot if it is still valid for the dump
+        Args:
+            dump_path (str): path to telegram json dump
+            snapshot_path (str, optional): path to snapshot file, snapshot is not used if not provided.
+            validate_hash (bool, optional): to check content hash of dump in addition to its size and mtime.
+
+        Returns:
+            TelegaMessageIndex: index with all messages from the dump
+        """
+        if snapshot_path:
+            mi = cls.load_snapshot(snapshot_path, dump_path, validate_hash)
+            if mi:
+                return mi
+        mi = cls.from_messages(telega_dump_parse_fast(dump_path, validate=cfg.dump_parse_validate, workers=cfg.dump_parse_workers))
+        if snapshot_path:
+            mi.save_snapshot(snapshot_path, dump_path, validate_hash)
+        return mi
+
+    def _snapshot_state(self) -> Dict:
+        msgs = self.msdg_ids.values()
+        return {'columns': tuple([getattr(msg, c) for msg in msgs] for c in message_columns),
+                'reply_to_msg_ids': self.reply_to_msg_ids,
+                'msg_date_ids': self.msg_date_ids,
+                'date_index': self.sorted_date_index(),
+                'topic_forest': (self._topic_parent, self._topic_set_size, self._topic_top, self._topic_msgs_count)}
+
+    def _restore_snapshot_state(self, state: Dict):
+        self.msdg_ids = LazyMessageDict(state['columns'])
+        self.reply_to_msg_ids = state['reply_to_msg_ids']
+        self.msg_date_ids = state['msg_date_ids']
+        self.date_index = state['date_index']
+        self._topic_parent, self._topic_set_size, self._topic_top, self._topic_msgs_count = state['topic_forest']
+
+    def save_snapshot(self, snapshot_path: str, dump_path: str = None, validate_hash: bool = cfg.snapshot_validate_hash):
+        state = self._snapshot_state()
+        state.update({'version': SNAPSHOT_VERSION, 'index_class': type(self).__name__,
+                      'dump_signature': dump_signature(dump_path, validate_hash) if dump_path else None})
+        os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+        tmp_path = f'{snapshot_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+        logging.info(f'snapshot of {len(self.msdg_ids)} messages saved to {snapshot_path}')
+
+    @classmethod
+    def load_snapshot(cls, snapshot_path: str, dump_path: str = None,
+                      validate_hash: bool = cfg.snapshot_validate_hash) -> Optional['TelegaMessageIndex']:
+        """returns None, if there is no snapshot, or it was made from another dump or by another version of the code"""
+        if not os.path.exists(snapshot_path):
+            return None
+        with gc_paused(), open(snapshot_path, 'rb') as f:  # snapshot is our own local cache file, so unpickling it is fine
+            state = pickle.load(f)
+        if state.get('version') != SNAPSHOT_VERSION or state.get('index_class') != cls.__name__:
+            logging.info(f'snapshot {snapshot_path} is of another version, ignoring it')
+            return None
+        if dump_path and state['dump_signature'] != dump_signature(dump_path, validate_hash):
+            logging.info(f'snapshot {snapshot_path} is stale for {dump_path}, ignoring it')
+            return None
+        mi = cls()
+        mi._restore_snapshot_state(state)
+        return mi
+
+    def sorted_date_index(self) -> List[Tuple[datetime, int]]:
+        if not self._date_index_sorted:
+            self.date_index.sort()  # timsort is close to linear for mostly ordered data
+            self._date_index_sorted = True
+        return self.date_index
+
+    def get_msg_ids_by_date_range(self, date_from: datetime, date_to: datetime) -> List[int]:
+        """ids of messages with date_from <= msg_date <= date_to, ordered by msg_date, msg_id"""
+        date_index = self.sorted_date_index()
+        start = bisect_left(date_index, (date_from,))
+        end = bisect_right(date_index, (date_to, inf))
+        return [msg_id for _, msg_id in date_index[start:end]]
 
     def get_message(self, msg_id: int) -> TelegaMessage:
         return self.msdg_ids.get(msg_id)
 
+    def get_children_ids(self, msg_id: int) -> Iterable[int]:
+        return self.reply_to_msg_ids.get(msg_id, ())
+
     def get_parent_messages(self, msg_id: int, max_steps: int = inf) -> List[TelegaMessage]:
         ret_lst = []
         step = 0
-        msg = self.msdg_ids.get(msg_id)
+        msg = self.get_message(msg_id)
         while msg and msg.reply_to_msg_id and step < max_steps:
             step += 1
             reply_to_msg_id = msg.reply_to_msg_id
@@ -46,22 +259,14 @@ class TelegaMessageIndex:
         return ret_lst
     
     def get_topic_starting_msg_id(self, msg: TelegaMessage, max_steps: int = 1000) -> int:
-        step = 0
-        topic_starting_msg_id = msg.msg_id
-        while msg and msg.reply_to_msg_id and step < max_steps:
-            step += 1
-            topic_starting_msg_id = msg.reply_to_msg_id
-            msg = self.get_message(topic_starting_msg_id)
-            if not msg:
-                pass  # todo figure out WTF
-                #  logging.warning(f'inconsistent data in index for reply_to_msg_id: {topic_starting_msg_id}')
-        return topic_starting_msg_id
+        """max_steps is accepted for compatibility and ignored, topic is found without walking the reply chain"""
+        return self.topic_of(msg.msg_id)
         
     def get_children_messages(self, msg_id: int, max_depth: int = inf) -> List[TelegaMessage]:
         descendants = []
 
         def dfs(parent_msg_id: int, tree_depth: int = 0):
-            for id in self.reply_to_msg_ids[parent_msg_id]:
+            for id in self.get_children_ids(parent_msg_id):
                 msg = self.get_message(id)
                 if not msg:
                     raise Exception(f'inconsistent data in index for id: {id}')
@@ -85,7 +290,7 @@ class TelegaMessageIndex:
         Returns:
             List[TelegaMessage]: _description_
         """
-        msg = self.msdg_ids.get(msg_id)
+        msg = self.get_message(msg_id)
         ancestors = self.get_parent_messages(msg_id, max_steps=max_steps_up)[::-1]  # reverting of order of list, topmost first
         descendants = self.get_children_messages(msg_id, max_depth=max_depth_down)
         direct_relatives = ancestors + [msg] + descendants
@@ -107,21 +312,18 @@ class TelegaMessageIndex:
         nm_nm = cfg.near_messages_number_of_messages_delta
         family_ids = {x.msg_id for x in family}
         family.sort(key=lambda x: x.msg_id)
-        family_candidates = []
+        candidate_ids = dict()  # used as ordered set
 
         for i, m in enumerate(family):
-            dt_interval = (m.msg_date - nm_td,  m.msg_date + nm_td)
             next_family_msg_id = family[i+1].msg_id if i < len(family) - 1 else None
             prev__family_msg_id = family[i-1].msg_id if i > 0 else 0
             msgs_interval = max(m.msg_id - nm_nm - 1, prev__family_msg_id), min(m.msg_id + nm_nm + 1, next_family_msg_id
                                                                                 if next_family_msg_id else m.msg_id + nm_nm)
             # as family candidates we are considering the messages some time before and after every explicit member of family
-            for _, msg_ids in filter(lambda itm: dt_interval[0] <= itm[0] <= dt_interval[1], self.msg_date_ids.items()):
-                for msg_id in filter(lambda msg_id: msgs_interval[0] < msg_id < msgs_interval[1] and msg_id not in family_ids, msg_ids):
-                    new_msg = self.msdg_ids[msg_id]
-                    if new_msg not in family_candidates:  # need to sort out why it happens
-                        family_candidates.append(new_msg)
-        return family_candidates
+            for msg_id in self.get_msg_ids_by_date_range(m.msg_date - nm_td,  m.msg_date + nm_td):
+                if msgs_interval[0] < msg_id < msgs_interval[1] and msg_id not in family_ids:
+                    candidate_ids[msg_id] = None
+        return [self.get_message(msg_id) for msg_id in candidate_ids]
 
     def get_potential_topic(self, topic_starting_message: int,  max_depth_down: int = inf, max_steps_up: int = inf,
                             take_in_direct_relatives: bool = False) -> List[TelegaMessage]:
@@ -0,0 +1,154 @@
+"""Bulk summarization of all chat topics to telegram-topics index, resumable by checkpoint file"""
+
+from contextlib import nullcontext
+from datetime import datetime
+from typing import Callable, Dict, List, Set
+import asyncio
+import json
+import logging
+import os
+import time
+
+import src.config as cfg
+import src.llm as llm
+from src.llm_accounting import BudgetExceeded, llm_accounting
+from src.telegram_messages_index import TelegaMessageIndex
+
+
+def select_topic_roots(msg_index: TelegaMessageIndex, min_size: int = cfg.topic_min_size,
+                       date_from: datetime = None, date_to: datetime = None) -> List[int]:
+    """ids of topic starting messages, for topics of min_size messages at least, started within the dates"""
+    roots, missing = [], 0
+    for root_id, _ in msg_index.get_topic_roots(min_size):
+        msg = msg_index.get_message(root_id)
+        if msg is None:  # topic replies to a message that is not in the dump
+            missing += 1
+            continue
+        if (date_from and msg.msg_date < date_from) or (date_to and msg.msg_date > date_to):
+            continue
+        roots.append(root_id)
+    if missing:
+        logging.info(f'{missing} topics are skipped as their starting messages are not in the index')
+    return sorted(roots)
+
+
+def read_done_topics(checkpoint_path: str) -> Set[int]:
+    done = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['topic_msg_id'])
+                except (ValueError, KeyError):
+                    pass  # line is cut by crash in the middle of writing
+    return done
+
+
+def index_topic_docs(docs: List[Dict]) -> Dict:
+    """bulk settings of the index are turned on once per run by summarize_topics, not by every flush"""
+    import src.elastic_search.es as es
+    return es.index_docs(docs, index_name=cfg.index_name_topics, recreate_index=False, bulk=True,
+                         bulk_settings=False)
+
+
+def topics_bulk_load():
+    import src.elastic_search.es as es
+    es.ensure_index(cfg.index_name_topics)
+    return es.bulk_load_settings(cfg.index_name_topics)
+
+
+def summarize_topics(msg_index: TelegaMessageIndex, min_size: int = cfg.topic_min_size,
+                     date_from: datetime = None, date_to: datetime = None,
+                     checkpoint_path: str = cfg.topics_checkpoint_path, llm_client: llm.AsyncLLMClient = None,
+                     index_docs: Callable[[List[Dict]], Dict] = index_topic_docs, flush_size: int = 20,
+                     budget_usd: float = None, soft_budget_usd: float = None) -> Dict:
+    """_summary_
+    Summarizes every topic by LLM concurrently and streams results to topics index.
+    Topics already in the checkpoint are skipped, so the job can be rerun after crash or with new messages.
+    Args:
+        msg_index (TelegaMessageIndex): index of chat messages
+        min_size (int, optional): min number of messages in topic. Defaults to cfg.topic_min_size.
+        date_from (datetime, optional): topics started earlier are skipped.
+        date_to (datetime, optional): topics started later are skipped.
+        checkpoint_path (str, optional): json lines of done topics. Defaults to cfg.topics_checkpoint_path.
+        llm_client (AsyncLLMClient, optional): Defaults to client with settings from config.
+        index_docs (Callable, optional): writes topic docs, returns index_docs like stats. Defaults to telegram-topics index,
+            with refresh and replicas turned off for the whole run.
+        flush_size (int, optional): number of topic docs per index_docs call. Defaults to 20.
+        budget_usd (float, optional): job stops before spending more. Defaults to None - no limit.
+        soft_budget_usd (float, optional): job is slowed down after spending more. Defaults to None - no limit.
+
+    Returns:
+        Dict: counts of done, skipped and failed topics, cost and throughput
+    """
+    with llm_accounting.scope('summarization', hard_limit=budget_usd, soft_limit=soft_budget_usd, budget_name='summarization job'), \
+            topics_bulk_load() if index_docs is index_topic_docs else nullcontext():
+        return llm.run_sync(_summarize_topics(msg_index, min_size, date_from, date_to, checkpoint_path, llm_client, index_docs,
+                                              flush_size))
+
+
+async def _summarize_topics(msg_index: TelegaMessageIndex, min_size: int, date_from: datetime, date_to: datetime,
+                            checkpoint_path: str, llm_client: llm.AsyncLLMClient, index_docs: Callable, flush_size: int) -> Dict:
+    started = time.perf_counter()
+    roots = select_topic_roots(msg_index, min_size, date_from, date_to)
+    done = read_done_topics(checkpoint_path)
+    todo = [x for x in roots if x not in done]
+    stats = {'topics': len(roots), 'skipped': len(roots) - len(todo), 'done': 0, 'failed': [], 'cost': 0.0, 'budget_exceeded': False}
+    logging.info(f'{len(todo)} topics to summarize, {stats["skipped"]} are already done')
+    own_client = llm_client is None
+    llm_client = llm_client or llm.AsyncLLMClient()
+
+    async def summarize(root_id: int):
+        try:
+            msgs = msg_index.get_potential_topic(root_id, max_steps_up=1)
+            prompt = llm.build_summarization_prompt(chat_description=cfg.chat_description, messages=msgs)
+            answer, cost = await llm_client.ask_with_cost(prompt)
+            doc = llm.get_dict_from_llm_result(answer)
+            doc['topic_msg_id'] = root_id
+            return root_id, doc, cost, None
+        except Exception as e:
+            return root_id, None, 0.0, e
+
+    async def flush(results: List):
+        index_stats = await asyncio.to_thread(index_docs, [doc for _, doc, _ in results])
+        failed_ids = {x['_id'] for x in index_stats.get('failed', [])}
+        with open(checkpoint_path, 'a') as f:
+            for root_id, doc, cost in results:
+                doc_id = ';'.join(str(doc.get(x)) for x in cfg.index_pk_fields[cfg.index_name_topics])
+                if doc_id in failed_ids:
+                    stats['failed'].append((root_id, 'not indexed'))
+                    continue
+                f.write(json.dumps({'topic_msg_id': root_id, 'topic_name': doc.get('topic_name'), 'cost': cost}, ensure_ascii=False) + '\n')
+                stats['done'] += 1
+        results.clear()
+
+    os.makedirs(os.path.dirname(checkpoint_path) or '.', exist_ok=True)
+    results = []
+    try:
+        for task in asyncio.as_completed([summarize(x) for x in todo]):
+            root_id, doc, cost, error = await task
+            stats['cost'] += cost
+            if isinstance(error, BudgetExceeded):
+                stats['budget_exceeded'] = True  # the topic is left for the next run
+                continue
+            if error is not None:
+                logging.warning(f'summarization of topic {root_id} failed: {error!r}')
+                stats['failed'].append((root_id, repr(error)))
+                continue
+            results.append((root_id, doc, cost))
+            if len(results) >= flush_size:
+                await flush(results)
+        if results:
+            await flush(results)
+    finally:
+        if own_client:
+            await llm_client.close()
+
+    stats['elapsed'] = time.perf_counter() - started
+    stats['topics_per_minute'] = 60 * stats['done'] / stats['elapsed'] if stats['elapsed'] else 0
+    stats['cost_per_topic'] = stats['cost'] / stats['done'] if stats['done'] else 0
+    if stats['budget_exceeded']:
+        logging.warning(f'LLM budget is reached, {len(todo) - stats["done"] - len(stats["failed"])} topics are left for the next run')
+    logging.info(f'summarized {stats["done"]} topics, {len(stats["failed"])} failed, {stats["topics_per_minute"]:.1f} topics/min, '
+                 f'{stats["cost"]:.4f} USD, {stats["cost_per_topic"]:.5f} USD per topic')
+    return stats
@@ -0,0 +1,201 @@
+"""In-process alternative to ES kNN search: vectors of index docs in memory mapped matrix, searched by numpy or HNSW"""
+
+from typing import Dict, Iterable, List, Optional
+import json
+import logging
+import os
+
+import numpy as np
+
+import src.config as cfg
+from src.data_classes import date_to_json_serialize
+from src.elastic_search.index_checkpoint import doc_content_hash
+from src.embeddings import EmbeddingService, embedding_service, encode_vector_fields
+
+try:
+    import hnswlib
+except ImportError:  # hnswlib is optional, exact search is used without it
+    hnswlib = None
+
+search_chunk_rows = 65536  # rows multiplied at once, to not convert whole float16 matrix to float32
+
+
+def _vector_fields(index_name: str) -> List[str]:
+    ind_flds = cfg.read_index_settings(index_name)['mappings']['properties']
+    return [f for f in ind_flds if ind_flds[f]['type'] == 'dense_vector']
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class LocalVectorIndex:
+    """_summary_
+    Docs of ES index with unit length vectors of its dense_vector fields, stored as .npy files, read by memory mapping.
+    Scores are the same as of ES cosine similarity: (1 + cosine) / 2.
+    Args:
+        index_name (str): name of ES index, settings for which are in index_settings.yml
+        index_dir (str, optional): folder of index files. Defaults to cfg.local_vector_index_dir.
+    """
+
+    def __init__(self, index_name: str, index_dir: str = cfg.local_vector_index_dir):
+        self.index_name = index_name
+        self.path_prefix = os.path.join(index_dir, index_name)
+        with open(f'{self.path_prefix}.docs.json', 'r') as f:
+            self.docs: List[Dict] = json.load(f)
+        self.chat_ids = np.load(f'{self.path_prefix}.chat_ids.npy')
+        self._vectors: Dict[str, np.ndarray] = dict()
+        self._hnsw: Dict[str, Optional[object]] = dict()
+
+    @classmethod
+    def build(cls, docs: Iterable[Dict], index_name: str, index_dir: str = cfg.local_vector_index_dir,
+              dtype: str = cfg.local_vector_dtype, encode_batch_size: int = cfg.embedding_batch_size,
+              encoder: EmbeddingService = None, previous: 'LocalVectorIndex' = None) -> 'LocalVectorIndex':
+        """builds index files from the same docs as es.index_docs gets, encoding vector fields missing in docs,
+        unless previous index has them for a doc of the same content"""
+        vector_flds = _vector_fields(index_name)
+        prefix = os.path.join(index_dir, index_name)
+        os.makedirs(index_dir, exist_ok=True)
+        stored_docs, chat_ids, vectors = [], [], {f: [] for f in vector_flds}
+        batch = []
+        previous_rows = None
+        if previous is not None:
+            previous_rows = {doc_content_hash(d): row for row, d in enumerate(previous.docs)}
+
+        def flush():
+            if previous_rows:
+                for d in batch:
+                    row = previous_rows.get(doc_content_hash(d, skip_fields=vector_flds))
+                    if row is not None:
+                        previous.copy_vectors(row, d, vector_flds)
+            encode_vector_fields([d for d in batch if any(f not in d for f in vector_flds)], vector_flds, encode_batch_size,
+                                 encoder=encoder or embedding_service)
+            for d in batch:
+                for f in vector_flds:
+                    vectors[f].append(d.get(f))
+                stored_docs.append({k: v for k, v in d.items() if k not in vector_flds})
+                chat_ids.append(int(d.get('chat_id') or cfg.telegram_group_id))
+            batch.clear()
+
+        for d in docs:
+            batch.append(dict(d))
+            if len(batch) >= encode_batch_size:
+                flush()
+        flush()
+
+        for f, field_vectors in vectors.items():
+            dims = next((len(v) for v in field_vectors if v is not None), 0)
+            # written aside and renamed, as the previous matrix might be memory mapped by a loaded index
+            matrix = np.lib.format.open_memmap(f'{prefix}.{f}.npy.tmp', mode='w+', dtype=dtype, shape=(len(field_vectors), dims))
+            for i, v in enumerate(field_vectors):
+                # doc without text gets NaN vector, which is never found
+                matrix[i] = np.nan if v is None else _normalize(np.asarray(v, dtype=np.float32))
+            matrix.flush()
+            if hnswlib is not None and len(field_vectors) >= cfg.local_vector_hnsw_min_size:
+                hnsw = hnswlib.Index(space='cosine', dim=dims)
+                hnsw.init_index(max_elements=len(field_vectors), ef_construction=200, M=16)
+                rows = [i for i, v in enumerate(field_vectors) if v is not None]
+                hnsw.add_items(np.asarray(matrix[rows], dtype=np.float32), rows)
+                hnsw.save_index(f'{prefix}.{f}.hnsw')
+            elif os.path.exists(f'{prefix}.{f}.hnsw'):
+                os.remove(f'{prefix}.{f}.hnsw')  # left from previous build
+            del matrix
+            os.replace(f'{prefix}.{f}.npy.tmp', f'{prefix}.{f}.npy')
+        np.save(f'{prefix}.chat_ids.npy', np.asarray(chat_ids, dtype=np.int64))
+        with open(f'{prefix}.docs.json', 'w') as f:
+            json.dump(stored_docs, f, default=date_to_json_serialize, ensure_ascii=False)
+        logging.info(f'local vector index {index_name} is built for {len(stored_docs)} docs')
+        _local_indices.pop(index_name, None)  # to reload on next search
+        return cls(index_name, index_dir)
+
+    def copy_vectors(self, row: int, doc: Dict, vector_flds: List[str]):
+        """sets vector fields missing in doc to the vectors of the row, vectors are unit length already"""
+        for f in vector_flds:
+            if f not in doc:
+                v = self.vectors(f)[row]
+                if not np.isnan(v).any():  # doc without text, it is encoded the same way as a new one
+                    doc[f] = np.array(v, dtype=np.float32)
+
+    def vectors(self, search_field: str) -> np.ndarray:
+        matrix = self._vectors.get(search_field)
+        if matrix is None:
+            matrix = self._vectors[search_field] = np.load(f'{self.path_prefix}.{search_field}.npy', mmap_mode='r')
+        return matrix
+
+    def _get_hnsw(self, search_field: str):
+        if search_field not in self._hnsw:
+            hnsw, path = None, f'{self.path_prefix}.{search_field}.hnsw'
+            if hnswlib is not None and os.path.exists(path):
+                hnsw = hnswlib.Index(space='cosine', dim=self.vectors(search_field).shape[1])
+                hnsw.load_index(path, max_elements=len(self.docs))
+                hnsw.set_ef(cfg.local_vector_hnsw_ef)
+            self._hnsw[search_field] = hnsw
+        return self._hnsw[search_field]
+
+    def search(self, query_vector, search_field: str, number_of_docs: int = 5, chat_id: int = None,
+               min_score: float = None, output_fields: List[str] = None) -> List[Dict]:
+        """top number_of_docs docs by cosine similarity, in the shape of es.knn_vector_search results"""
+        query = _normalize(np.asarray(query_vector, dtype=np.float32).reshape(-1))
+        hnsw = self._get_hnsw(search_field)
+        if hnsw is not None:
+            rows, scores = self._search_hnsw(hnsw, query, search_field, number_of_docs, chat_id)
+        else:
+            rows, scores = self._search_exact(query, search_field, number_of_docs, chat_id)
+        result_docs = []
+        for row, score in zip(rows, scores):
+            if min_score and score <= min_score:  # the same as es._hits_to_docs: strict bound, 0 is no filter
+                continue
+            doc = self.docs[row]
+            if output_fields:
+                doc = {k: v for k, v in doc.items() if k in output_fields}
+            result_docs.append({'doc': doc, 'score': score})
+        return result_docs
+
+    def _search_exact(self, query: np.ndarray, search_field: str, k: int, chat_id: int = None):
+        matrix = self.vectors(search_field)
+        candidate_rows, candidate_sims = [], []
+        for start in range(0, len(matrix), search_chunk_rows):
+            sims = np.asarray(matrix[start:start + search_chunk_rows], dtype=np.float32) @ query
+            sims[np.isnan(sims)] = -np.inf
+            if chat_id is not None:
+                sims[self.chat_ids[start:start + len(sims)] != chat_id] = -np.inf
+            top = np.argpartition(-sims, k - 1)[:k] if len(sims) > k else np.arange(len(sims))
+            candidate_rows.append(top + start)
+            candidate_sims.append(sims[top])
+        if not candidate_rows:
+            return [], []
+        rows, sims = np.concatenate(candidate_rows), np.concatenate(candidate_sims)
+        order = np.lexsort((rows, -sims))[:k]
+        order = order[np.isfinite(sims[order])]
+        return rows[order].tolist(), ((1 + sims[order]) / 2).tolist()
+
+    def _search_hnsw(self, hnsw, query: np.ndarray, search_field: str, k: int, chat_id: int = None):
+        flt = None if chat_id is None else (lambda row: self.chat_ids[row] == chat_id)
+        k = min(k, hnsw.get_current_count())
+        if k == 0:
+            return [], []
+        try:
+            labels, distances = hnsw.knn_query(query, k=k, filter=flt)
+        except RuntimeError:  # hnswlib fails when the filter leaves less than k rows to find, while exact search returns all of them
+            return self._search_exact(query, search_field, k, chat_id)
+        return labels[0].tolist(), ((2 - distances[0]) / 2).tolist()  # hnswlib cosine distance is 1 - cosine
+
+
+_local_indices: Dict[str, LocalVectorIndex] = dict()
+
+
+def load_local_vector_index(index_name: str, index_dir: str = None) -> Optional[LocalVectorIndex]:
+    """index built before, None if there is no one"""
+    index_dir = index_dir or cfg.local_vector_index_dir
+    if not os.path.exists(os.path.join(index_dir, f'{index_name}.docs.json')):
+        return None
+    return LocalVectorIndex(index_name, index_dir)
+
+
+def get_local_vector_index(index_name: str) -> LocalVectorIndex:
+    """index loaded once per process, see LocalVectorIndex.build for creation of its files"""
+    index = _local_indices.get(index_name)
+    if index is None:
+        index = _local_indices[index_name] = LocalVectorIndex(index_name, cfg.local_vector_index_dir)
+    return index
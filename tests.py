@@ -1,5 +1,5 @@
 from unittest import TestCase, skip
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
 from tqdm import tqdm
@@ -19,6 +19,83 @@ topics_file_path = 'output/llm_output/topics.json'
 topics_file_path_gt = 'output/llm_output/ground_truth.json'
 
 
+def write_synthetic_dump(dump_path: str, messages_count: int):
+    """writes dump in the format of Telegram Desktop export, with some replies and service messages"""
+    start = datetime(2023, 1, 1)
+    msgs = []
+    for i in range(1, messages_count + 1):
+        msg = {'id': i, 'type': 'message', 'date': (start + timedelta(seconds=97 * i)).strftime('%Y-%m-%dT%H:%M:%S'),
+               'from': f'User {i % 300}', 'from_id': f'user{i % 300}',
+               'text': f'сообщение номер {i} про котов и сантехников',
+               'text_entities': [{'type': 'plain', 'text': f'сообщение номер {i} '}, {'type': 'plain', 'text': 'про котов и сантехников'}]}
+        if i % 3 and i > 10:
+            msg['reply_to_message_id'] = i - 1 - i % 7
+        if i % 50 == 0:
+            msg = {'id': i, 'type': 'service', 'date': msg['date'], 'actor': 'User 1', 'action': 'pin_message', 'text': '', 'text_entities': []}
+        msgs.append(msg)
+    with open(dump_path, 'w', encoding='utf-8') as f:
+        json.dump({'name': 'test chat', 'type': 'public_supergroup', 'id': cfg.telegram_group_id, 'messages': msgs}, f,
+                  ensure_ascii=False, indent=1)
+
+
+class FakeOpenAIServer:
+    """OpenAI compatible chat completions endpoint on localhost, answers with respond(prompt) after latency
+
+    Args:
+        latency (float): seconds per request
+        fail_first (int): number of first requests answered with 429
+        respond (Callable[[str], str]): completion for the prompt, reversed prompt by default
+    """
+
+    def __init__(self, latency: float = 0.1, fail_first: int = 0, respond=lambda prompt: prompt[::-1]):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import threading
+        import time
+        server = self
+        self.requests_count, self.max_in_flight, self._in_flight = 0, 0, 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server._lock:
+                    server.requests_count += 1
+                    failed = server.requests_count <= fail_first
+                    server._in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server._in_flight)
+                time.sleep(latency)
+                with server._lock:
+                    server._in_flight -= 1
+                prompt = body['messages'][0]['content']
+                if failed:
+                    payload, status = {'error': {'message': 'rate limit', 'type': 'requests'}}, 429
+                else:
+                    payload, status = {'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                                       'choices': [{'index': 0, 'finish_reason': 'stop',
+                                                    'message': {'role': 'assistant', 'content': respond(prompt)}}],
+                                       'usage': {'prompt_tokens': len(prompt), 'completion_tokens': len(prompt),
+                                                 'total_tokens': 2 * len(prompt)}}, 200
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if failed:
+                    self.send_header('retry-after', '0.05')
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self._httpd.server_port}/v1'
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
 class TestTelega(TestCase):
 
     def set_up_tmi(self):
@@ -67,6 +144,60 @@ class TestTelega(TestCase):
         print(ids)
         assert ids == [2, 3, 4, 5, 7]
 
+    def test_topics_out_of_order(self):
+        import random
+
+        def msg(msg_id, reply_to_msg_id=None):
+            return TelegaMessage(msg_id=msg_id, reply_to_msg_id=reply_to_msg_id, msg_date=datetime(2020, 1, 1), msg_text='t', user_name='xx')
+
+        mi = TelegaMessageIndex()
+        for m in [msg(5, 4), msg(7, 4), msg(4, 2), msg(9), msg(2, 1)]:  # replies before their parents, 1 is not in the dump at all
+            mi.add_item(m)
+        assert {x: mi.topic_of(x) for x in [2, 4, 5, 7, 9]} == {2: 1, 4: 1, 5: 1, 7: 1, 9: 9}
+        mi.add_item(msg(1))
+        mi.add_item(msg(10, 5))
+        assert mi.topic_of(10) == 1 and mi.topic_size(10) == 6
+        assert mi.topics == {1: {1, 2, 4, 5, 7, 10}, 9: {9}}
+        assert sorted(mi.get_topic_roots(min_size=2)) == [(1, 6)]
+        assert mi.topics is mi.topics  # built once for all callers
+        mi.add_item(msg(11, 9))
+        assert mi.topics == {1: {1, 2, 4, 5, 7, 10}, 9: {9, 11}}
+        assert mi.get_topic_starting_msg_id(msg(10, 5), max_steps=1) == 1
+
+        msgs = [msg(i, i - 1 - i % 5 if i % 7 else None) for i in range(1, 500)]
+        ordered = TelegaMessageIndex.from_messages(msgs)
+        random.Random(42).shuffle(msgs)
+        shuffled = TelegaMessageIndex.from_messages(msgs)
+        assert ordered.topics == shuffled.topics
+
+    def test_columnar_index_same_as_dict(self):
+        import random
+        from src.columnar_message_index import ColumnarTelegaMessageIndex
+
+        start = datetime(2023, 1, 1)
+        msgs = [TelegaMessage(msg_id=i, reply_to_msg_id=(i - 1 - i % 5 if i % 7 and i > 5 else None) if i != 30 else 1000,
+                              msg_date=start + timedelta(minutes=7 * i), msg_text=f'текст {i}' if i % 11 else None,
+                              user_name=f'user {i % 4}' if i % 13 else None, user_id=f'u{i % 4}', chat_id=1)
+                for i in range(1, 300)]
+        random.Random(1).shuffle(msgs)
+        mi, cmi = TelegaMessageIndex(), ColumnarTelegaMessageIndex()
+        for msg in msgs[:150]:
+            mi.add_item(msg)
+            cmi.add_item(msg)
+        assert cmi.get_message(msgs[0].msg_id).model_dump() == msgs[0].model_dump()  # consolidation in the middle of load
+        for msg in msgs[150:]:
+            mi.add_item(msg)
+            cmi.add_item(msg)
+        assert len(cmi.msdg_ids) == len(mi.msdg_ids) and 5 in cmi.msdg_ids and 1000 not in cmi.msdg_ids
+        assert all(cmi.get_message(m.msg_id).model_dump() == m.model_dump() for m in msgs)
+        assert cmi.topics == mi.topics
+        assert sorted(cmi.get_topic_roots(3)) == sorted(mi.get_topic_roots(3))
+        assert cmi.topic_of(30) == 1000 and cmi.topic_size(31) == mi.topic_size(31)
+        for msg_id in [1, 30, 100, 250]:
+            assert [m.msg_id for m in cmi.get_messages_tree(msg_id, take_in_direct_relatives=True)] == \
+                   [m.msg_id for m in mi.get_messages_tree(msg_id, take_in_direct_relatives=True)]
+            assert [m.msg_id for m in cmi.get_potential_topic(msg_id)] == [m.msg_id for m in mi.get_potential_topic(msg_id)]
+
     def test_family_adding(self):
         self.set_up_tmi()
         mi = self.telegram_index
@@ -87,6 +218,220 @@ class TestTelega(TestCase):
         print(f'buyuk topics: {[x[0] for x in topics]}')
 
 
+class TestParquetCache(TestCase):
+
+    def test_dump_to_parquet_and_back(self):
+        import tempfile
+        import time
+        from src.parquet_cache import ensure_parquet_cache, dump_to_parquet, read_parquet_dataframe, read_parquet_messages, read_parquet_index
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dump_path, cache_dir = f'{tmp_dir}/result.json', f'{tmp_dir}/parquet'
+            write_synthetic_dump(dump_path, 50000)
+            ensure_parquet_cache(dump_path, cache_dir)
+            all_msgs = list(telega_dump_parse_essential(dump_path))
+            assert [m.model_dump() for m in read_parquet_messages(cache_dir)] == [m.model_dump() for m in all_msgs]
+
+            date_from, date_to = datetime(2023, 1, 20), datetime(2023, 2, 3, 12)
+            started = time.perf_counter()
+            sliced = list(read_parquet_messages(cache_dir, date_from=date_from, date_to=date_to, chat_id=cfg.telegram_group_id))
+            print(f'{len(sliced)} of {len(all_msgs)} messages read in {time.perf_counter() - started:.3f}s')
+            assert [m.msg_id for m in sliced] == [m.msg_id for m in all_msgs if date_from <= m.msg_date <= date_to]
+            assert not list(read_parquet_messages(cache_dir, chat_id=42))
+
+            df = read_parquet_dataframe(cache_dir, columns=['msg_id', 'msg_text'], date_from=date_from)
+            assert list(df.columns) == ['msg_id', 'msg_text'] and len(df) == len([m for m in all_msgs if m.msg_date >= date_from])
+            mi = read_parquet_index(cache_dir, date_to=date_to)
+            assert mi.get_message(sliced[0].msg_id) == sliced[0]
+
+            write_synthetic_dump(dump_path, 1000)  # months of the longer dump must not stay in the cache
+            dump_to_parquet(dump_path, cache_dir)
+            assert [m.msg_id for m in read_parquet_messages(cache_dir)] == [m.msg_id for m in telega_dump_parse_essential(dump_path)]
+
+
+class TestPerformance(TestCase):
+
+    def test_snapshot_vs_cold_parse(self):
+        import tempfile
+        import time
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dump_path, snapshot_path = f'{tmp_dir}/result.json', f'{tmp_dir}/messages_index.pkl'
+            write_synthetic_dump(dump_path, 100000)
+            started = time.perf_counter()
+            cold = TelegaMessageIndex.from_dump(dump_path, snapshot_path=snapshot_path)
+            cold_time = time.perf_counter() - started
+            started = time.perf_counter()
+            warm = TelegaMessageIndex.from_dump(dump_path, snapshot_path=snapshot_path)
+            warm_time = time.perf_counter() - started
+            print(f'{len(cold.msdg_ids)} messages: cold parse {cold_time:.2f}s, snapshot load {warm_time:.2f}s')
+            assert len(warm.msdg_ids) == len(cold.msdg_ids)
+            assert warm.topics == cold.topics
+            assert warm.get_message(500) == cold.get_message(500)
+            assert [m.msg_id for m in warm.get_potential_topic(1001)] == [m.msg_id for m in cold.get_potential_topic(1001)]
+            assert warm_time < cold_time
+
+            with open(dump_path, 'a') as f:  # any change of dump makes snapshot stale
+                f.write(' ')
+            assert TelegaMessageIndex.load_snapshot(snapshot_path, dump_path) is None
+
+    def test_fast_dump_parser(self):
+        import tempfile
+        import time
+        from src.read_telega_dump import telega_dump_parse_fast
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dump_path = f'{tmp_dir}/result.json'
+            write_synthetic_dump(dump_path, 100000)
+            results = dict()
+            parsers = {'essential': lambda: telega_dump_parse_essential(dump_path),
+                       'fast ijson': lambda: telega_dump_parse_fast(dump_path),
+                       'fast ijson validated': lambda: telega_dump_parse_fast(dump_path, validate=True),
+                       'fast orjson': lambda: telega_dump_parse_fast(dump_path, reader='orjson'),
+                       'fast 4 processes': lambda: telega_dump_parse_fast(dump_path, workers=4)}
+            for name, parse in parsers.items():
+                started = time.perf_counter()
+                msgs = list(parse())
+                duration = time.perf_counter() - started
+                results[name] = [m.model_dump() for m in msgs]
+                print(f'{name}: {len(msgs) / duration:.0f} messages per second')
+            assert all(msgs == results['essential'] for msgs in results.values())
+
+    def test_family_candidates_time_index(self):
+        import time
+
+        def family_candidates_full_scan(mi: TelegaMessageIndex, family):  # implementation before sorted time index
+            nm_td, nm_nm = cfg.near_messages_time_delta, cfg.near_messages_number_of_messages_delta
+            family_ids = {x.msg_id for x in family}
+            family.sort(key=lambda x: x.msg_id)
+            family_candidates = []
+            for i, m in enumerate(family):
+                dt_interval = (m.msg_date - nm_td,  m.msg_date + nm_td)
+                next_family_msg_id = family[i+1].msg_id if i < len(family) - 1 else None
+                prev__family_msg_id = family[i-1].msg_id if i > 0 else 0
+                msgs_interval = max(m.msg_id - nm_nm - 1, prev__family_msg_id), min(m.msg_id + nm_nm + 1, next_family_msg_id
+                                                                                    if next_family_msg_id else m.msg_id + nm_nm)
+                for _, msg_ids in filter(lambda itm: dt_interval[0] <= itm[0] <= dt_interval[1], mi.msg_date_ids.items()):
+                    for msg_id in filter(lambda msg_id: msgs_interval[0] < msg_id < msgs_interval[1] and msg_id not in family_ids, msg_ids):
+                        new_msg = mi.msdg_ids[msg_id]
+                        if new_msg not in family_candidates:
+                            family_candidates.append(new_msg)
+            return family_candidates
+
+        start, messages_count = datetime(2023, 1, 1), 200000
+        msgs = [TelegaMessage.model_construct(msg_id=i, msg_date=start + timedelta(seconds=60 * i + (i % 5) * 7), user_id='u', user_name='n',
+                                              reply_to_msg_id=(i // 10) * 10 if i % 10 else None, msg_text='text', chat_id=1)
+                for i in range(1, messages_count + 1)]
+        mi = TelegaMessageIndex()
+        for msg in msgs[::2] + msgs[1::2]:  # out of order ingest
+            mi.add_item(msg)
+        families = [mi.get_messages_tree(msg_id, max_depth_down=10, max_steps_up=10) for msg_id in range(1000, messages_count, 20000)]
+
+        started = time.perf_counter()
+        expected = [sorted(m.msg_id for m in family_candidates_full_scan(mi, list(f))) for f in families]
+        full_scan_time = time.perf_counter() - started
+        started = time.perf_counter()
+        actual = [sorted(m.msg_id for m in mi.get_family_candidates(list(f))) for f in families]
+        time_index_time = time.perf_counter() - started
+        print(f'{len(families)} families over {messages_count} messages: full scan {full_scan_time:.3f}s, time index {time_index_time:.4f}s')
+        assert actual == expected
+        assert any(actual)
+        assert time_index_time < full_scan_time
+
+    def test_columnar_index_memory(self):
+        import gc
+        import tracemalloc
+        from src.columnar_message_index import ColumnarTelegaMessageIndex
+
+        start, messages_count = datetime(2023, 1, 1), 200000
+
+        def msgs():
+            for i in range(1, messages_count + 1):
+                yield TelegaMessage(msg_id=i, msg_date=start + timedelta(seconds=61 * i), user_id=f'user{i % 500}', user_name=f'User {i % 500}',
+                                    reply_to_msg_id=(i // 10) * 10 if i % 10 else None, msg_text=f'сообщение {i} про котов', chat_id=1)
+
+        sizes = dict()
+        for index_class in [TelegaMessageIndex, ColumnarTelegaMessageIndex]:
+            gc.collect()
+            tracemalloc.start()
+            mi = index_class.from_messages(msgs())
+            mi.get_message(1)  # consolidation of columnar index
+            gc.collect()
+            sizes[index_class.__name__] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del mi
+        print({k: f'{v / messages_count:.0f} bytes per message' for k, v in sizes.items()})
+        assert sizes['ColumnarTelegaMessageIndex'] * 5 < sizes['TelegaMessageIndex']
+
+
+class TestChunking(TestCase):
+
+    def test_chunk_messages(self):
+        import time
+        from src.chunking import chunk_messages, chunk_to_json, estimate_tokens
+
+        msg_dicts = [{'msg_id': i, 'user_name': f'User {i % 30}', 'msg_text': 'сообщение про котов ' * (1 + i % 17)}
+                     for i in range(1, 20001)]
+        msg_dicts[100]['msg_text'] = 'очень длинное ' * 2000  # does not fit to any chunk
+        for count_tokens in (estimate_tokens, lambda text: len(text.split())):
+            started = time.perf_counter()
+            chunks = list(chunk_messages(msg_dicts, max_tokens_count=2000, overlapping_msgs_cnt=2, count_tokens=count_tokens))
+            print(f'{len(chunks)} chunks in {time.perf_counter() - started:.3f}s')
+            new_ids = []
+            for prev_chunk, chunk in zip([[]] + chunks, chunks):
+                overlap = [m for m in chunk if m['msg_id'] <= (prev_chunk[-1]['msg_id'] if prev_chunk else 0)]
+                assert overlap == chunk[:len(overlap)] and len(overlap) <= 2
+                new_ids.extend(m['msg_id'] for m in chunk[len(overlap):])
+                tokens = count_tokens(chunk_to_json(chunk))
+                assert tokens <= 2000 or chunk == [msg_dicts[100]]
+            assert new_ids == [m['msg_id'] for m in msg_dicts]
+            full_chunks = [c for c in chunks[:-1] if c[0]['msg_id'] > 101]  # chunks next to the long message are smaller
+            assert min(count_tokens(chunk_to_json(c)) for c in full_chunks) > 2000 * 0.8  # chunks are packed
+
+
+class TestPromptContext(TestCase):
+
+    def test_compact_encoding_and_packing(self):
+        from src.chunking import estimate_tokens
+        from src.data_classes import convert_to_json_list
+        from src.prompt_context import encode_messages_compact, pack_messages
+        from unittest.mock import patch
+
+        start = datetime(2024, 8, 29, 10, 14, 18)
+        texts = ['What motor oil for VW?', 'I prefer Shell oil', 'I have a nice cat', 'Shell sucks. Buy Motul', 'Buy Tesla']
+        users = ['Dima', 'John', 'Janet', 'George', 'John']
+        replies = [None, None, None, 124, 123]
+        msgs = [TelegaMessage(msg_id=123 + i, msg_date=start + timedelta(minutes=7 * i), user_name=users[i], user_id=f'user{i}',
+                              chat_id=cfg.telegram_group_id, reply_to_msg_id=replies[i], msg_text=texts[i], is_in_family=i in (0, 4))
+                for i in range(5)]
+        compact = encode_messages_compact(msgs)
+        lines = compact.split('\n')
+        header = json.loads(lines[0])
+        assert header['t0'] == '2024-08-29 10:14' and header['users'] == {'1': 'Dima', '2': 'John', '3': 'Janet', '4': 'George'}
+        assert json.loads(lines[4]) == {'id': 126, 're': 124, 't': 21, 'u': 4, 'x': 'Shell sucks. Buy Motul'}
+        assert json.loads(lines[5]) == {'id': 127, 're': 123, 't': 28, 'u': 2, 'x': 'Buy Tesla'}
+        assert 'fam' in encode_messages_compact(msgs, with_family=True)
+        assert estimate_tokens(compact) * 2 < estimate_tokens(convert_to_json_list(msgs))
+
+        assert pack_messages(msgs, 10000, count_tokens=estimate_tokens) == msgs  # everything fits
+        scores = {126: 2.0, 125: 1.0}
+        packed = pack_messages(msgs, 150, scores, count_tokens=estimate_tokens)
+        assert [x.msg_id for x in packed] == [124, 126]  # the best message with the one it replies to
+        assert estimate_tokens(encode_messages_compact(packed)) <= 150
+        packed = pack_messages(msgs, 150, count_tokens=estimate_tokens)  # family first by default
+        assert [x.msg_id for x in packed] == [123, 127]
+        packed = pack_messages(msgs, 150, scores, prompt_format='json', count_tokens=estimate_tokens)
+        assert [x.msg_id for x in packed] == [125]  # 126 with 124 does not fit as indented json, next best is taken
+
+        from src import llm
+        with patch('src.prompt_context.get_token_counter', lambda model: estimate_tokens):
+            for build in (lambda f: llm.build_rag_prompt('Which oil?', 'cars', msgs, prompt_format=f),
+                          lambda f: llm.build_summarization_prompt(msgs, 'cars', prompt_format=f)):
+                compact_prompt, json_prompt = build('compact'), build('json')
+                assert '"msg_id"' not in compact_prompt and '"is_in_family"' not in compact_prompt  # instructions speak compact keys
+                assert '{"id":123,' in compact_prompt and '"reply_to_msg_id": 124' in json_prompt
+
+
 class TestJSONhelper(TestCase):
     def test_merge_translated(self):
         import json
@@ -107,6 +452,160 @@ class TestES(TestCase):
         doc_file = "output/llm_output/merged_messages.json"
         es.index_json_file(doc_file, cfg.index_name_messages_eng)
 
+    def test_messages_eng_index_bulk(self):
+        doc_file = "output/llm_output/merged_messages.json"
+        es.index_json_file(doc_file, cfg.index_name_messages_eng, bulk=True)
+
+    def test_bulk_actions_batch_encoding(self):
+        from unittest.mock import patch
+        from src.embeddings import EmbeddingService
+
+        class FakeModel:
+            batches = []
+
+            def encode(self, texts, batch_size=None):
+                FakeModel.batches.append(len(texts))
+                return [[float(len(t))] * 3 for t in texts]
+
+        docs = [{'msg_id': i, 'msg_text': f'text {i}'} for i in range(5)] + [{'msg_id': 5, 'msg_text': None}]
+        with patch.object(es, 'embedding_service', EmbeddingService(model_loader=lambda name: FakeModel())):
+            actions = list(es._bulk_actions(docs, cfg.index_name_messages_eng, ['msg_text_vector'], ['chat_id', 'msg_id'],
+                                            encode_batch_size=4))
+        assert FakeModel.batches == [4, 1]
+        assert [a['_id'] for a in actions] == [f'{cfg.telegram_group_id};{i}' for i in range(6)]
+        assert actions[0]['_source']['msg_text_vector'] == [6.0] * 3
+        assert 'msg_text_vector' not in actions[-1]['_source']
+
+    def test_messages_index_incremental(self):
+        es.load_messages_from_dump(incremental=True)
+        stats = es.load_messages_from_dump(incremental=True)  # second run should skip everything
+        assert stats['indexed'] == 0
+
+    def test_incremental_checkpoint_filter(self):
+        import tempfile
+        from unittest.mock import MagicMock, patch
+        from src.elastic_search.index_checkpoint import IndexCheckpoint
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            docs = [{'msg_id': i, 'msg_text': f'text {i}'} for i in range(1, 4)]
+            checkpoint = IndexCheckpoint('test-index', checkpoint_dir=tmp_dir)
+            stats, pending = {'indexed': 0, 'skipped': 0, 'failed': []}, dict()
+            for d in es._filter_changed_docs(docs, ['chat_id', 'msg_id'], [], checkpoint, pending, stats):
+                es._confirm_indexed(es._prepare_doc(d, ['chat_id', 'msg_id']), stats, checkpoint, pending)
+            checkpoint.save()
+            assert stats['indexed'] == 3 and len(checkpoint.doc_hashes) == 3
+
+            checkpoint = IndexCheckpoint('test-index', checkpoint_dir=tmp_dir)  # reread from disk
+            docs = [{'msg_id': 2, 'msg_text': 'text 2', 'msg_text_vector': [0.1]},  # unchanged, vector is not part of content
+                    {'msg_id': 3, 'msg_text': 'edited text 3'},
+                    {'msg_id': 4, 'msg_text': 'text 4'}]
+            stats, pending = {'indexed': 0, 'skipped': 0, 'failed': []}, dict()
+            changed = list(es._filter_changed_docs(docs, ['chat_id', 'msg_id'], ['msg_text_vector'], checkpoint, pending, stats))
+            assert [d['msg_id'] for d in changed] == [3, 4]
+            assert stats['skipped'] == 1
+
+            IndexCheckpoint.delete('test-index', checkpoint_dir=tmp_dir)
+            assert not IndexCheckpoint('test-index', checkpoint_dir=tmp_dir).doc_hashes
+
+        fake_client = MagicMock()
+        fake_client.indices.exists.return_value = False  # recreated index is empty
+        with patch.object(es, 'es_client', fake_client), patch.object(IndexCheckpoint, 'delete') as delete_checkpoint:
+            es.index_docs([{'msg_id': 1, 'msg_text': 'text 1'}], cfg.index_name_messages, recreate_index=True)
+        delete_checkpoint.assert_called_once_with(cfg.index_name_messages)
+
+    def test_messages_index_from_es(self):
+        mi = TelegaMessageIndex.from_messages(es.scan_messages(cfg.index_name_messages, slices=4))
+        print(f'{len(mi.msdg_ids)} messages loaded from ES')
+        assert mi.msdg_ids
+
+    def test_scan_messages_slices(self):
+        from unittest.mock import patch
+
+        class FakeES:
+            def __init__(self, docs):
+                self.docs, self.closed = docs, False
+                self.pit_ids = dict()  # slice id -> pit id returned by its last search
+
+            def open_point_in_time(self, index, keep_alive):
+                return {'id': 'pit'}
+
+            def close_point_in_time(self, id):
+                self.closed = id
+
+            def search(self, body):
+                slice_id = body['slice']['id']
+                assert body['pit']['id'] == self.pit_ids.get(slice_id, 'pit')  # the latest pit id is carried to the next page
+                self.pit_ids[slice_id] = f'pit {slice_id} {body.get("search_after", [0])[0]}'
+                slice_docs = [d for d in self.docs if d['msg_id'] % body['slice']['max'] == body['slice']['id']]
+                start = body.get('search_after', [0])[0]
+                page = [d for d in slice_docs if d['msg_id'] > start][:body['size']]
+                return {'pit_id': self.pit_ids[slice_id], 'hits': {'hits': [{'_source': d, 'sort': [d['msg_id']]} for d in page]}}
+
+        docs = [{'msg_id': i, 'msg_date': '2024-01-01T10:00:00', 'reply_to_msg_id': None, 'msg_text': f't {i}', 'chat_id': 1}
+                for i in range(1, 1001)]
+        fake_es = FakeES(docs)
+        with patch.object(es, 'es_client', fake_es):
+            msgs = list(es.scan_messages(slices=3, page_size=100))
+            assert sorted(m.msg_id for m in msgs) == list(range(1, 1001))
+            assert fake_es.closed in fake_es.pit_ids.values()
+            fake_es.closed, fake_es.pit_ids = False, dict()
+            first = next(iter(es.scan_messages(slices=3, page_size=10)))  # abandoned generator should not hang
+            assert first.msg_id
+
+    def test_quantized_index_settings(self):
+        ind_set = cfg.read_index_settings(cfg.index_name_topics, vector_index_type='int8_hnsw', vectors_in_source=False)
+        props = ind_set['mappings']['properties']
+        assert props['topic_name_vector']['index_options'] == {'type': 'int8_hnsw'}
+        assert ind_set['mappings']['_source'] == {'excludes': ['topic_name_vector', 'topic_name_eng_vector']}
+        assert '_source' not in cfg.read_index_settings(cfg.index_name_messages, vectors_in_source=False)['mappings']
+        assert '_source' not in cfg.read_index_settings(cfg.index_name_topics, vectors_in_source=True)['mappings']
+        assert es._knn_rescore_options('int8_hnsw') == {'rescore_vector': {'oversample': cfg.es_knn_rescore_oversample}}
+        assert es._knn_rescore_options('hnsw') == {}
+
+    def test_quantized_vectors_benchmark(self):
+        import time
+        import numpy as np
+        from elasticsearch.helpers import bulk
+
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(200, 512))  # clustered, like embeddings of chat messages on few topics
+        vectors = centers[rng.integers(0, 200, 20000)] + rng.normal(scale=0.7, size=(20000, 512))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = vectors[rng.integers(0, 20000, 50)] + rng.normal(scale=0.3, size=(50, 512))
+        exact_top = np.argsort(-(queries @ vectors.T), axis=1)[:, :10]
+        recalls = dict()
+        for vector_index_type, vectors_in_source in [('hnsw', True), ('int8_hnsw', False), ('bbq_hnsw', False)]:
+            index_name = f'benchmark-vectors-{vector_index_type.replace("_", "-")}'
+            ind_set = cfg.apply_vector_options({'settings': {'number_of_shards': 1, 'number_of_replicas': 0},
+                                                'mappings': {'properties': {
+                                                    'msg_id': {'type': 'integer'}, 'chat_id': {'type': 'keyword'},
+                                                    'msg_text_vector': {'type': 'dense_vector', 'dims': 512, 'index': True,
+                                                                        'similarity': 'cosine'}}}},
+                                               vector_index_type, vectors_in_source)
+            es.es_client.indices.delete(index=index_name, ignore_unavailable=True)
+            es.es_client.indices.create(index=index_name, body=ind_set)
+            try:
+                actions = ({'_index': index_name, '_id': i,
+                            '_source': {'msg_id': i, 'chat_id': cfg.telegram_group_id, 'msg_text_vector': v.tolist()}}
+                           for i, v in enumerate(vectors))
+                bulk(es.es_client, actions, chunk_size=1000)
+                es.es_client.indices.refresh(index=index_name)
+                es.es_client.indices.forcemerge(index=index_name, max_num_segments=1)
+                size = es.es_client.indices.stats(index=index_name, metric='store')['indices'][index_name]['total']['store']['size_in_bytes']
+                hits, started = 0, time.perf_counter()
+                for q, exact in zip(queries, exact_top):
+                    knn = {'field': 'msg_text_vector', 'query_vector': q.tolist(), 'k': 10, 'num_candidates': 100,
+                           **es._knn_rescore_options(vector_index_type)}
+                    ret = es.es_client.search(index=index_name, knn=knn, source=['msg_id'], size=10)
+                    hits += len({h['_source']['msg_id'] for h in ret['hits']['hits']} & set(exact.tolist()))
+                latency = (time.perf_counter() - started) / len(queries)
+                recalls[vector_index_type] = hits / exact_top.size
+                print(f'{vector_index_type}: {size / 2 ** 20:.1f} MB, {latency * 1000:.1f} ms per query, '
+                      f'recall@10 {recalls[vector_index_type]:.3f}')
+            finally:
+                es.es_client.indices.delete(index=index_name, ignore_unavailable=True)
+        assert recalls['int8_hnsw'] >= recalls['hnsw'] - 0.05
+
     def test_topics_index(self):
         topics_path = cfg.topics_path
         es.index_json_file(topics_path, cfg.index_name_topics)
@@ -147,6 +646,761 @@ class TestES(TestCase):
                                index_name=cfg.index_name_messages_eng)
         assert ret
 
+    def test_fused_hybrid_search(self):
+        import time
+        from unittest.mock import patch
+
+        def text_leg(search_term, size, **kwargs):
+            return [(10.0 - i, {'msg_id': x, 'chat_id': 1}) for i, x in enumerate([1, 2, 3, 4])][:size]
+
+        def knn_leg(search_term, number_of_docs, **kwargs):
+            return [{'doc': {'msg_id': x}, 'score': 0.9} for x in [3, 5, 1]][:number_of_docs]
+
+        def slow_knn_leg(*args, **kwargs):
+            time.sleep(1)
+            return knn_leg(*args, **kwargs)
+
+        def broken_leg(*args, **kwargs):
+            raise ConnectionError('ES is down')
+
+        with patch.object(es, 'simple_search', text_leg), patch.object(es, 'knn_vector_search', knn_leg):
+            ret = es.fused_hybrid_search('cat food', size=4, chat_id=1, rrf_k=60)
+        assert [x['doc']['msg_id'] for x in ret] == [1, 3, 2, 5]  # found by both legs first
+        assert ret[0]['ranks'] == {'text': 1, 'knn': 3}
+        assert abs(ret[0]['score'] - (1 / 61 + 1 / 63)) < 1e-9
+        assert ret[0]['doc'] == {'msg_id': 1, 'chat_id': 1}  # doc of the first leg
+
+        with patch.object(es, 'simple_search', text_leg), patch.object(es, 'knn_vector_search', slow_knn_leg):
+            started = time.perf_counter()
+            ret = es.fused_hybrid_search('cat food', size=4, chat_id=1, knn_timeout=0.1)
+            assert time.perf_counter() - started < 0.5
+        assert [x['doc']['msg_id'] for x in ret] == [1, 2, 3, 4]
+
+        with patch.object(es, 'simple_search', broken_leg), patch.object(es, 'knn_vector_search', knn_leg):
+            ret = es.fused_hybrid_search('cat food', size=4, chat_id=1)
+        assert [x['doc']['msg_id'] for x in ret] == [3, 5, 1]
+
+        with patch.object(es, 'simple_search', broken_leg), patch.object(es, 'knn_vector_search', broken_leg):
+            self.assertRaises(Exception, es.fused_hybrid_search, 'cat food', chat_id=1)
+
+    def test_knn_vector_search_many_ground_truth(self):
+        import time
+        with open(topics_file_path_gt, 'r') as f:
+            questions = [x['question'] for x in json.load(f)]
+        started = time.perf_counter()
+        singles = [es.knn_vector_search(search_term=q, search_field='msg_text_vector', index_name=cfg.index_name_messages_eng)
+                   for q in questions]
+        single_time = time.perf_counter() - started
+        es.embedding_service.clear_cache()
+        started = time.perf_counter()
+        batched = es.knn_vector_search_many(questions, search_field='msg_text_vector', index_name=cfg.index_name_messages_eng)
+        batch_time = time.perf_counter() - started
+        print(f'{len(questions)} questions: one by one {single_time:.2f}s, batched {batch_time:.2f}s')
+        assert [[d['doc']['msg_id'] for d in x] for x in batched] == [[d['doc']['msg_id'] for d in x] for x in singles]
+
+    def test_msearch_batch_search(self):
+        from unittest.mock import patch
+        from src.embeddings import EmbeddingService
+
+        class FakeModel:
+            batches = []
+
+            def encode(self, texts, batch_size=None):
+                FakeModel.batches.append(list(texts) if isinstance(texts, list) else [texts])
+                return [[float(len(t)), 1.0] for t in texts] if isinstance(texts, list) else [float(len(texts)), 1.0]
+
+        class FakeES:
+            requests = []
+
+            def msearch(self, searches):
+                FakeES.requests.append(searches)
+                responses = []
+                for header, body in zip(searches[::2], searches[1::2]):
+                    assert header == {'index': cfg.index_name_messages_eng}
+                    if 'knn' in body:
+                        score = body['knn']['query_vector'][0]
+                    else:
+                        score = len(body['query']['match']['msg_text'])
+                    responses.append({'hits': {'hits': [{'_source': {'msg_id': int(score)}, '_score': score}]}})
+                return {'responses': responses}
+
+        questions = ['cat', 'where is visa', 'cat', 'taxi']
+        encoder = EmbeddingService(model_loader=lambda name: FakeModel())
+        encoder.encode_query('taxi')
+        with patch.object(es, 'es_client', FakeES()), patch.object(es, 'embedding_service', encoder), \
+                patch.object(cfg, 'vector_search_backend', 'es'):
+            ret = es.knn_vector_search_many(questions, 'msg_text_vector', cfg.index_name_messages_eng, min_score=3.5)
+            srs = es.simple_search_many(questions, 'msg_text', cfg.index_name_messages_eng, min_score=0)
+            bodies = [{'query': {'match': {'msg_text': q}}} for q in questions]
+            assert len(es.msearch(cfg.index_name_messages_eng, bodies, batch_size=3)) == len(questions)
+        assert FakeModel.batches == [['taxi'], ['cat', 'where is visa']]  # one batch for all the new questions
+        assert [[d['doc']['msg_id'] for d in x] for x in ret] == [[], [13], [], [4]]  # aligned with questions
+        assert [[d['msg_id'] for _, d in x] for x in srs] == [[3], [13], [3], [4]]
+        assert [len(x) // 2 for x in FakeES.requests] == [4, 4, 3, 1]
+        assert 'msg_text_vector' not in FakeES.requests[0][1]['_source']
+
+
+class TestLocalVectorSearch(TestCase):
+
+    def test_local_knn_search(self):
+        import tempfile
+        import numpy as np
+        from unittest.mock import MagicMock, patch
+        from src.embeddings import EmbeddingService
+        from src import vector_store
+        from src.vector_store import LocalVectorIndex
+
+        rng = np.random.default_rng(42)
+        words = {w: rng.normal(size=16) for w in ['cat', 'dog', 'taxi', 'bus', 'rent', 'flat', 'doctor', 'visa']}
+
+        class FakeModel:
+            def encode(self, texts, batch_size=None):
+                def encode_one(t):
+                    return sum((words[w] for w in t.split() if w in words), np.zeros(16)) + 0.01
+                return encode_one(texts) if isinstance(texts, str) else np.array([encode_one(t) for t in texts])
+
+        encoder = EmbeddingService(model_loader=lambda name: FakeModel())
+        ws = list(words)
+        docs = [{'msg_id': i, 'msg_text': ' '.join(ws[j] for j in rng.choice(len(ws), 3)), 'chat_id': 1 if i % 4 else 2,
+                 'msg_date': datetime(2024, 1, 1) + timedelta(hours=i)} for i in range(500)]
+        docs.append({'msg_id': 500, 'msg_text': None, 'chat_id': 1})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            exact = LocalVectorIndex.build(docs, cfg.index_name_messages_eng, index_dir=tmp_dir, dtype='float32',
+                                           encode_batch_size=64, encoder=encoder)
+            query = encoder.encode_query('cat taxi')
+            results = exact.search(query, 'msg_text_vector', number_of_docs=10, chat_id=1)
+            vectors = np.array([FakeModel().encode(d['msg_text'] or '') for d in docs[:500]])
+            cosines = vectors @ query / np.linalg.norm(vectors, axis=1) / np.linalg.norm(query)
+            expected = sorted(((1 + cosines[i]) / 2 for i in range(500) if i % 4), reverse=True)[:10]
+            assert np.allclose([r['score'] for r in results], expected, atol=1e-6)
+            assert np.allclose([r['score'] for r in results], [(1 + cosines[r['doc']['msg_id']]) / 2 for r in results], atol=1e-6)
+            assert all(r['doc']['chat_id'] == 1 for r in results)
+            assert results[0]['doc']['msg_date'] == docs[results[0]['doc']['msg_id']]['msg_date'].isoformat()
+            assert all(r['score'] > 0.9 for r in exact.search(query, 'msg_text_vector', 500, chat_id=1, min_score=0.9))
+            bounded = exact.search(query, 'msg_text_vector', 10, chat_id=1, min_score=results[-1]['score'])
+            assert bounded == [r for r in results if r['score'] > results[-1]['score']]  # strict bound, as in es._hits_to_docs
+            assert exact.search(query, 'msg_text_vector', 10, chat_id=1, min_score=0) == results  # 0 is no filter, as in ES
+            assert len(exact.search(query, 'msg_text_vector', 1000, chat_id=1)) == 375  # doc without text is never found
+
+            failing_hnsw = MagicMock()  # hnswlib raises, when filtered rows are less than k
+            failing_hnsw.get_current_count.return_value = len(docs)
+            failing_hnsw.knn_query.side_effect = RuntimeError('Cannot return the results in a contiguous 2D array')
+            exact._hnsw['msg_text_vector'] = failing_hnsw
+            assert exact.search(query, 'msg_text_vector', number_of_docs=10, chat_id=1) == results
+            del exact._hnsw['msg_text_vector']
+
+            half = LocalVectorIndex.build(docs, cfg.index_name_messages_eng, index_dir=f'{tmp_dir}/f16', encoder=encoder)
+            assert half.vectors('msg_text_vector').dtype == np.float16
+            half_results = half.search(query, 'msg_text_vector', number_of_docs=10, chat_id=2, output_fields=['msg_id'])
+            assert all(r['doc']['msg_id'] % 4 == 0 and list(r['doc']) == ['msg_id'] for r in half_results)
+
+            with patch.object(cfg, 'vector_search_backend', 'local'), patch.object(cfg, 'local_vector_index_dir', tmp_dir), \
+                    patch.object(es, 'embedding_service', encoder), patch.object(cfg, 'telegram_group_id', 1):
+                ret = es.knn_vector_search('cat taxi', search_field='msg_text_vector', index_name=cfg.index_name_messages_eng,
+                                           number_of_docs=10)
+                vector_store._local_indices.clear()  # loaded from temporary dir
+            assert ret == results
+
+    def test_local_index_follows_index_docs(self):
+        import tempfile
+        import numpy as np
+        from unittest.mock import MagicMock, patch
+        from src.embeddings import EmbeddingService
+        from src import vector_store
+        from src.elastic_search.index_checkpoint import IndexCheckpoint
+
+        words = {w: np.random.default_rng(i).normal(size=8) for i, w in enumerate(['cat', 'dog', 'taxi', 'bus', 'visa'])}
+
+        class FakeModel:
+            encoded = []
+
+            def encode(self, texts, batch_size=None):
+                texts = [texts] if isinstance(texts, str) else texts
+                FakeModel.encoded.extend(texts)
+                return np.array([sum((words[w] for w in t.split()), np.zeros(8)) for t in texts])
+
+        encoder = EmbeddingService(model_loader=lambda name: FakeModel())
+        index_name = cfg.index_name_messages_eng
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            class TmpCheckpoint(IndexCheckpoint):
+                def __init__(self, name):
+                    super().__init__(name, checkpoint_dir=tmp_dir)
+
+            def load(docs, **kwargs):
+                FakeModel.encoded.clear()
+                es.index_docs([dict(d) for d in docs], index_name, **kwargs)
+                vector_store._local_indices.clear()
+                return list(FakeModel.encoded)
+
+            docs = [{'msg_id': 1, 'msg_text': 'cat'}, {'msg_id': 2, 'msg_text': 'dog'}, {'msg_id': 3, 'msg_text': 'taxi'}]
+            with patch.object(cfg, 'vector_search_backend', 'local'), patch.object(cfg, 'local_vector_index_dir', tmp_dir), \
+                    patch.object(es, 'es_client', MagicMock()), patch.object(es, 'IndexCheckpoint', TmpCheckpoint), \
+                    patch.object(es, 'embedding_service', encoder), patch.object(vector_store, 'embedding_service', encoder):
+                assert load(docs, incremental=True) == ['cat', 'dog', 'taxi']
+                docs[1] = {'msg_id': 2, 'msg_text': 'bus'}
+                # unchanged docs are skipped by ES load, and their vectors are reused by local index, not encoded again
+                assert load(docs + [{'msg_id': 4, 'msg_text': 'visa'}], incremental=True, recreate_index=False) == ['bus', 'visa']
+                assert load([{'msg_id': 5, 'msg_text': 'dog'}], recreate_index=False) == ['dog']  # others are kept
+                local_index = vector_store.get_local_vector_index(index_name)
+                assert [d['msg_id'] for d in local_index.docs] == [1, 2, 3, 4, 5]
+                found = es.knn_vector_search('bus', search_field='msg_text_vector', index_name=index_name, number_of_docs=1)
+                assert found[0]['doc']['msg_id'] == 2
+                vector_store._local_indices.clear()
+
+
+class TestEmbeddings(TestCase):
+
+    def test_query_embedding_cache(self):
+        from src.embeddings import EmbeddingService
+
+        class FakeModel:
+            encode_calls = 0
+
+            def encode(self, texts, batch_size=None):
+                FakeModel.encode_calls += 1
+                if isinstance(texts, str):
+                    return [float(len(texts)), 1.0]
+                return [[float(len(t)), 1.0] for t in texts]
+
+        loaded_models = []
+        svc = EmbeddingService(max_cache_size=2, model_loader=lambda name: loaded_models.append(name) or FakeModel())
+        svc.encode_query('cat feeding', model_name='m1')
+        svc.encode_query('  cat   feeding ', model_name='m1')  # same text after normalization
+        svc.encode_query('cat feeding', model_name='m2')
+        assert loaded_models == ['m1', 'm2']
+        assert svc.stats()['hits'] == 1 and svc.stats()['misses'] == 2
+        svc.encode_query('taxi', model_name='m1')  # evicts least recently used ('m1', 'cat feeding')
+        svc.encode_query('cat feeding', model_name='m1')
+        assert svc.stats()['misses'] == 4
+        assert svc.stats()['cached'] == 2
+        assert svc.encode(['a', 'bb'], model_name='m1').shape == (2, 2)
+        assert loaded_models == ['m1', 'm2']
+
+
+class TestAsyncLLM(TestCase):
+
+    def run_client(self, server, prompts, max_concurrency, rate_limiter=None, use_cache=False, return_exceptions=False):
+        import asyncio
+        from openai import AsyncOpenAI
+        from src.llm import AsyncLLMClient
+
+        async def run():
+            llm_client = AsyncLLMClient(model='fake', max_concurrency=max_concurrency, rate_limiter=rate_limiter, use_cache=use_cache,
+                                        client=AsyncOpenAI(base_url=server.base_url, api_key='x', max_retries=0))
+            try:
+                return await llm_client.ask_many(prompts, return_exceptions=return_exceptions), llm_client.retries_count
+            finally:
+                await llm_client.close()
+        return asyncio.run(run())
+
+    def test_async_client_throughput(self):
+        import time
+        import src.llm as llm
+
+        server = FakeOpenAIServer(latency=0.1)
+        prompts = [f'prompt {i}' for i in range(40)]
+        try:
+            spend_before = llm.TOTAL_SPEND
+            started = time.perf_counter()
+            answers, _ = self.run_client(server, prompts, max_concurrency=1)
+            sequential_time = time.perf_counter() - started
+            sequential_spend = llm.TOTAL_SPEND - spend_before
+            started = time.perf_counter()
+            concurrent_answers, _ = self.run_client(server, prompts, max_concurrency=10)
+            concurrent_time = time.perf_counter() - started
+        finally:
+            server.close()
+        print(f'{len(prompts)} prompts: sequential {sequential_time:.2f}s, concurrent {concurrent_time:.2f}s')
+        assert answers == concurrent_answers == [p[::-1] for p in prompts]  # in order of prompts
+        assert 1 < server.max_in_flight <= 10
+        assert concurrent_time * 3 < sequential_time
+        tokens = sum(len(p) for p in prompts)
+        assert abs(sequential_spend - tokens * (cfg.llm_price[0] + cfg.llm_price[1]) / 1000000) < 1e-12
+        assert abs(llm.TOTAL_SPEND - spend_before - 2 * sequential_spend) < 1e-12
+
+    def test_async_client_retries_and_rate_limit(self):
+        import asyncio
+        import threading
+        import time
+        from src.llm import RateLimiter
+
+        server = FakeOpenAIServer(latency=0.01, fail_first=3)
+        shared_limiter = RateLimiter(rpm=100, tpm=100000)
+        try:
+            answers, retries_count = self.run_client(server, ['a', 'b', 'c', 'd'], max_concurrency=4, rate_limiter=shared_limiter)
+        finally:
+            server.close()
+        assert answers == ['a', 'b', 'c', 'd'] and retries_count == 3 and server.requests_count == 7
+        assert len(shared_limiter._window) == 7 and shared_limiter._tokens == 4 * 2  # failed attempts are charged 0 tokens
+
+        def acquire_and_correct():  # event loops of different threads share the limiter
+            async def run():
+                for _ in range(200):
+                    shared_limiter.correct(await shared_limiter.acquire(3), 1)
+            asyncio.run(run())
+        shared_limiter.rpm = 10000
+        threads = [threading.Thread(target=acquire_and_correct) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert shared_limiter._tokens == sum(x[1] for x in shared_limiter._window) == 8 + 4 * 200
+
+        now = [0.0]
+        limiter = RateLimiter(rpm=2, tpm=100, clock=lambda: now[0])
+
+        async def acquire_all():
+            first = await limiter.acquire(10)
+            await limiter.acquire(10)
+            limiter.correct(first, 50)
+            third = asyncio.ensure_future(limiter.acquire(10))
+            await asyncio.sleep(0.05)
+            assert not third.done()  # 2 requests per minute are used up
+            now[0] = 61.0
+            await asyncio.wait_for(third, 2)
+            assert limiter._tokens == 10
+        started = time.perf_counter()
+        asyncio.run(acquire_all())
+        assert time.perf_counter() - started < 3
+
+    def test_completion_cache(self):
+        import asyncio
+        import tempfile
+        import time
+        import src.llm as llm
+        from src.completion_cache import CompletionCache, completion_key
+
+        server = FakeOpenAIServer(latency=0.01)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = f'{tmp_dir}/completions.sqlite'
+            saved_cache, llm.completion_cache = llm.completion_cache, CompletionCache(cache_path, max_entries=3)
+            try:
+                hits, misses, saved, spend = llm.CACHE_HITS, llm.CACHE_MISSES, llm.CACHE_SAVED_SPEND, llm.TOTAL_SPEND
+                answers, _ = self.run_client(server, ['one', 'two'], max_concurrency=2, use_cache=True)
+                assert llm.ask_llm_many(['one'], model='fake') == ['eno']  # real client, but answer is in cache
+                assert answers == ['eno', 'owt'] and server.requests_count == 2
+                assert (llm.CACHE_HITS - hits, llm.CACHE_MISSES - misses) == (1, 2)
+                assert abs(llm.CACHE_SAVED_SPEND - saved - (llm.TOTAL_SPEND - spend) / 2) < 1e-12  # 'one' and 'two' cost the same
+
+                async def in_notebook():  # Jupyter runs cells inside its event loop
+                    return llm.ask_llm_many(['two'], model='fake')
+                assert asyncio.run(in_notebook()) == ['owt'] and llm.AsyncLLMClient().rate_limiter is llm.account_rate_limiter
+                self.run_client(server, ['two'], max_concurrency=1, use_cache=False)  # bypass
+                assert server.requests_count == 3
+
+                llm.completion_cache.close()
+                read_only = CompletionCache(cache_path, read_only=True)
+                assert read_only.get(completion_key('fake', 'one'))[0] == 'eno'
+                read_only.put(completion_key('fake', 'three'), 'fake', 'eerht', 1.0)
+                assert read_only.get(completion_key('fake', 'three')) is None
+                read_only.close()
+
+                cache = CompletionCache(cache_path, max_entries=3)
+                for i in range(5):
+                    cache.put(completion_key('fake', str(i)), 'fake', str(i), 0.1)
+                    time.sleep(0.01)  # to order by last access
+                cache.get(completion_key('fake', '2'))
+                assert cache.evict() == 4 and cache.stats()['entries'] == 3  # 'one', 'two', '0', '1' are least recently used
+                assert cache.get(completion_key('fake', '2')) is not None and cache.get(completion_key('fake', '1')) is None
+                cache.max_age = 0
+                assert cache.get(completion_key('fake', '2')) is None and cache.evict() == 3
+                cache.close()
+            finally:
+                server.close()
+                llm.completion_cache = saved_cache
+
+    def test_llm_accounting_and_budgets(self):
+        from src.llm_accounting import BudgetExceeded, estimate_cost, llm_accounting
+
+        server = FakeOpenAIServer(latency=0.01)
+        prompts = [f'prompt {i}' for i in range(6)]
+        try:
+            with llm_accounting.scope('test_translation'):
+                self.run_client(server, prompts[:2], max_concurrency=2)
+            # budget for 3 calls by estimate, though real cost is much less, as completions are short
+            with llm_accounting.scope('test_summarization', hard_limit=3.5 * estimate_cost(5)) as budget:
+                answers, _ = self.run_client(server, prompts, max_concurrency=2, return_exceptions=True)
+                assert [isinstance(x, BudgetExceeded) for x in answers] == [False] * 3 + [True] * 3
+                assert server.requests_count == 2 + 3 and budget.reserved == 0 and budget.spent > 0
+                answers, _ = self.run_client(server, prompts[:1], max_concurrency=1)  # spent is settled by real usage
+                assert answers == [prompts[0][::-1]]
+        finally:
+            server.close()
+        summary = llm_accounting.summary()
+        assert summary['test_translation']['calls'] == 2 and summary['test_summarization']['calls'] == 4
+        assert summary['test_translation']['prompt_tokens'] == sum(len(p) for p in prompts[:2])
+        assert summary['test_summarization']['latency_per_call'] > 0.01
+        assert json.loads(llm_accounting.to_json())['test_translation']['cost'] == summary['test_translation']['cost']
+        prometheus = llm_accounting.to_prometheus()
+        assert '# TYPE llm_cost_usd_total counter' in prometheus
+        assert 'llm_calls_total{tag="test_summarization",model="fake"} 4' in prometheus
+
+    def test_translate_messages_by_one_client(self):
+        import os
+        import tempfile
+        from unittest.mock import patch
+        import src.llm as llm
+        from src.rag_integration import translate_messages
+
+        server = FakeOpenAIServer(latency=0.05)
+        msgs = [TelegaMessage(msg_id=i, msg_date=datetime(2024, 1, 1) + timedelta(minutes=i), msg_text=f'сообщение {i} ' * 20,
+                              reply_to_msg_id=None, chat_id=cfg.telegram_group_id) for i in range(1, 41)]
+        with tempfile.TemporaryDirectory() as tmp_dir, patch.dict(os.environ, {'OPENAI_BASE_URL': server.base_url}), \
+                patch.object(cfg, 'llm_cache_mode', 'off'), patch.object(llm, 'completion_cache', None), \
+                patch.object(llm, 'account_rate_limiter', llm.RateLimiter(tpm=10 ** 7)):  # fake usage counts letters as tokens
+            try:
+                translate_messages(msgs, tmp_dir, max_tokens_count=300, llm_model='fake')
+            finally:
+                server.close()
+            files = os.listdir(tmp_dir)
+        assert len(files) == server.requests_count > cfg.llm_max_concurrency
+        assert 1 < server.max_in_flight <= cfg.llm_max_concurrency
+
+    def test_topic_pipeline_resume(self):
+        import re
+        import tempfile
+        from openai import AsyncOpenAI
+        from src.llm import AsyncLLMClient, RateLimiter
+        from src.topic_pipeline import select_topic_roots, summarize_topics
+
+        start = datetime(2024, 1, 1)
+        msgs = []
+        for topic in range(30):  # topic of 3 + topic % 5 messages, started by message topic * 10
+            for i in range(3 + topic % 5):
+                msg_id = topic * 10 + i
+                msgs.append(TelegaMessage(msg_id=msg_id, msg_date=start + timedelta(days=topic, minutes=i), msg_text=f'text {msg_id}',
+                                          reply_to_msg_id=topic * 10 if i else None, chat_id=cfg.telegram_group_id))
+        mi = TelegaMessageIndex.from_messages(msgs)
+        roots = select_topic_roots(mi, min_size=5, date_to=start + timedelta(days=25))
+        assert roots == [t * 10 for t in range(26) if 3 + t % 5 >= 5]
+
+        def respond(prompt):
+            ids = sorted({int(x) for x in re.findall(r'"(?:msg_)?id": ?(\d+)', prompt.split("let's play")[1])})
+            if ids[0] == 30 and not respond.fail_once:
+                respond.fail_once = True
+                return 'not a json'
+            return '```json' + json.dumps({'topic_name': f'topic {ids[0]}', 'msg_ids': ids}) + '```'
+        respond.fail_once = False
+        indexed = []
+
+        def run(server, checkpoint_path):
+            llm_client = AsyncLLMClient(model='fake', max_concurrency=4, use_cache=False, rate_limiter=RateLimiter(tpm=10 ** 7),
+                                        client=AsyncOpenAI(base_url=server.base_url, api_key='x', max_retries=0))
+            return summarize_topics(mi, min_size=5, date_to=start + timedelta(days=25), checkpoint_path=checkpoint_path,
+                                    llm_client=llm_client, index_docs=lambda docs: indexed.extend(docs) or {'failed': []}, flush_size=4)
+
+        server = FakeOpenAIServer(latency=0.05, respond=respond)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                stats = run(server, f'{tmp_dir}/topics.jsonl')
+                assert stats['done'] == len(roots) - 1 and [x[0] for x in stats['failed']] == [30]
+                stats = run(server, f'{tmp_dir}/topics.jsonl')  # rerun only does the failed topic
+                assert stats['skipped'] == len(roots) - 1 and stats['done'] == 1 and not stats['failed']
+            finally:
+                server.close()
+        assert sorted(d['topic_name'] for d in indexed) == sorted(f'topic {x}' for x in roots)
+        assert server.requests_count == len(roots) + 1
+        assert next(d for d in indexed if d['topic_name'] == 'topic 40')['msg_ids'] == list(range(40, 47))
+        assert sorted(d['topic_msg_id'] for d in indexed) == roots  # doc id, as LLM may give the same name to different topics
+
+
+class TestRagBenchmark(TestCase):
+
+    def test_benchmark_with_local_stand_ins(self):
+        import os
+        import tempfile
+        import zlib
+        import numpy as np
+        from unittest.mock import patch
+        from src import rag_benchmark
+        from src.embeddings import EmbeddingService
+        from src.elastic_search.local_es import LocalElasticsearch
+
+        class FakeModel:
+            def encode(self, texts, batch_size=None):
+                def vector(text):
+                    return sum(np.random.default_rng(zlib.crc32(w.encode())).normal(size=512) for w in text.lower().split())
+                return [vector(t) for t in texts] if isinstance(texts, list) else vector(texts)
+
+        msgs = [{'msg_id': 1, 'msg_date': '2024-08-01T10:00:00', 'msg_text': 'how to feed a cat'},
+                {'msg_id': 2, 'msg_date': '2024-08-01T10:01:00', 'msg_text': 'cat food from the market', 'reply_to_msg_id': 1},
+                {'msg_id': 3, 'msg_date': '2024-08-02T10:00:00', 'msg_text': 'taxi to the airport'},
+                {'msg_id': 4, 'msg_date': '2024-08-03T10:00:00', 'msg_text': 'visa run to georgia'}]
+        topics = [{'topic_name_eng': 'cat food', 'msg_ids': '[1, 2]'}, {'topic_name_eng': 'airport taxi', 'msg_ids': '[3]'}]
+        encoder = EmbeddingService(model_loader=lambda name: FakeModel())
+        local_es = LocalElasticsearch(encoder)
+        local_es.add_docs(cfg.index_name_messages, msgs)
+        local_es.add_docs(cfg.index_name_messages_eng, msgs)
+        local_es.add_docs(cfg.index_name_topics, topics)
+        assert local_es.search(cfg.index_name_messages, {'query': {'match': {'msg_text': 'cat'}}})['hits']['hits'][0]['_score'] > 0
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gt_path, topics_path = os.path.join(tmp_dir, 'gt.json'), os.path.join(tmp_dir, 'topics.json')
+            with open(gt_path, 'w') as f:
+                json.dump([{'question': 'what food for cat', 'tags': 'cat food'},
+                           {'question': 'taxi to airport', 'answer_msg_ids': [3]},
+                           {'question': 'unknown question'}], f)
+            with open(topics_path, 'w') as f:
+                json.dump([{'question': 'what food for cat', 'answer_message_ids': '[2]'}], f)
+            ground_truth = rag_benchmark.load_ground_truth(gt_path, topics_path)
+        assert [x['answer_msg_ids'] for x in ground_truth] == [[2], [3]]
+
+        fake_llm = rag_benchmark.FakeLLM()
+        with patch.object(es, 'es_client', local_es), patch.object(es, 'embedding_service', encoder), \
+                patch('src.rag_integration.embedding_service', encoder), patch.object(cfg, 'vector_search_backend', 'es'):
+            index = TelegaMessageIndex.from_messages(TelegaMessage.model_validate(d) for d in local_es.indices[cfg.index_name_messages].docs)
+            rg = RaguDuDu(telegram_index=index, ask_llm=fake_llm)
+            results = rag_benchmark.run_benchmark(rg, ground_truth, ['topics', 'simple_search', 'dense_vector_search', 'hybrid_search'])
+        print(json.dumps(results, indent=4))
+        assert fake_llm.calls > 0
+        for name in ['topics', 'dense_vector_search', 'hybrid_search']:
+            assert results[name]['errors'] == 0 and results[name]['hit_rate'] == 1.0
+        assert results['dense_vector_search']['mrr'] > 0.5
+        assert {'embed', 'search', 'context', 'prompt', 'llm', 'total'} <= set(results['dense_vector_search']['latency_ms'])
+        assert set(results['dense_vector_search']['latency_ms']['total']) == {'p50', 'p95', 'p99', 'mean'}
+
+        worse = json.loads(json.dumps({'methods': results}))
+        worse['methods']['topics']['hit_rate'] = 0.5
+        assert rag_benchmark.compare_results(worse, {'methods': results}) == ['topics hit_rate 1.000 -> 0.500']
+        assert rag_benchmark.compare_results({'methods': results}, {'methods': results}) == []
+
+        with patch.object(es, 'es_client', local_es), patch.object(es, 'embedding_service', encoder), \
+                patch.object(cfg, 'vector_search_backend', 'es'):
+            tokens = rag_benchmark.measure_prompt_tokens(rg, ground_truth, ['dense_vector_search'])['dense_vector_search']
+        assert tokens['compact_tokens'] < tokens['json_tokens'] and tokens['savings'] > 0.3
+        assert tokens['context_hit_rate_compact'] == tokens['context_hit_rate_json'] == 1.0
+
+
+class TestAnswerCache(TestCase):
+
+    def test_semantic_answer_cache(self):
+        import zlib
+        import numpy as np
+        from unittest.mock import MagicMock, patch
+        from src.answer_cache import SemanticAnswerCache, note_retrieved
+        from src.embeddings import EmbeddingService
+
+        class FakeModel:
+            def encode(self, text, batch_size=None):  # bag of words, so word order does not change the vector
+                return sum(np.random.default_rng(zlib.crc32(w.encode())).normal(size=64) for w in text.lower().split())
+
+        now = [1000.0]
+        cache = SemanticAnswerCache(threshold=0.9, ttl=60, max_entries=10, encoder=EmbeddingService(model_loader=lambda name: FakeModel()),
+                                    clock=lambda: now[0])
+
+        class FakeRag:
+            calls = 0
+
+            @cache.cached()
+            def rag_by_question(self, question, number_of_docs=5):
+                FakeRag.calls += 1
+                note_retrieved([1, 2][:number_of_docs])
+                return {'answer': f'answer {FakeRag.calls}', 'msg_ids': [1]}
+
+        rag = FakeRag()
+        assert rag.rag_by_question('where to find a plumber') == {'answer': 'answer 1', 'msg_ids': [1]}
+        assert rag.rag_by_question('Where to find a   plumber') == {'answer': 'answer 1', 'msg_ids': [1]}
+        assert rag.rag_by_question('a plumber where to find') == {'answer': 'answer 1', 'msg_ids': [1]}
+        assert rag.rag_by_question('taxi from the airport')['answer'] == 'answer 2'
+        assert rag.rag_by_question('where to find a plumber', number_of_docs=1)['answer'] == 'answer 3'  # other arguments
+        assert rag.rag_by_question('where to find a plumber', 1)['answer'] == 'answer 3'  # the same arguments, given by position
+        assert rag.rag_by_question('where to find a plumber', number_of_docs=5)['answer'] == 'answer 1'  # the default one
+        assert FakeRag.calls == 3
+        stats = cache.stats()
+        assert stats['hits'] == 4 and stats['misses'] == 3 and stats['cached'] == 3 and stats['saved_latency'] > 0
+        assert [x['msg_ids'] for x in cache._entries.values()] == [[1, 2], [1], [1, 2]]  # in order of use
+
+        now[0] += 61  # expired
+        assert rag.rag_by_question('where to find a plumber')['answer'] == 'answer 4'
+
+        failing_client = MagicMock()
+        failing_client.index.side_effect = Exception('ES is down')
+        with patch.object(es, 'es_client', failing_client), patch.object(es, 'index_listeners', [cache.on_index]):
+            with self.assertRaises(Exception):
+                es.index_docs([{'msg_id': 5, 'msg_text': 'call Ivan the plumber'}], cfg.index_name_messages, recreate_index=False)
+        assert cache.stats()['cached'] == 1  # failed load does not drop answers
+        with patch.object(es, 'es_client', MagicMock()), patch.object(es, 'index_listeners', [cache.on_index]):
+            es.index_docs([{'msg_id': 5, 'msg_text': 'call Ivan the plumber'}], cfg.index_name_messages, recreate_index=False)
+        assert cache.stats()['cached'] == 0
+        assert rag.rag_by_question('where to find a plumber')['answer'] == 'answer 5'
+        with patch.object(cfg, 'answer_cache_enabled', False):
+            assert rag.rag_by_question('where to find a plumber')['answer'] == 'answer 6'
+
+
+class TestRagStream(TestCase):
+
+    def test_rag_stream(self):
+        import zlib
+        import numpy as np
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock, patch
+        from src import llm
+        from src.answer_cache import answer_cache
+        from src.embeddings import EmbeddingService
+        from src.elastic_search.local_es import LocalElasticsearch
+        from src.llm_accounting import llm_accounting
+
+        field_stream = llm.JsonFieldStream('answer')
+        raw = '{"msg_ids": [1], "answer": "Buy \\"Whiskas\\"\\nor \\u043a\\u043e\\u0442 food"}'
+        assert ''.join(field_stream.feed(raw[i:i + 3]) for i in range(0, len(raw), 3)) == 'Buy "Whiskas"\nor кот food'
+        assert field_stream.done
+
+        chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=x))], usage=None) for x in ['{"ans', 'wer": "hi"}']]
+        chunks.append(SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5)))
+        fake_client = MagicMock()
+        fake_client.chat.completions.create.return_value.__enter__.return_value = iter(chunks)
+        with patch.object(llm, 'client', fake_client), patch.object(cfg, 'llm_cache_mode', 'off'):
+            spend = llm.TOTAL_SPEND
+            assert list(llm.ask_llm_stream('prompt')) == ['{"ans', 'wer": "hi"}']
+            assert llm.TOTAL_SPEND > spend
+        assert fake_client.chat.completions.create.call_args.kwargs['stream']
+
+        class FakeModel:
+            def encode(self, texts, batch_size=None):
+                def vector(text):
+                    return sum(np.random.default_rng(zlib.crc32(w.encode())).normal(size=512) for w in text.lower().split())
+                return [vector(t) for t in texts] if isinstance(texts, list) else vector(texts)
+
+        msgs = [{'msg_id': 1, 'msg_date': '2024-08-01T10:00:00', 'msg_text': 'how to feed a cat'},
+                {'msg_id': 2, 'msg_date': '2024-08-01T10:01:00', 'msg_text': 'cat food from the market', 'reply_to_msg_id': 1},
+                {'msg_id': 3, 'msg_date': '2024-08-02T10:00:00', 'msg_text': 'taxi to the airport'}]
+        encoder = EmbeddingService(model_loader=lambda name: FakeModel())
+        local_es = LocalElasticsearch(encoder)
+        local_es.add_docs(cfg.index_name_messages_eng, msgs)
+        answer = {'answer': 'Cat food is sold at the "market"', 'msg_ids': [2]}
+        answer_json = json.dumps(answer)
+        llm_calls = []
+
+        def fake_llm_stream(prompt, model):
+            llm_calls.append(prompt)
+            for i in range(0, len(answer_json), 4):
+                yield answer_json[i:i + 4]
+
+        answer_cache.clear()
+        with patch.object(es, 'es_client', local_es), patch.object(es, 'embedding_service', encoder), \
+                patch('src.rag_integration.embedding_service', encoder), patch.object(answer_cache, 'encoder', encoder), \
+                patch.object(cfg, 'vector_search_backend', 'es'), patch.object(cfg, 'answer_cache_enabled', True):
+            index = TelegaMessageIndex.from_messages(TelegaMessage.model_validate({**d, 'reply_to_msg_id': d.get('reply_to_msg_id')})
+                                                     for d in msgs)
+            rg = RaguDuDu(telegram_index=index, ask_llm=lambda prompt, model: answer_json, ask_llm_stream=fake_llm_stream)
+            events = list(rg.rag_stream('what food for a cat'))
+            assert 'messages' in events[0] and 2 in [x.msg_id for x in events[0]['messages']]
+            tokens = [x['token'] for x in events[1:-1]]
+            assert len(tokens) > 1 and ''.join(tokens) == answer['answer']
+            assert events[-1] == {'answer': answer}
+            assert len(llm_calls) == 1 and answer_cache.stats()['misses'] == 1
+
+            cached_events = list(rg.rag_stream('what food for a cat'))  # answer cache is shared with rag_by_dense_vector_search
+            assert cached_events[1:] == [{'token': answer['answer']}, {'answer': answer}]
+            assert rg.rag_by_dense_vector_search('what food for a cat') == answer
+            assert len(llm_calls) == 1 and answer_cache.stats()['hits'] == 2
+
+            answer_cache.store('rag_by_topics', 'taxi to the airport', answer_json)  # rag_by_topics caches the raw LLM result
+            cached_events = list(rg.rag_stream('taxi to the airport', method='rag_by_topics'))
+            assert cached_events[1:] == [{'token': answer['answer']}, {'answer': answer_json}]
+
+            abandoned = rg.rag_stream('cat food from the market')
+            next(abandoned)
+            assert llm_accounting.current_tag() == 'untagged'  # scope of the query does not leak to the reader
+            next(abandoned)
+            abandoned.close()
+            assert len(llm_calls) == 2
+        answer_cache.clear()
+
+
+class TestRagService(TestCase):
+
+    def test_rag_service_batching_and_admission(self):
+        import asyncio
+        import zlib
+        import numpy as np
+        from unittest.mock import patch
+        from src import rag_service
+        from src.rag_benchmark import FakeLLM
+        from src.embeddings import EmbeddingService
+        from src.elastic_search.local_es import LocalElasticsearch
+
+        class FakeModel:
+            batch_sizes = []
+
+            def encode(self, texts, batch_size=None):
+                def vector(text):
+                    return sum(np.random.default_rng(zlib.crc32(w.encode())).normal(size=512) for w in text.lower().split())
+                if isinstance(texts, list):
+                    FakeModel.batch_sizes.append(len(texts))
+                    return [vector(t) for t in texts]
+                return vector(texts)
+
+        msgs = [{'msg_id': i, 'msg_date': f'2024-08-01T10:{i:02d}:00', 'msg_text': f'message {i} about cats and plumbers'}
+                for i in range(1, 30)]
+        encoder = EmbeddingService(model_loader=lambda name: FakeModel())
+        local_es = LocalElasticsearch(encoder)
+        local_es.add_docs(cfg.index_name_messages_eng, msgs)
+        FakeModel.batch_sizes.clear()
+        questions = [f'question {i} about cats' for i in range(40)]
+
+        async def scenario(service_kwargs, requests, concurrency):
+            service = rag_service.RagService(rg, warm_reranker=False, batcher=rag_service.QuestionBatcher(encoder, 0.02), **service_kwargs)
+            port = await service.start('127.0.0.1', 0)
+            try:
+                results = await rag_service.load_test('127.0.0.1', port, questions, requests, concurrency)
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                checks = [await rag_service.http_request(reader, writer, 'POST', '/rag_by_nothing', {'question': 'x'}),
+                          await rag_service.http_request(reader, writer, 'POST', '/rag_by_dense_vector_search', {'query': 'x'}),
+                          await rag_service.http_request(reader, writer, 'GET', '/stats')]
+                body = json.dumps({'question': 'question 1 about cats'}).encode()
+                writer.write(f'POST /rag_stream HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+                stream = (await reader.read()).decode()
+                writer.close()
+                return results, checks, stream
+            finally:
+                await service.stop()
+
+        with patch.object(es, 'es_client', local_es), patch.object(es, 'embedding_service', encoder), \
+                patch('src.rag_integration.embedding_service', encoder), patch.object(cfg, 'vector_search_backend', 'es'), \
+                patch.object(cfg, 'answer_cache_enabled', False):
+            index = TelegaMessageIndex.from_messages(TelegaMessage.model_validate({**d, 'reply_to_msg_id': None}) for d in msgs)
+            rg = RaguDuDu(telegram_index=index, ask_llm=FakeLLM(latency=0.05))
+            results, checks, stream = asyncio.run(scenario({'workers': 8}, 40, 16))
+            print(json.dumps({k: v for k, v in results.items() if k != 'service'}, indent=4))
+            assert results['rejected'] == results['failed'] == 0 and results['throughput_rps'] > 0
+            assert sum(FakeModel.batch_sizes) == 40 and max(FakeModel.batch_sizes) > 1  # each question encoded once, in batches
+            assert [x[0] for x in checks] == [404, 400, 200]
+            assert checks[2][1]['batching']['mean_batch_size'] > 1 and checks[2][1]['latency_ms']['p95'] > 0
+            assert stream.startswith('HTTP/1.1 200') and '"messages"' in stream and '"token"' in stream and stream.endswith('0\r\n\r\n')
+
+            results, _, _ = asyncio.run(scenario({'workers': 1, 'max_queue': 2}, 12, 6))  # queue is full, so some are rejected
+            assert 0 < results['rejected'] < 12 and results['failed'] == 0
+
+
+class TestReranker(TestCase):
+
+    def test_reranker_engine_cache(self):
+        import math
+        import numpy as np
+        from src.reranker import RerankerEngine
+
+        class FakeCrossEncoder:
+            pairs_scored = 0
+
+            def predict(self, pairs, batch_size=32):
+                assert len(pairs) <= 3 or batch_size == 3
+                FakeCrossEncoder.pairs_scored += len(pairs)
+                return np.array([len(a) - len(q) for q, a in pairs], dtype=np.float32)
+
+        loads = []
+        engine = RerankerEngine(batch_size=3, max_cache_size=4, model_loader=lambda name: loads.append(name) or FakeCrossEncoder())
+        answers = ['short', 'a bit longer answer', 'short', 'the longest answer of all']
+        scores = engine.predict('what  is best', answers)
+        assert scores == [1 / (1 + math.exp(-(len(a) - len('what is best')))) for a in answers]
+        assert FakeCrossEncoder.pairs_scored == 3  # duplicated answer is scored once
+        docs = [{'doc': {'msg_text': a}} for a in answers[:3]]
+        engine.rerank(docs, 'what is best')
+        assert [d['doc']['msg_text'] for d in docs] == ['a bit longer answer', 'short', 'short']
+        assert FakeCrossEncoder.pairs_scored == 3 and engine.stats()['hits'] == 3
+        engine.predict('other question', ['short', 'x'])  # evicts least recently used scores
+        assert engine.stats()['cached'] == 4 and loads == [cfg.reranker_model_name]
+
 
 class TestLLM(TestCase):
 
@@ -166,6 +1420,40 @@ class TestLLM(TestCase):
         ret = self.rg.rag_reranked(question='Where I can repair my refrigerator?')
         print(ret)
 
+    def test_rerank_benchmark(self):
+        import time
+        import numpy as np
+        from src.rag_integration import CrossEncoderRanker
+        from src.reranker import RerankerEngine
+
+        with open(topics_file_path, 'r') as f:
+            topics = json.load(f)
+        engines = {'torch': RerankerEngine(backend='torch'), 'int8': RerankerEngine(backend='int8')}
+        for engine in engines.values():
+            engine.warm_up()
+        timings, hits = {'baseline': 0.0, **{k: 0.0 for k in engines}}, {'baseline': 0, **{k: 0 for k in engines}}
+        for topic in topics:
+            question, answer_ids = topic['question'], {int(x) for x in topic['answer_message_ids']}
+            candidates = es.knn_vector_search(search_term=question, search_field='msg_text_vector',
+                                              index_name=cfg.index_name_messages_eng, number_of_docs=10)
+            answers = [x['doc']['msg_text'] for x in candidates]
+            started = time.perf_counter()
+            baseline_scores = CrossEncoderRanker(model_name=cfg.reranker_model_name).predict(question=question, answers=answers)
+            timings['baseline'] += time.perf_counter() - started
+            ranked = sorted(zip(baseline_scores, candidates), key=lambda x: x[0], reverse=True)[:5]
+            hits['baseline'] += bool(answer_ids & {int(d['doc']['msg_id']) for _, d in ranked})
+            for name, engine in engines.items():
+                docs = [dict(x) for x in candidates]
+                started = time.perf_counter()
+                engine.rerank(docs, question)
+                timings[name] += time.perf_counter() - started
+                hits[name] += bool(answer_ids & {int(d['doc']['msg_id']) for d in docs[:5]})
+                if name == 'torch':
+                    assert np.allclose(sorted(baseline_scores), sorted(d['reranked_score'] for d in docs), atol=1e-5)
+        for name in timings:
+            print(f'{name}: {timings[name] / len(topics) * 1000:.1f} ms per question, hit@5 {hits[name] / len(topics):.2f}')
+        assert timings['torch'] < timings['baseline']
+
     def test_rag_by_dense_vector_search(self):
         ret = self.rg.rag_by_dense_vector_search(question='Where I can repair my refrigerator?')
         print(ret)
@@ -4,18 +4,38 @@ import streamlit as st
 from src.rag_integration import RaguDuDu
 
 
+@st.cache_resource
+def get_rag() -> RaguDuDu:
+    """built once per process, not on every rerun of the script"""
+    return RaguDuDu()
+
+
 def main():
-    rg = RaguDuDu()
+    rg = get_rag()
     st.title("RAG Function Invocation")
 
     user_input = st.text_input("Enter your input:")
 
     if st.button("Ask"):
-        with st.spinner('Processing your request'):
-            ret = rg.rag_by_dense_vector_search(question=user_input)
-            st.success("Completed!")
-            st.write(ret)
+        with st.spinner('Searching for messages'):
+            events = rg.rag_stream(question=user_input, method='rag_by_dense_vector_search')
+            msgs = next(events)['messages']
+        with st.expander(f'{len(msgs)} messages found'):
+            st.json([x.model_dump(mode='json') for x in msgs])
+        result = dict()
+
+        def answer_tokens():
+            for event in events:
+                if 'token' in event:
+                    yield event['token']
+                else:
+                    result.update(event)
+
+        st.write_stream(answer_tokens())
+        st.success("Completed!")
+        if result.get('answer'):
+            st.write(result['answer'])
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()